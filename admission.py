@@ -0,0 +1,225 @@
+"""
+Admission control in front of the API, so that one client cannot fill SQLite's single writer for everyone.
+
+Every request carrying a token draws from that token's bucket and gets 429 when it is empty. Writes (every
+method but GET and HEAD) also need one of a fixed number of write slots. A write is turned away with 503 at
+once when the queue of writes waiting for a slot is full, or when the wait it can expect, from the queue
+length and how long writes have recently held their slot, is longer than it may wait; a write that does queue
+and still waits too long gets 503 too. Both responses carry Retry-After.
+"""
+import asyncio
+import math
+import os
+import time
+from collections import OrderedDict, deque
+from typing import Optional, Tuple
+
+from commons import scope_token
+from serializers import ORJSONResponse
+
+READ_METHODS = ("GET", "HEAD")
+
+
+class RateLimiter:
+    """
+    Token bucket per key: `burst` requests at once, refilled at `rate` per second. Buckets are kept in an LRU
+    of at most `maxsize` keys, so a check is a dict lookup and memory stays bounded; a key pushed out of the
+    LRU starts again with a full bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, maxsize: int, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.clock = clock
+        self.allowed = 0
+        self.limited = 0
+        self.evictions = 0
+        self._buckets = OrderedDict()
+
+    def acquire(self, key) -> float:
+        """
+        Takes one request from the key's bucket; returns 0 when allowed, otherwise the seconds until it would be
+        """
+        now = self.clock()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            level = self.burst
+        else:
+            level = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            self._buckets.move_to_end(key)
+
+        if level < 1:
+            self._buckets[key] = (level, now)
+            self.limited += 1
+            return (1 - level) / self.rate
+
+        self._buckets[key] = (level - 1, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+            self.evictions += 1
+        self.allowed += 1
+        return 0.0
+
+    def clear(self):
+        self._buckets.clear()
+        self.allowed = self.limited = self.evictions = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+
+class WriteGate:
+    """
+    At most `limit` writes in flight, and at most `max_queue` more waiting for a slot, each for up to `max_wait`
+    seconds. Slots are handed over in arrival order. How long a write holds its slot is tracked as a moving
+    average, which gives the wait a new write can expect without measuring it.
+    """
+
+    def __init__(self, limit: int, max_queue: int, max_wait: float, clock=time.monotonic):
+        self.limit = limit
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.clock = clock
+        self.active = 0
+        self.hold_seconds = 0.0
+        self.admitted = 0
+        self.shed = {"queue_full": 0, "overloaded": 0, "timeout": 0}
+        self._waiters = deque()
+        self._waiting = 0
+
+    @property
+    def waiting(self) -> int:
+        return self._waiting
+
+    def expected_wait(self) -> float:
+        if self.active < self.limit:
+            return 0.0
+        return (self._waiting + 1) * self.hold_seconds / self.limit
+
+    def refusal(self) -> Optional[Tuple[str, float]]:
+        """
+        (reason, retry after) when a write arriving now should be shed without queueing, otherwise None
+        """
+        if self.active < self.limit:
+            return None
+        expected = self.expected_wait()
+        if self._waiting >= self.max_queue:
+            self.shed["queue_full"] += 1
+            return "queue_full", expected
+        if expected > self.max_wait:
+            self.shed["overloaded"] += 1
+            return "overloaded", expected
+        return None
+
+    async def acquire(self) -> Optional[float]:
+        """
+        Waits for a slot; returns the time the slot was taken, or None when `max_wait` ran out first
+        """
+        if self.active < self.limit and not self._waiting:
+            self.active += 1
+            self.admitted += 1
+            return self.clock()
+
+        slot = asyncio.get_running_loop().create_future()
+        self._waiters.append(slot)
+        self._waiting += 1
+        try:
+            await asyncio.wait_for(slot, self.max_wait)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as error:
+            # The slot may have been handed over just as the wait ended; pass it on rather than lose it.
+            if slot.done() and not slot.cancelled():
+                self._hand_over()
+            if isinstance(error, asyncio.CancelledError):
+                raise
+            self.shed["timeout"] += 1
+            return None
+        finally:
+            self._waiting -= 1
+        self.admitted += 1
+        return self.clock()
+
+    def release(self, taken_at: float):
+        self.hold_seconds += (self.clock() - taken_at - self.hold_seconds) * 0.1
+        self._hand_over()
+
+    def _hand_over(self):
+        # A waiter that timed out is still queued, cancelled; skip it. The slot passes straight to the next
+        # waiter, so `active` does not change.
+        while self._waiters:
+            slot = self._waiters.popleft()
+            if not slot.done():
+                slot.set_result(None)
+                return
+        self.active -= 1
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware applying the per-token RateLimiter and the WriteGate; either may be None to turn it off
+    """
+
+    def __init__(self, app, limiter: Optional[RateLimiter], gate: Optional[WriteGate]):
+        self.app = app
+        self.limiter = limiter
+        self.gate = gate
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        if self.limiter is not None:
+            token = scope_token(scope)
+            retry_after = self.limiter.acquire(token) if token else 0.0
+            if retry_after:
+                return await _reject(429, "Too many requests", retry_after, scope, receive, send)
+
+        if self.gate is None or scope["method"] in READ_METHODS:
+            return await self.app(scope, receive, send)
+
+        refusal = self.gate.refusal()
+        if refusal is not None:
+            return await _reject(503, "Server busy", refusal[1], scope, receive, send)
+        taken_at = await self.gate.acquire()
+        if taken_at is None:
+            return await _reject(503, "Server busy", self.gate.expected_wait(), scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.gate.release(taken_at)
+
+
+async def _reject(status_code: int, detail: str, retry_after: float, scope, receive, send):
+    response = ORJSONResponse(status_code=status_code, content={"detail": detail},
+                              headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+    await response(scope, receive, send)
+
+
+def rate_limiter_from_env() -> Optional[RateLimiter]:
+    """
+    WALLET_RATE_LIMIT requests per second per token (0 turns the limiter off), in bursts of up to
+    WALLET_RATE_BURST, with buckets for at most WALLET_RATE_LIMIT_TOKENS tokens
+    """
+    rate = float(os.getenv("WALLET_RATE_LIMIT", "20"))
+    if rate <= 0:
+        return None
+    return RateLimiter(
+        rate,
+        burst=float(os.getenv("WALLET_RATE_BURST", "40")),
+        maxsize=int(os.getenv("WALLET_RATE_LIMIT_TOKENS", "100000"))
+    )
+
+
+def write_gate_from_env() -> Optional[WriteGate]:
+    """
+    WALLET_MAX_CONCURRENT_WRITES slots (0 turns the gate off), WALLET_MAX_WRITE_QUEUE waiting writes and
+    WALLET_MAX_WRITE_WAIT seconds of waiting
+    """
+    limit = int(os.getenv("WALLET_MAX_CONCURRENT_WRITES", "32"))
+    if limit <= 0:
+        return None
+    return WriteGate(
+        limit,
+        max_queue=int(os.getenv("WALLET_MAX_WRITE_QUEUE", "256")),
+        max_wait=float(os.getenv("WALLET_MAX_WRITE_WAIT", "0.5"))
+    )
@@ -0,0 +1,307 @@
+"""
+Cold storage for old transactions.
+
+`python manage.py archive` moves transactions older than WALLET_ARCHIVE_AFTER_DAYS out of the transactions
+table into one SQLite database per calendar month (transactions-2024-01.db, ...) in WALLET_ARCHIVE_DIR. The
+archives are shared by all shards and only ever appended to. For every wallet and month an ArchivedMonth row
+next to the wallet records how many transactions were archived and which one was the last, and a balance
+checkpoint is written at the last archived transaction, so balances stay exact without the archives.
+
+The readers below span both tiers: history pages and exports continue into the archived months when the hot
+table runs out, and point-in-time balances look up the archived running balance. A wallet with nothing
+archived pays one extra primary-key lookup at most.
+
+Archiving leaves the transaction_references table alone, so a retried deposit or withdrawal is still recognised
+and answered with its original result after the transaction has been archived.
+"""
+import os
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Column, Index, MetaData, Table, delete, func, make_url, select, tuple_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker
+
+import crud
+import models
+from database import SQLALCHEMY_DATABASE_URL, begin_write, make_engine, read_only_url
+
+ARCHIVE_AFTER_DAYS = int(os.getenv("WALLET_ARCHIVE_AFTER_DAYS", "365"))
+ARCHIVE_CHUNK_SIZE = 5000
+# Wallets whose old transactions are collected per archival chunk.
+ARCHIVE_WALLET_BATCH = 500
+
+# The transactions table as it is laid out in an archive: the same columns, only the ledger-order index.
+archive_metadata = MetaData()
+archived_transactions = Table(
+    models.Transaction.__tablename__, archive_metadata,
+    *(Column(column.name, column.type, primary_key=column.primary_key)
+      for column in models.Transaction.__table__.columns),
+    Index("ix_transactions_wallet_id_transacted_at_id", "wallet_id", "transacted_at", "id")
+)
+
+_engines = {}
+
+
+def archive_directory() -> str:
+    """
+    WALLET_ARCHIVE_DIR, or an `archive` directory next to the SQLite database of shard 0
+    """
+    configured = os.getenv("WALLET_ARCHIVE_DIR")
+    if configured:
+        return configured
+    parsed = make_url(SQLALCHEMY_DATABASE_URL)
+    if parsed.get_backend_name() != "sqlite" or parsed.database in (None, "", ":memory:"):
+        raise ValueError("Set WALLET_ARCHIVE_DIR to archive transactions of a database that is not a SQLite file")
+    return os.path.join(os.path.dirname(os.path.abspath(parsed.database)), "archive")
+
+
+def archive_url(month: str) -> str:
+    return f"sqlite+aiosqlite:///{os.path.join(archive_directory(), f'transactions-{month}.db')}"
+
+
+def _engine(month: str, read_only: bool):
+    key = (archive_directory(), month, read_only)
+    engine = _engines.get(key)
+    if engine is None:
+        url = archive_url(month)
+        engine = _engines[key] = make_engine(read_only_url(url) if read_only else url, read_only=read_only)
+    return engine
+
+
+def archive_sessions(month: str) -> async_sessionmaker:
+    """
+    Read-only sessions on the archive of `month`
+    """
+    return async_sessionmaker(bind=_engine(month, read_only=True), autoflush=False, expire_on_commit=False)
+
+
+async def dispose_engines():
+    for engine in _engines.values():
+        await engine.dispose()
+    _engines.clear()
+
+
+async def archived_months(db: AsyncSession, wallet_id: str, newest_first: bool = True):
+    order = models.ArchivedMonth.month.desc() if newest_first else models.ArchivedMonth.month
+    query = select(models.ArchivedMonth).filter(models.ArchivedMonth.wallet_id == wallet_id).order_by(order)
+    return (await db.execute(query)).scalars().all()
+
+
+def _through(month: models.ArchivedMonth) -> Tuple[datetime, str]:
+    # Rows past this position were copied by a run that has not committed the move yet.
+    return month.last_transacted_at, month.last_transaction_id
+
+
+async def get_transactions_page(db: AsyncSession, wallet: crud.WalletRef, limit: int,
+                                after: Optional[Tuple[datetime, str]] = None, transaction_type: Optional[str] = None,
+                                transacted_from: Optional[datetime] = None, transacted_to: Optional[datetime] = None,
+                                min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                                archived: bool = True):
+    """
+    crud.get_transactions_page over the hot table, continued into the archived months, newest first, when the
+    page is not full. Every archived transaction is older than every transaction left in the hot table.
+    `archived=False` says the wallet has no archived months (see crud.get_wallet_state), saving their lookup.
+    """
+    filters = {"transaction_type": transaction_type, "transacted_from": transacted_from,
+               "transacted_to": transacted_to, "min_amount": min_amount, "max_amount": max_amount}
+    page = list(await crud.get_transactions_page(db=db, wallet=wallet, limit=limit, after=after, **filters))
+    if len(page) >= limit or not archived:
+        return page
+
+    for month in await archived_months(db, wallet.id):
+        if transacted_from is not None and month.last_transacted_at < transacted_from:
+            break
+        if after is not None and month.first_transacted_at > after[0]:
+            continue
+        if transacted_to is not None and month.first_transacted_at >= transacted_to:
+            continue
+        async with archive_sessions(month.month)() as archive_db:
+            page += await crud.get_transactions_page(db=archive_db, wallet=wallet, limit=limit - len(page),
+                                                     after=after, through=_through(month), **filters)
+        if len(page) >= limit:
+            break
+    return page
+
+
+async def stream_transactions(db: AsyncSession, wallet: crud.WalletRef, partition_size: int = 1000,
+                              archived: bool = True):
+    """
+    crud.stream_transactions over the archived months, oldest first, followed by the hot table; `archived` is
+    as in get_transactions_page
+    """
+    for month in await archived_months(db, wallet.id, newest_first=False) if archived else ():
+        async with archive_sessions(month.month)() as archive_db:
+            async for partition in crud.stream_transactions(archive_db, wallet, partition_size, _through(month)):
+                yield partition
+    async for partition in crud.stream_transactions(db, wallet, partition_size):
+        yield partition
+
+
+async def get_balance_at(db: AsyncSession, wallet: crud.WalletRef, at: datetime) -> Optional[crud.BalanceAt]:
+    """
+    crud.get_balance_at that also finds the running balance of archived transactions
+    """
+    state = await crud.get_status_and_balance_at(db, wallet, at)
+    if state is None or state.status != crud.WalletStatus.ENABLED.value or state.balance is not None:
+        return state
+    return state._replace(balance=await _archived_balance_at(db, wallet, at))
+
+
+async def _archived_balance_at(db: AsyncSession, wallet: crud.WalletRef, at: datetime) -> float:
+    """
+    Balance at `at` of a wallet with no transaction at or before it left in the transactions table
+    """
+    month = (await db.execute(
+        select(models.ArchivedMonth)
+        .filter(models.ArchivedMonth.wallet_id == wallet.id, models.ArchivedMonth.first_transacted_at <= at)
+        .order_by(models.ArchivedMonth.month.desc())
+        .limit(1))).scalar_one_or_none()
+    if month is not None:
+        async with archive_sessions(month.month)() as archive_db:
+            balance = await crud.get_last_balance_at(archive_db, wallet, at, through=_through(month))
+        if balance is not None:
+            return balance
+    return await crud.get_checkpoint_balance_at(db, wallet, at)
+
+
+async def archived_rollups(db: AsyncSession) -> List[dict]:
+    """
+    Daily rollups of the archived transactions of the wallets in `db`, for crud.rebuild_rollups
+    """
+    months = defaultdict(list)
+    for month in (await db.execute(select(models.ArchivedMonth))).scalars():
+        months[month.month].append(month)
+
+    rollups = []
+    day = func.date(archived_transactions.c.transacted_at)
+    for name, wallet_months in sorted(months.items()):
+        async with archive_sessions(name)() as archive_db:
+            for wallet_month in wallet_months:
+                rows = await archive_db.execute(
+                    select(day.label("day"), archived_transactions.c.type,
+                           func.sum(archived_transactions.c.amount).label("total_amount"),
+                           func.count().label("transaction_count"))
+                    .filter(archived_transactions.c.wallet_id == wallet_month.wallet_id,
+                            tuple_(archived_transactions.c.transacted_at, archived_transactions.c.id)
+                            <= tuple_(*_through(wallet_month)))
+                    .group_by(day, archived_transactions.c.type))
+                rollups += [
+                    {"wallet_id": wallet_month.wallet_id, "day": date.fromisoformat(row.day), "type": row.type,
+                     "total_amount": row.total_amount, "transaction_count": row.transaction_count}
+                    for row in rows
+                ]
+    return rollups
+
+
+async def archive_transactions(session_factory, cutoff: datetime, dry_run: bool = False) -> int:
+    """
+    Move every transaction made before `cutoff` from the database behind `session_factory` to the monthly
+    archives, in chunks of ARCHIVE_CHUNK_SIZE. Each chunk is first appended to the archives, then recorded in
+    archived_months and the balance checkpoints and deleted from the transactions table in one transaction,
+    which holds the write lock from the moment the chunk is read. A run that stops in between is finished by
+    the next one: rows already copied are skipped. Returns the number of transactions moved (or, with
+    `dry_run`, that would be moved).
+    """
+    transaction = models.Transaction
+    if dry_run:
+        async with session_factory() as db:
+            return (await db.execute(
+                select(func.count()).select_from(transaction).filter(transaction.transacted_at < cutoff))).scalar()
+
+    moved = 0
+    last_wallet_id = ""
+    while True:
+        async with session_factory() as db:
+            wallet_ids = (await db.execute(
+                select(models.Wallet.id).filter(models.Wallet.id > last_wallet_id)
+                .order_by(models.Wallet.id).limit(ARCHIVE_WALLET_BATCH))).scalars().all()
+        if not wallet_ids:
+            return moved
+        last_wallet_id = wallet_ids[-1]
+
+        while True:
+            async with session_factory() as db:
+                await begin_write(db)
+                rows = (await db.execute(
+                    select(*transaction.__table__.columns)
+                    .filter(transaction.wallet_id.in_(wallet_ids), transaction.transacted_at < cutoff)
+                    .order_by(transaction.wallet_id, transaction.transacted_at, transaction.id)
+                    .limit(ARCHIVE_CHUNK_SIZE))).mappings().all()
+                if not rows:
+                    break
+                await _append_to_archives(rows)
+                await _record_archived(db, rows)
+                await db.commit()
+            moved += len(rows)
+            if len(rows) < ARCHIVE_CHUNK_SIZE:
+                break
+
+
+async def _append_to_archives(rows):
+    by_month = defaultdict(list)
+    for row in rows:
+        by_month[row["transacted_at"].strftime("%Y-%m")].append(dict(row))
+
+    os.makedirs(archive_directory(), exist_ok=True)
+    for month, month_rows in by_month.items():
+        engine = _engine(month, read_only=False)
+        async with engine.begin() as conn:
+            await conn.run_sync(archive_metadata.create_all)
+            await conn.execute(sqlite.insert(archived_transactions).on_conflict_do_nothing(), month_rows)
+
+
+async def _record_archived(db: AsyncSession, rows):
+    """
+    Update archived_months, add a checkpoint at each wallet's last archived transaction and delete the rows
+    """
+    months = {}
+    for row in rows:
+        key = (row["wallet_id"], row["transacted_at"].strftime("%Y-%m"))
+        if key not in months:
+            months[key] = {"wallet_id": key[0], "month": key[1], "transaction_count": 0,
+                           "first_transacted_at": row["transacted_at"]}
+        # Rows come in (wallet_id, transacted_at, id) order, so the last one seen is the newest.
+        months[key].update(transaction_count=months[key]["transaction_count"] + 1,
+                           last_transacted_at=row["transacted_at"], last_transaction_id=row["id"])
+
+    wallet_ids = {wallet_id for wallet_id, _ in months}
+    archived_before = dict((await db.execute(
+        select(models.ArchivedMonth.wallet_id, func.sum(models.ArchivedMonth.transaction_count))
+        .filter(models.ArchivedMonth.wallet_id.in_(wallet_ids))
+        .group_by(models.ArchivedMonth.wallet_id))).all())
+
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(models.ArchivedMonth)
+    # Each wallet is archived oldest first, so an existing row already has the month's first transaction.
+    statement = statement.on_conflict_do_update(
+        index_elements=["wallet_id", "month"],
+        set_={
+            "transaction_count": models.ArchivedMonth.transaction_count + statement.excluded.transaction_count,
+            "last_transacted_at": statement.excluded.last_transacted_at,
+            "last_transaction_id": statement.excluded.last_transaction_id
+        }
+    )
+    await db.execute(statement, list(months.values()))
+
+    last_rows = {}
+    counts = defaultdict(int)
+    for row in rows:
+        last_rows[row["wallet_id"]] = row
+        counts[row["wallet_id"]] += 1
+    await db.execute(models.BalanceCheckpoint.__table__.insert(), [
+        {"wallet_id": wallet_id, "transaction_id": row["id"],
+         "transacted_at": row["transacted_at"], "balance": row["balance_after"],
+         "transaction_count": (archived_before.get(wallet_id) or 0) + counts[wallet_id]}
+        for wallet_id, row in last_rows.items()
+    ])
+    await db.execute(delete(models.Transaction).where(models.Transaction.id.in_([row["id"] for row in rows])))
+
+
+def archive_cutoff(days: int = None) -> datetime:
+    """
+    Start of the day `days` (WALLET_ARCHIVE_AFTER_DAYS) ago; transactions before it are archived
+    """
+    today = datetime.combine(date.today(), datetime.min.time())
+    return today - timedelta(days=ARCHIVE_AFTER_DAYS if days is None else days)
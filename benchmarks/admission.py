@@ -0,0 +1,107 @@
+"""
+Latency of well-behaved clients while one token floods /api/v1/wallet/deposits, with and without admission
+control, on a throwaway SQLite database.
+
+    python -m benchmarks.admission --noisy-concurrency 16 --quiet-clients 4 --seconds 3
+
+Quiet clients make one deposit at a time, each on its own wallet. The noisy client keeps --noisy-concurrency
+deposits in flight on a single wallet, retrying 10ms after a rejection whatever Retry-After says. Each mode
+reports the quiet clients' p50/p99 and how many of the noisy client's requests were served, rate limited (429)
+or shed (503).
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+import httpx
+
+from benchmarks.http_load import _auth, _create_wallet, percentile
+
+
+async def _flood(client, token, stop, outcomes):
+    while not stop.is_set():
+        response = await client.post("/api/v1/wallet/deposits", headers=_auth(token),
+                                     data={"amount": 1, "reference_id": str(uuid.uuid4())})
+        outcomes[response.status_code] = outcomes.get(response.status_code, 0) + 1
+        if response.status_code in (429, 503):
+            # Ignores Retry-After, but does not spin: client and app share this process's event loop.
+            await asyncio.sleep(0.01)
+
+
+async def _quiet(client, token, stop, latencies):
+    while not stop.is_set():
+        started = time.perf_counter()
+        response = await client.post("/api/v1/wallet/deposits", headers=_auth(token),
+                                     data={"amount": 1, "reference_id": str(uuid.uuid4())})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        await asyncio.sleep(0.01)
+
+
+async def _run(mode, args):
+    from admission import AdmissionMiddleware, RateLimiter, WriteGate
+    from main import app
+
+    if mode == "admission":
+        app = AdmissionMiddleware(app, RateLimiter(args.rate, args.burst, maxsize=100000),
+                                  WriteGate(args.max_writes, max_queue=args.max_queue, max_wait=args.max_wait))
+    async with httpx.AsyncClient(app=app, base_url="http://benchmark", timeout=60) as client:
+        noisy = await _create_wallet(client)
+        quiet = [await _create_wallet(client) for _ in range(args.quiet_clients)]
+
+        stop = asyncio.Event()
+        outcomes, latencies = {}, []
+        tasks = [asyncio.create_task(_flood(client, noisy, stop, outcomes)) for _ in range(args.noisy_concurrency)]
+        tasks += [asyncio.create_task(_quiet(client, token, stop, latencies)) for token in quiet]
+        await asyncio.sleep(args.seconds)
+        stop.set()
+        await asyncio.gather(*tasks)
+
+    latencies.sort()
+    return {
+        "mode": mode,
+        "quiet_requests": len(latencies),
+        "quiet_p50_ms": percentile(latencies, 0.50) * 1000,
+        "quiet_p99_ms": percentile(latencies, 0.99) * 1000,
+        "noisy_served": sum(count for status, count in outcomes.items() if status < 400),
+        "noisy_429": outcomes.get(429, 0),
+        "noisy_503": outcomes.get(503, 0)
+    }
+
+
+async def _compare(args):
+    # One event loop for both modes: the app's connection pools belong to the loop that opened them.
+    return [await _run(mode, args) for mode in ("unprotected", "admission")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--noisy-concurrency", type=int, default=16)
+    parser.add_argument("--quiet-clients", type=int, default=4)
+    parser.add_argument("--seconds", type=float, default=3)
+    parser.add_argument("--rate", type=float, default=20, help="requests per second per token")
+    parser.add_argument("--burst", type=float, default=40)
+    parser.add_argument("--max-writes", type=int, default=32)
+    parser.add_argument("--max-queue", type=int, default=256)
+    parser.add_argument("--max-wait", type=float, default=0.5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        # The app is wrapped here instead, so the one main.py builds from the environment stays off.
+        os.environ["WALLET_DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"
+        os.environ["WALLET_RATE_LIMIT"] = "0"
+        os.environ["WALLET_MAX_CONCURRENT_WRITES"] = "0"
+        from migrations import migrate_all
+        migrate_all()
+
+        for result in asyncio.run(_compare(args)):
+            print(f"{result['mode']:>12}: quiet p50 {result['quiet_p50_ms']:.1f}ms p99 {result['quiet_p99_ms']:.1f}ms "
+                  f"over {result['quiet_requests']} requests; noisy served {result['noisy_served']}, "
+                  f"429 {result['noisy_429']}, 503 {result['noisy_503']}")
+
+
+if __name__ == "__main__":
+    main()
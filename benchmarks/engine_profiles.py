@@ -0,0 +1,76 @@
+"""
+Runs the same concurrent read/write mix against every SQLite engine profile in database.ENGINE_PROFILES.
+
+    python -m benchmarks.engine_profiles --clients 32 --operations 50 --write-ratio 0.2
+"""
+import argparse
+import asyncio
+import os
+import random
+import tempfile
+import time
+
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import crud
+import models
+from database import Base, ENGINE_PROFILES, make_engine
+
+
+async def _run(profile, clients, operations, write_ratio, seed):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_engine(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}", profile=profile)
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        async with session_factory() as db:
+            wallets = [
+                models.Wallet(customer_xid=f"customer-{index}", token=f"token-{index}", status="enabled", balance=0)
+                for index in range(clients)
+            ]
+            db.add_all(wallets)
+            await db.commit()
+
+        rng = random.Random(seed)
+        plan = [[rng.random() < write_ratio for _ in range(operations)] for _ in wallets]
+        errors = 0
+
+        async def client(wallet, writes):
+            nonlocal errors
+            for index, is_write in enumerate(writes):
+                try:
+                    async with session_factory() as db:
+                        if is_write:
+                            await crud.add_deposit(db, wallet, 1, f"{wallet.id}-{index}")
+                        else:
+                            await crud.get_wallet(db, wallet.id)
+                except OperationalError:
+                    errors += 1
+
+        started = time.perf_counter()
+        await asyncio.gather(*[client(wallet, writes) for wallet, writes in zip(wallets, plan)])
+        elapsed = time.perf_counter() - started
+        await engine.dispose()
+
+    total = clients * operations
+    return {"profile": profile, "operations": total, "ops_per_sec": total / elapsed, "errors": errors}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--operations", type=int, default=50, help="operations per client")
+    parser.add_argument("--write-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    for profile in ENGINE_PROFILES:
+        if profile.startswith("sqlite"):
+            result = asyncio.run(_run(profile, args.clients, args.operations, args.write_ratio, args.seed))
+            print(f"{result['profile']:>15}: {result['operations']} operations, "
+                  f"{result['ops_per_sec']:.0f} ops/s, {result['errors']} lock errors")
+
+
+if __name__ == "__main__":
+    main()
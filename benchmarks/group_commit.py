@@ -0,0 +1,97 @@
+"""
+Compares direct per-request commits with the group-commit writer on a throwaway SQLite database.
+
+    python -m benchmarks.group_commit --clients 64 --writes 20
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import crud
+import models
+from database import Base, make_engine
+from writer import WriteCoalescer
+
+
+async def _seed(session_factory, clients):
+    async with session_factory() as db:
+        wallets = [
+            models.Wallet(customer_xid=f"customer-{index}", token=f"token-{index}", status="enabled", balance=0)
+            for index in range(clients)
+        ]
+        db.add_all(wallets)
+        await db.commit()
+        return wallets
+
+
+async def _run(mode, clients, writes, max_batch, max_delay):
+    with tempfile.TemporaryDirectory() as directory:
+        engine = make_engine(f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        session_factory = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+        wallets = await _seed(session_factory, clients)
+
+        commits = 0
+
+        def count_commit(conn):
+            nonlocal commits
+            commits += 1
+
+        event.listen(engine.sync_engine, "commit", count_commit)
+
+        coalescer = None
+        if mode == "group-commit":
+            coalescer = WriteCoalescer(session_factory, max_batch=max_batch, max_delay=max_delay)
+            await coalescer.start()
+
+        async def client(wallet):
+            for index in range(writes):
+                kwargs = {"wallet": wallet, "amount": 1, "reference_id": f"{wallet.id}-{index}"}
+                if coalescer is None:
+                    async with session_factory() as db:
+                        await crud.add_deposit(db, **kwargs)
+                else:
+                    await coalescer.submit(crud.add_deposit, **kwargs)
+
+        started = time.perf_counter()
+        await asyncio.gather(*[client(wallet) for wallet in wallets])
+        elapsed = time.perf_counter() - started
+
+        if coalescer is not None:
+            await coalescer.stop()
+        await engine.dispose()
+
+    total = clients * writes
+    return {
+        "mode": mode,
+        "writes": total,
+        "commits": commits,
+        "writes_per_sec": total / elapsed,
+        "commits_per_sec": commits / elapsed,
+        "writes_per_commit": total / commits if commits else 0
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent writers, one wallet each")
+    parser.add_argument("--writes", type=int, default=20, help="deposits per writer")
+    parser.add_argument("--max-batch", type=int, default=64)
+    parser.add_argument("--max-delay-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    for mode in ("direct", "group-commit"):
+        result = asyncio.run(_run(mode, args.clients, args.writes, args.max_batch, args.max_delay_ms / 1000))
+        print(f"{result['mode']:>12}: {result['writes']} writes, {result['commits']} commits, "
+              f"{result['writes_per_sec']:.0f} writes/s, {result['commits_per_sec']:.0f} commits/s, "
+              f"{result['writes_per_commit']:.1f} writes/commit")
+
+
+if __name__ == "__main__":
+    main()
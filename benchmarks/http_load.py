@@ -0,0 +1,296 @@
+"""
+HTTP load benchmark for every endpoint in main.py.
+
+Seeds N wallets with M transactions each, then drives each endpoint with a concurrent async client and
+reports throughput and p50/p95/p99 latency per endpoint. By default the app runs in-process against a
+throwaway SQLite database; pass --url to benchmark a running server instead.
+
+    python -m benchmarks.http_load --wallets 20 --transactions 1000 --concurrency 16 --requests 400 \
+        --output bench_results.json --baseline benchmarks/baseline.json
+
+Results are written as JSON. With --baseline, any endpoint whose p95 latency rises or whose throughput drops
+by more than --tolerance compared with the baseline is reported and the command exits with status 1.
+Use --update-baseline to store the new results as the baseline. The results' meta records the run settings and
+the machine; compare only against a baseline recorded with the same ones.
+
+Tail latencies vary a lot between runs on a small machine. With --runs N the benchmark runs N times, each in its
+own process, and keeps each endpoint's slowest run when updating the baseline and its fastest run otherwise.
+--runs defaults to 5 with --update-baseline, 3 with --baseline and 1 without.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime
+
+import httpx
+
+SEED_BATCH_SIZE = 5000
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def _auth(token):
+    return {"Authorization": f"Token {token}"}
+
+
+async def _create_wallet(client, enable=True):
+    response = await client.post("/api/v1/init", data={"customer_xid": str(uuid.uuid4())})
+    response.raise_for_status()
+    token = response.json()["data"]["token"]
+    if enable:
+        (await client.post("/api/v1/wallet", headers=_auth(token))).raise_for_status()
+    return token
+
+
+async def seed(client, wallets, transactions):
+    """
+    Creates enabled wallets and gives each one `transactions` deposits through the batch endpoint
+    """
+    tokens = [await _create_wallet(client) for _ in range(wallets)]
+    for token in tokens:
+        for start in range(0, transactions, SEED_BATCH_SIZE):
+            items = [
+                {"type": "deposit", "amount": 1000, "reference_id": str(uuid.uuid4())}
+                for _ in range(min(SEED_BATCH_SIZE, transactions - start))
+            ]
+            (await client.post("/api/v1/wallet/batch", json={"items": items}, headers=_auth(token))).raise_for_status()
+    return tokens
+
+
+def scenarios(tokens, fresh_tokens, enabled_fresh_tokens):
+    """
+    One request factory per endpoint. Each factory returns (method, path, keyword arguments for httpx).
+    """
+    wallets = itertools.cycle(tokens)
+    now = datetime.now().isoformat()
+
+    def money(kind):
+        def request():
+            return "POST", f"/api/v1/wallet/{kind}", {
+                "data": {"amount": 1, "reference_id": str(uuid.uuid4())}, "headers": _auth(next(wallets))}
+        return request
+
+    def batch():
+        items = [{"type": "deposit", "amount": 1, "reference_id": str(uuid.uuid4())} for _ in range(50)]
+        return "POST", "/api/v1/wallet/batch", {"json": {"items": items}, "headers": _auth(next(wallets))}
+
+    def get(path, params=None):
+        def request():
+            return "GET", path, {"params": params, "headers": _auth(next(wallets))}
+        return request
+
+    return {
+        "POST /api/v1/init": lambda: ("POST", "/api/v1/init", {"data": {"customer_xid": str(uuid.uuid4())}}),
+        "POST /api/v1/wallet": lambda: ("POST", "/api/v1/wallet", {"headers": _auth(next(fresh_tokens))}),
+        "GET /api/v1/wallet": get("/api/v1/wallet"),
+        "GET /api/v1/wallet/balance": get("/api/v1/wallet/balance", {"at": now}),
+        "GET /api/v1/wallet/summary": get("/api/v1/wallet/summary"),
+        "GET /api/v1/wallet/transactions": get("/api/v1/wallet/transactions", {"limit": 100}),
+        "GET /api/v1/wallet/transactions/export": get("/api/v1/wallet/transactions/export"),
+        "POST /api/v1/wallet/deposits": money("deposits"),
+        "POST /api/v1/wallet/withdrawals": money("withdrawals"),
+        "POST /api/v1/wallet/batch": batch,
+        "PATCH /api/v1/wallet": lambda: ("PATCH", "/api/v1/wallet", {
+            "data": {"is_disabled": "true"}, "headers": _auth(next(enabled_fresh_tokens))}),
+    }
+
+
+async def run_scenario(client, make_request, requests, concurrency):
+    latencies = []
+    errors = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors
+        for _ in remaining:
+            method, path, kwargs = make_request()
+            started = time.perf_counter()
+            response = await client.request(method, path, **kwargs)
+            await response.aread()
+            latencies.append(time.perf_counter() - started)
+            if response.status_code >= 400:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(requests / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 2)
+    }
+
+
+async def run(args):
+    if args.url:
+        client = httpx.AsyncClient(base_url=args.url, timeout=60)
+    else:
+        from main import app
+        client = httpx.AsyncClient(app=app, base_url="http://benchmark", timeout=60)
+
+    async with client:
+        tokens = await seed(client, args.wallets, args.transactions)
+        fresh_tokens = iter([await _create_wallet(client, enable=False) for _ in range(args.requests)])
+        enabled_fresh_tokens = iter([await _create_wallet(client) for _ in range(args.requests)])
+
+        results = {}
+        for endpoint, make_request in scenarios(tokens, fresh_tokens, enabled_fresh_tokens).items():
+            if args.endpoint and not any(selected in endpoint for selected in args.endpoint):
+                continue
+            results[endpoint] = await run_scenario(client, make_request, args.requests, args.concurrency)
+            print(f"{endpoint:<42} {results[endpoint]['throughput_rps']:>9.1f} req/s  "
+                  f"p50 {results[endpoint]['p50_ms']:>8.2f}ms  p95 {results[endpoint]['p95_ms']:>8.2f}ms  "
+                  f"p99 {results[endpoint]['p99_ms']:>8.2f}ms  errors {results[endpoint]['errors']}")
+
+    return {
+        "meta": {
+            "wallets": args.wallets,
+            "transactions": args.transactions,
+            "concurrency": args.concurrency,
+            "requests": args.requests,
+            "target": args.url or "in-process",
+            "rate_limit": os.environ.get("WALLET_RATE_LIMIT"),
+            "python": platform.python_version(),
+            "sqlite": sqlite3.sqlite_version,
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "runs": 1
+        },
+        "endpoints": results
+    }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a message for every endpoint that regressed beyond `tolerance` against the baseline
+    """
+    for key, expected in baseline.get("meta", {}).items():
+        if key != "runs" and results["meta"].get(key) != expected:
+            print(f"NOTE baseline was recorded with {key}={expected!r}, this run has {results['meta'].get(key)!r}")
+    regressions = []
+    for endpoint, expected in baseline["endpoints"].items():
+        actual = results["endpoints"].get(endpoint)
+        if actual is None:
+            continue
+        if actual["p95_ms"] > expected["p95_ms"] * (1 + tolerance):
+            regressions.append(f"{endpoint}: p95 {actual['p95_ms']}ms > baseline {expected['p95_ms']}ms")
+        if actual["throughput_rps"] < expected["throughput_rps"] * (1 - tolerance):
+            regressions.append(
+                f"{endpoint}: {actual['throughput_rps']} req/s < baseline {expected['throughput_rps']} req/s")
+        if actual["errors"] > expected["errors"]:
+            regressions.append(f"{endpoint}: {actual['errors']} errors > baseline {expected['errors']}")
+    return regressions
+
+
+def merge(runs, slowest):
+    """
+    One result per endpoint from several runs of the same benchmark: the slowest latencies and lowest throughput
+    any run had when `slowest`, the fastest and highest otherwise. Errors are the most any run had either way.
+    """
+    latency, throughput = (max, min) if slowest else (min, max)
+    endpoints = {}
+    for endpoint, first in runs[0]["endpoints"].items():
+        measured = [run["endpoints"][endpoint] for run in runs]
+        endpoints[endpoint] = {
+            "requests": first["requests"],
+            "errors": max(result["errors"] for result in measured),
+            "throughput_rps": throughput(result["throughput_rps"] for result in measured),
+            **{key: latency(result[key] for result in measured) for key in ("p50_ms", "p95_ms", "p99_ms")}
+        }
+    return {"meta": {**runs[0]["meta"], "runs": len(runs)}, "endpoints": endpoints}
+
+
+def repeat(args, slowest):
+    """
+    Runs the benchmark args.runs times, each in a fresh process with its own database, and merges the results
+    """
+    options = ["--wallets", str(args.wallets), "--transactions", str(args.transactions),
+               "--concurrency", str(args.concurrency), "--requests", str(args.requests)]
+    for endpoint in args.endpoint or []:
+        options += ["--endpoint", endpoint]
+    if args.url:
+        options += ["--url", args.url]
+    runs = []
+    with tempfile.TemporaryDirectory() as directory:
+        for index in range(args.runs):
+            print(f"Run {index + 1} of {args.runs}")
+            output = os.path.join(directory, f"run{index}.json")
+            subprocess.run([sys.executable, "-m", "benchmarks.http_load", *options, "--output", output], check=True)
+            with open(output) as run_file:
+                runs.append(json.load(run_file))
+    return merge(runs, slowest)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=20, help="seeded wallets")
+    parser.add_argument("--transactions", type=int, default=1000, help="seeded transactions per wallet")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent client connections")
+    parser.add_argument("--requests", type=int, default=400, help="requests per endpoint")
+    parser.add_argument("--endpoint", action="append", help="only run endpoints containing this text")
+    parser.add_argument("--url", help="benchmark a running server instead of the in-process app")
+    parser.add_argument("--output", default="bench_output.json", help="where to write the results")
+    parser.add_argument("--baseline", help="baseline JSON file to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--update-baseline", action="store_true", help="write the results to --baseline")
+    parser.add_argument("--runs", type=int, help="repeat the benchmark, see above")
+    args = parser.parse_args(argv)
+    if args.runs is None:
+        args.runs = 5 if args.baseline and args.update_baseline else 3 if args.baseline else 1
+
+    if args.runs > 1:
+        results = repeat(args, slowest=args.update_baseline)
+    else:
+        with tempfile.TemporaryDirectory() as directory:
+            if not args.url:
+                # The in-process app builds its engines at import, so point it at a throwaway database first.
+                os.environ["WALLET_DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"
+                # Measure what the app can serve, not the per-token limit; see benchmarks/admission.py for that.
+                os.environ.setdefault("WALLET_RATE_LIMIT", "0")
+                from migrations import migrate_all
+                migrate_all()
+            results = asyncio.run(run(args))
+
+    with open(args.output, "w") as output:
+        json.dump(results, output, indent=2)
+
+    if args.baseline and args.update_baseline:
+        with open(args.baseline, "w") as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+            baseline_file.write("\n")
+        print(f"Baseline written to {args.baseline}")
+    elif args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = compare(results, json.load(baseline_file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Measures what the metrics layer adds per request and per statement.
+
+    python -m benchmarks.metrics_overhead --requests 20000 --queries 20000
+
+The request figure compares a minimal ASGI app with and without MetricsMiddleware, the statement figure compares
+SELECT 1 on a synchronous in-memory SQLite engine with and without instrument_engine (the async driver's thread
+hop would bury the difference in noise). Both baselines are far cheaper than real requests and statements, so
+the absolute overhead is what matters.
+"""
+import argparse
+import asyncio
+import time
+
+from sqlalchemy import create_engine, text
+
+from metrics import MetricsMiddleware, instrument_engine
+
+
+async def _plain_app(scope, receive, send):
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+
+async def _time_requests(app, requests):
+    scope = {"type": "http", "method": "GET", "path": "/"}
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        await app(dict(scope), receive, send)
+    return (time.perf_counter() - started) / requests
+
+
+def _time_queries(instrumented, queries):
+    engine = create_engine("sqlite://")
+    if instrumented:
+        instrument_engine(engine, "benchmark")
+    statement = text("SELECT 1")
+    with engine.connect() as conn:
+        started = time.perf_counter()
+        for _ in range(queries):
+            conn.execute(statement)
+        elapsed = time.perf_counter() - started
+    engine.dispose()
+    return elapsed / queries
+
+
+async def _run(requests, queries, rounds):
+    # Best of several interleaved rounds, so warm-up and noise do not land on one side only.
+    results = [[], [], [], []]
+    for _ in range(rounds):
+        results[0].append(await _time_requests(_plain_app, requests))
+        results[1].append(await _time_requests(MetricsMiddleware(_plain_app), requests))
+        results[2].append(_time_queries(False, queries))
+        results[3].append(_time_queries(True, queries))
+    return [min(timings) for timings in results]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20000)
+    parser.add_argument("--queries", type=int, default=20000)
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    plain_request, measured_request, plain_query, measured_query = asyncio.run(
+        _run(args.requests, args.queries, args.rounds))
+    print(f"request:   {plain_request * 1e6:7.2f}us bare, {measured_request * 1e6:7.2f}us with middleware, "
+          f"+{(measured_request - plain_request) * 1e6:.2f}us per request")
+    print(f"statement: {plain_query * 1e6:7.2f}us bare, {measured_query * 1e6:7.2f}us instrumented, "
+          f"+{(measured_query - plain_query) * 1e6:.2f}us per statement")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,46 @@
+"""
+Bulk provisioning throughput: `manage.py provision` against a throwaway SQLite database.
+
+    python -m benchmarks.provisioning --wallets 1000000 --shards 1
+
+Writes --wallets customer xids to a file, times one provisioning run and then a re-run of the same file, which
+finds every customer's wallet and creates none.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchmarks.startup import ROOT
+
+
+def _provision(env, customers, output, *extra):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "manage.py", "provision", customers, "--output", output, *extra],
+                            cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+    return time.perf_counter() - started, result.stdout.strip()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--wallets", type=int, default=1000000)
+    parser.add_argument("--shards", type=int, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = {**os.environ, "WALLET_SHARDS": str(args.shards),
+               "WALLET_DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"}
+        subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, capture_output=True)
+        customers = os.path.join(directory, "customers.txt")
+        with open(customers, "w") as source:
+            source.writelines(f"customer-{index}\n" for index in range(args.wallets))
+
+        for label, output in (("first run", "mapping.csv"), ("re-run", "again.csv")):
+            seconds, summary = _provision(env, customers, os.path.join(directory, output))
+            print(f"{label:>9}: {seconds:.1f}s, {args.wallets / seconds:,.0f} customers/s ({summary})")
+
+
+if __name__ == "__main__":
+    main()
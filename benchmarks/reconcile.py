@@ -0,0 +1,94 @@
+"""
+Ledger reconciliation time: `manage.py reconcile` against a throwaway SQLite database.
+
+    python -m benchmarks.reconcile --transactions 5000000 --wallets 200000 --workers 4 --touched 1000
+
+Fills the database with --transactions transactions spread over --wallets wallets, in insert order as the app
+writes them, and times a full pass. It then adds a deposit to --touched wallets and times the incremental pass
+that follows.
+"""
+import argparse
+import json
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from benchmarks.startup import ROOT
+
+INSERT_CHUNK = 100000
+
+
+def _fill(path, transactions, wallets):
+    wallet_ids = [str(uuid.uuid4()) for _ in range(wallets)]
+    balances = dict.fromkeys(wallet_ids, 0.0)
+    counts = dict.fromkeys(wallet_ids, 0)
+    start = datetime(2024, 1, 1)
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA synchronous = OFF")
+    for first in range(0, transactions, INSERT_CHUNK):
+        rows = []
+        for index in range(first, min(first + INSERT_CHUNK, transactions)):
+            wallet_id = random.choice(wallet_ids)
+            amount = float(random.randint(1, 1000))
+            kind = "deposit" if balances[wallet_id] < amount or random.random() < 0.6 else "withdrawal"
+            balances[wallet_id] += amount if kind == "deposit" else -amount
+            counts[wallet_id] += 1
+            rows.append((f"t{index}", "success", start + timedelta(seconds=index), kind, amount, f"r{index}",
+                         wallet_id, balances[wallet_id]))
+        conn.executemany("INSERT INTO transactions (id, status, transacted_at, type, amount, reference_id, "
+                         "wallet_id, balance_after) VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+    conn.executemany("INSERT INTO wallets (id, customer_xid, status, balance, token, transaction_count, version) "
+                     "VALUES (?, ?, 'enabled', ?, ?, ?, ?)",
+                     [(wallet_id, wallet_id, balances[wallet_id], uuid.uuid4().hex, counts[wallet_id],
+                       counts[wallet_id]) for wallet_id in wallet_ids])
+    conn.commit()
+    return conn, wallet_ids
+
+
+def _reconcile(env, workers):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, "manage.py", "reconcile", "--workers", str(workers)],
+                            cwd=ROOT, env=env, check=True, capture_output=True, text=True)
+    return time.perf_counter() - started, json.loads(result.stdout)["shards"][0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=2000000)
+    parser.add_argument("--wallets", type=int, default=100000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--touched", type=int, default=1000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "bench.db")
+        env = {**os.environ, "WALLET_SHARDS": "1", "WALLET_DATABASE_URL": f"sqlite+aiosqlite:///{path}"}
+        subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, capture_output=True)
+        conn, wallet_ids = _fill(path, args.transactions, args.wallets)
+
+        seconds, shard = _reconcile(env, args.workers)
+        print(f"       full: {seconds:.1f}s, {shard['transactions_checked'] / seconds:,.0f} transactions/s over "
+              f"{shard['wallets_checked']} wallets, {shard['mismatches']} mismatches")
+
+        conn.executemany("INSERT INTO transactions (id, status, transacted_at, type, amount, reference_id, "
+                         "wallet_id) VALUES (?, 'success', ?, 'deposit', 1.0, ?, ?)",
+                         [(f"touch{index}", datetime.now(), f"touch{index}", wallet_id)
+                          for index, wallet_id in enumerate(random.sample(wallet_ids, args.touched))])
+        conn.execute("UPDATE wallets SET balance = balance + 1.0, transaction_count = transaction_count + 1 "
+                     "WHERE id IN (SELECT wallet_id FROM transactions WHERE id LIKE 'touch%')")
+        conn.commit()
+        conn.close()
+
+        seconds, shard = _reconcile(env, args.workers)
+        print(f"incremental: {seconds:.1f}s over {shard['wallets_checked']} wallets, "
+              f"{shard['mismatches']} mismatches")
+
+
+if __name__ == "__main__":
+    main()
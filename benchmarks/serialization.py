@@ -0,0 +1,70 @@
+"""
+Compares the response encoding of a transaction list before and after the orjson serializers.
+
+    python -m benchmarks.serialization --transactions 10000 --rounds 20
+
+"before" builds the dicts with datetime_conversion/format_balance and renders them with Starlette's JSONResponse,
+"after" uses serializers.transaction_list with ORJSONResponse, as the transactions endpoint does now.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+from uuid import uuid4
+
+from fastapi.responses import JSONResponse
+
+import models
+from commons import datetime_conversion, format_balance
+from serializers import ORJSONResponse, transaction_list
+
+
+def _before(transactions):
+    return JSONResponse({"status": "success", "data": {"transactions": [
+        {
+            "id": transaction.id,
+            "status": transaction.status,
+            "transacted_at": datetime_conversion(transaction.transacted_at),
+            "type": transaction.type,
+            "amount": format_balance(transaction.amount),
+            "reference_id": transaction.reference_id
+        }
+        for transaction in transactions
+    ]}}).body
+
+
+def _after(transactions):
+    return ORJSONResponse({"status": "success", "data": {"transactions": transaction_list(transactions)}}).body
+
+
+def _best_of(function, transactions, rounds):
+    timings = []
+    for _ in range(rounds):
+        started = time.perf_counter()
+        function(transactions)
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transactions", type=int, default=10000)
+    parser.add_argument("--rounds", type=int, default=20)
+    args = parser.parse_args()
+
+    start = datetime(2024, 1, 1)
+    transactions = [
+        models.Transaction(id=str(uuid4()), status="success", transacted_at=start + timedelta(seconds=index),
+                           type="deposit", amount=index * 1.5, reference_id=str(uuid4()))
+        for index in range(args.transactions)
+    ]
+    assert len(_before(transactions)) == len(_after(transactions))
+
+    before = _best_of(_before, transactions, args.rounds)
+    after = _best_of(_after, transactions, args.rounds)
+    per_row = 1e6 / args.transactions
+    print(f"{args.transactions} transactions: before {before * 1000:.2f}ms ({before * per_row:.2f}us/row), "
+          f"after {after * 1000:.2f}ms ({after * per_row:.2f}us/row), {before / after:.1f}x faster")
+
+
+if __name__ == "__main__":
+    main()
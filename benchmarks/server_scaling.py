@@ -0,0 +1,92 @@
+"""
+Throughput of server.py with 1, 2 and 4 worker processes against a throwaway SQLite database.
+
+    python -m benchmarks.server_scaling --workers 1 2 4 --concurrency 32 --requests 2000
+
+Each run starts the production launcher on a free port, drives it with the benchmarks.http_load scenarios over
+real HTTP and stops it with SIGTERM. Read endpoints should scale with the number of cores; writes stay bound by
+SQLite's single writer (see benchmarks.sharding).
+"""
+import argparse
+import asyncio
+import os
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from benchmarks import http_load
+
+DEFAULT_ENDPOINTS = ["GET /api/v1/wallet/transactions", "GET /api/v1/wallet/summary",
+                     "POST /api/v1/wallet/deposits"]
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _wait_until_ready(url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"server exited with status {process.returncode}")
+        try:
+            if httpx.get(f"{url}/openapi.json").status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"server did not answer within {timeout}s")
+
+
+def _run(workers, args):
+    with tempfile.TemporaryDirectory() as directory:
+        port = _free_port()
+        url = f"http://127.0.0.1:{port}"
+        env = {"WALLET_RATE_LIMIT": "0", **os.environ,
+               "WALLET_DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(directory, 'bench.db')}"}
+        process = subprocess.Popen(
+            [sys.executable, "server.py", "--host", "127.0.0.1", "--port", str(port), "--workers", str(workers)],
+            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            _wait_until_ready(url, process)
+            load = argparse.Namespace(wallets=args.wallets, transactions=args.transactions,
+                                      concurrency=args.concurrency, requests=args.requests,
+                                      endpoint=args.endpoint or DEFAULT_ENDPOINTS, url=url)
+            return asyncio.run(http_load.run(load))["endpoints"]
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=60)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--wallets", type=int, default=20)
+    parser.add_argument("--transactions", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000, help="requests per endpoint")
+    parser.add_argument("--endpoint", action="append", help="only run endpoints containing this text")
+    args = parser.parse_args()
+
+    results = {}
+    for workers in args.workers:
+        print(f"--- {workers} workers")
+        results[workers] = _run(workers, args)
+
+    first = args.workers[0]
+    print(f"\n{'endpoint':<42} " + " ".join(f"{workers:>5}w" for workers in args.workers))
+    for endpoint, baseline in results[first].items():
+        speedups = [results[workers][endpoint]["throughput_rps"] / baseline["throughput_rps"]
+                    for workers in args.workers]
+        print(f"{endpoint:<42} " + " ".join(f"{speedup:>5.2f}x" for speedup in speedups))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Write throughput with the wallets spread over 1, 2 and 4 throwaway SQLite shards.
+
+    python -m benchmarks.sharding --clients 32 --writes 20 --shards 1 2 4
+
+Every client deposits into its own wallet with one commit per deposit, so each shard's single writer is the
+bottleneck. Shards only help when commits can run on different cores and disks at once: on a single-core machine
+the figures stay roughly flat.
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+import uuid
+
+import crud
+import models
+from database import Base, _open_shard
+from sharding import shard_for_wallet
+
+
+async def _run(shard_count, clients, writes):
+    with tempfile.TemporaryDirectory() as directory:
+        shards = [_open_shard(index, f"sqlite+aiosqlite:///{os.path.join(directory, f'shard{index}.db')}")
+                  for index in range(shard_count)]
+        for shard in shards:
+            async with shard.engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+
+        placed = []
+        for index in range(clients):
+            wallet_id = str(uuid.uuid4())
+            shard = shards[shard_for_wallet(wallet_id, shard_count)]
+            async with shard.sessions() as db:
+                wallet = models.Wallet(id=wallet_id, customer_xid=f"customer-{index}", token=f"token-{index}",
+                                       status="enabled", balance=0)
+                db.add(wallet)
+                await db.commit()
+            placed.append((shard, wallet))
+
+        async def client(shard, wallet):
+            for index in range(writes):
+                async with shard.sessions() as db:
+                    await crud.add_deposit(db, wallet, 1, f"{wallet.id}-{index}")
+
+        started = time.perf_counter()
+        await asyncio.gather(*[client(shard, wallet) for shard, wallet in placed])
+        elapsed = time.perf_counter() - started
+
+        for shard in shards:
+            await shard.engine.dispose()
+            await shard.read_engine.dispose()
+
+    total = clients * writes
+    return {"shards": shard_count, "writes": total, "writes_per_sec": total / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--clients", type=int, default=32, help="concurrent writers, one wallet each")
+    parser.add_argument("--writes", type=int, default=20, help="deposits per writer")
+    parser.add_argument("--shards", type=int, nargs="+", default=[1, 2, 4])
+    args = parser.parse_args()
+
+    baseline = None
+    for shard_count in args.shards:
+        result = asyncio.run(_run(shard_count, args.clients, args.writes))
+        baseline = baseline or result["writes_per_sec"]
+        print(f"{result['shards']:>2} shards: {result['writes']} writes, {result['writes_per_sec']:.0f} writes/s, "
+              f"{result['writes_per_sec'] / baseline:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
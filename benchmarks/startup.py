@@ -0,0 +1,80 @@
+"""
+Cold start of the app: a fresh interpreter importing main and answering its first request.
+
+    python -m benchmarks.startup --runs 5
+
+Each run starts a new Python process against an already migrated throwaway database, imports main, runs the
+app's startup handlers and sends POST /api/v1/init in-process. The process reports how long the import took
+and when the first response arrived; the wall time also includes interpreter start-up. tests/startup_test.py
+holds the result to a budget.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs in the child process. httpx is imported before the clock starts: a server does not need it.
+COLD_START = """
+import asyncio, json, time
+import httpx
+started = time.perf_counter()
+import main
+imported = time.perf_counter()
+
+async def first_response():
+    await main.app.router.startup()
+    async with httpx.AsyncClient(app=main.app, base_url="http://startup") as client:
+        response = await client.post("/api/v1/init", data={"customer_xid": "startup"})
+    assert response.status_code == 201, response.text
+    await main.app.router.shutdown()
+
+asyncio.run(first_response())
+print(json.dumps({"import_seconds": imported - started, "first_response_seconds": time.perf_counter() - started}))
+"""
+
+
+def migrated_environment(directory: str) -> dict:
+    """
+    Environment pointing the app at a new database in `directory`, with the schema already migrated
+    """
+    env = {**os.environ, "WALLET_DATABASE_URL": f"sqlite+aiosqlite:///{os.path.join(directory, 'startup.db')}"}
+    subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True,
+                   stdout=subprocess.DEVNULL)
+    return env
+
+
+def cold_start(env: dict) -> dict:
+    """
+    One cold start in a new process: import, first response and total wall time in seconds
+    """
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-c", COLD_START], cwd=ROOT, env=env, check=True,
+                               capture_output=True, text=True)
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    result["wall_seconds"] = time.perf_counter() - started
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        env = migrated_environment(directory)
+        runs = [cold_start(env) for _ in range(args.runs)]
+
+    for field in ("import_seconds", "first_response_seconds", "wall_seconds"):
+        values = [run[field] * 1000 for run in runs]
+        print(f"{field[:-8]:>15}: median {statistics.median(values):7.1f}ms  min {min(values):7.1f}ms  "
+              f"max {max(values):7.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+import os
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class WalletIdentity(NamedTuple):
+    """
+    The part of a wallet needed to authenticate a request, cached per token
+    """
+    id: str
+    status: str
+    customer_xid: str
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire `ttl` seconds after they were stored
+    """
+
+    def __init__(self, maxsize: int, ttl: float, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None or entry[1] <= self.clock():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value):
+        self._entries[key] = (value, self.clock() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_ratio": self.hits / lookups if lookups else 0.0
+        }
+
+
+wallet_cache = TTLCache(
+    maxsize=int(os.getenv("WALLET_AUTH_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("WALLET_AUTH_CACHE_TTL", "30"))
+)
+
+# Latest known version of each wallet, so a conditional GET can be answered without a query.
+wallet_versions = TTLCache(
+    maxsize=int(os.getenv("WALLET_VERSION_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("WALLET_VERSION_CACHE_TTL", "1"))
+)
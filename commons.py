@@ -1,10 +1,16 @@
 from fastapi import HTTPException, Header
 from typing import Optional
+from datetime import datetime
+import base64
+import binascii
+
+from crud import WalletNotFound
 
 
 def check_wallet_status(wallet):
     if wallet is None:
-        raise HTTPException(status_code=404, detail="Wallet not found")
+        # Answered with 404 by sharding.StaleRouteMiddleware, once the wallet is not on its current shard either.
+        raise WalletNotFound()
 
     if wallet.status != 'enabled':
         content = {
@@ -28,3 +34,41 @@ def extract_token(authorization: Optional[str] = Header(None)) -> str:
     if not authorization or not authorization.startswith('Token '):
         raise HTTPException(status_code=400, detail="Token Header not found")
     return authorization.split(" ")[1].strip()
+
+
+def scope_token(scope) -> Optional[str]:
+    """
+    The token of an ASGI request, for middleware that runs before the handlers parse the header
+    """
+    for name, value in scope["headers"]:
+        if name == b"authorization":
+            authorization = value.decode("latin-1")
+            return extract_token(authorization) if authorization.startswith('Token ') else None
+    return None
+
+
+def encode_cursor(transaction) -> str:
+    raw = f"{transaction.transacted_at.isoformat()}|{transaction.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str):
+    try:
+        transacted_at, transaction_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+        return datetime.fromisoformat(transacted_at), transaction_id
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def wallet_etag(wallet_id: str, version: int) -> str:
+    return f'"{wallet_id}.{version}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    """
+    If-None-Match uses the weak comparison: a W/ prefix is ignored, and * matches any current representation
+    """
+    if not if_none_match:
+        return False
+    candidates = [candidate.strip() for candidate in if_none_match.split(",")]
+    return "*" in candidates or any(candidate.removeprefix("W/") == etag for candidate in candidates)
@@ -1,7 +1,17 @@
+import os
 from enum import Enum
+from sqlalchemy import delete, event, func, select, update, insert, tuple_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from datetime import datetime
+from datetime import date, datetime, timedelta
+from typing import List, NamedTuple, Optional, Tuple, Union
+from uuid import uuid4
 import models
+from cache import WalletIdentity, wallet_cache, wallet_versions
+from database import begin_write
+from writer import Discard
 
 
 class WalletStatus(Enum):
@@ -18,76 +28,714 @@ class TransactionStatus(Enum):
     SUCCESS = "success"
 
 
-def create_wallet(db: Session, customer_xid: str, token: str):
-    db_wallet = models.Wallet(customer_xid=customer_xid, token=token)
-    _commit_and_refresh(db, db_wallet)
+class WalletNotFound(LookupError):
+    """
+    Raised when the wallet is not in the database the request was routed to, e.g. because another process has
+    just moved it to another shard (see sharding.StaleRouteMiddleware)
+    """
+
+    def __init__(self):
+        super().__init__("Wallet not found")
+
+
+class WalletState(NamedTuple):
+    """
+    A wallet's identity with its current version, and whether any of its transactions have been archived
+    """
+    id: str
+    status: str
+    customer_xid: str
+    version: int
+    archived: bool
+
+
+class BalanceAt(NamedTuple):
+    """
+    A wallet's current status, read together with its balance at a point in time
+    """
+    status: str
+    balance: Optional[float]
+
+
+WalletRef = Union[models.Wallet, WalletIdentity, WalletState]
+
+# A balance checkpoint is written after every CHECKPOINT_INTERVAL-th transaction of a wallet.
+CHECKPOINT_INTERVAL = int(os.getenv("WALLET_CHECKPOINT_INTERVAL", "1000"))
+
+
+async def create_wallet(db: AsyncSession, customer_xid: str, token: str, wallet_id: Optional[str] = None):
+    db_wallet = models.Wallet(id=wallet_id, customer_xid=customer_xid, token=token)
+    db.add(db_wallet)
+    await db.commit()
     return db_wallet
 
 
-def get_wallet_by_token(db: Session, token: str):
-    return db.query(models.Wallet).filter(models.Wallet.token == token).one_or_none()
+async def get_wallet_by_token(db: AsyncSession, token: str):
+    result = await db.execute(select(models.Wallet).filter(models.Wallet.token == token))
+    return result.scalar_one_or_none()
+
+
+async def get_wallet(db: AsyncSession, wallet_id: str):
+    return await db.get(models.Wallet, wallet_id)
+
+
+async def get_wallet_identity(db: AsyncSession, token: str):
+    """
+    Resolves a token through the auth cache, only querying the id/status/customer_xid columns on a miss.
+    Only enabled wallets are cached, so a disabled wallet is read again on every request and its enabling is seen
+    at once. Status changes invalidate the entry in this process only: the conditional balance UPDATE re-checks
+    status on every write, and reads re-check it in the query that reads their data.
+    """
+    identity = wallet_cache.get(token)
+    if identity is not None:
+        return identity
+
+    row = (await db.execute(
+        select(models.Wallet.id, models.Wallet.status, models.Wallet.customer_xid)
+        .filter(models.Wallet.token == token))).one_or_none()
+    if row is None:
+        return None
+    identity = WalletIdentity(*row)
+    _cache_identity(token, identity)
+    return identity
+
+
+def cached_wallet_identity(token: str) -> Optional[WalletIdentity]:
+    return wallet_cache.get(token)
+
+
+def _cache_identity(token: str, identity: WalletIdentity):
+    if identity.status == WalletStatus.ENABLED.value:
+        wallet_cache.set(token, identity)
+    else:
+        wallet_cache.invalidate(token)
+
+
+async def get_wallet_state(db: AsyncSession, token: str) -> Optional[WalletState]:
+    """
+    Reads the wallet of `token` with its version and whether it has archived months in one query, in the
+    session's transaction, so the version describes what the session reads next. The auth cache and the
+    version map are refreshed with what it read.
+    """
+    archived = select(models.ArchivedMonth.wallet_id).filter(
+        models.ArchivedMonth.wallet_id == models.Wallet.id).exists()
+    row = (await db.execute(
+        select(models.Wallet.id, models.Wallet.status, models.Wallet.customer_xid, models.Wallet.version, archived)
+        .filter(models.Wallet.token == token))).one_or_none()
+    if row is None:
+        return None
+    state = WalletState(row[0], row[1], row[2], row[3], bool(row[4]))
+    _cache_identity(token, WalletIdentity(state.id, state.status, state.customer_xid))
+    remember_version(state.id, state.version)
+    return state
+
+
+async def get_wallet_version(db: AsyncSession, wallet_id: str) -> Optional[int]:
+    """
+    Reads the wallet's version in the session's transaction, so it describes what the session reads next,
+    and keeps the version map up to date with it.
+    """
+    version = (await db.execute(
+        select(models.Wallet.version).filter(models.Wallet.id == wallet_id))).scalar_one_or_none()
+    if version is not None:
+        remember_version(wallet_id, version)
+    return version
+
+
+def cached_wallet_version(wallet_id: str) -> Optional[int]:
+    return wallet_versions.get(wallet_id)
+
 
+def remember_version(wallet_id: str, version: int):
+    """
+    Versions only go up: a read that started before a commit must not put the older version back in the map
+    """
+    cached = wallet_versions.get(wallet_id)
+    if cached is None or cached < version:
+        wallet_versions.set(wallet_id, version)
 
-def get_enable_wallet(db: Session, wallet: models.Wallet):
+
+async def get_transactions_page(db: AsyncSession, wallet: WalletRef, limit: int,
+                                after: Optional[Tuple[datetime, str]] = None, transaction_type: Optional[str] = None,
+                                transacted_from: Optional[datetime] = None, transacted_to: Optional[datetime] = None,
+                                min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                                through: Optional[Tuple[datetime, str]] = None):
+    """
+    Returns up to `limit` transactions, newest first, strictly after the (transacted_at, id) keyset position
+    `after` and, when `through` is given, at or before that position. The keyset and transacted_at bounds are
+    served by the (wallet_id, transacted_at, id) index, so without other filters a page costs O(limit) regardless
+    of the wallet's history size. type, min_amount and max_amount are checked on each row the index walk reaches,
+    so a selective one of those may examine every row of the wallet within the time bounds to fill a page.
+    """
+    query = select(models.Transaction).filter(models.Transaction.wallet_id == wallet.id)
+    if after is not None:
+        query = query.filter(tuple_(models.Transaction.transacted_at, models.Transaction.id) < tuple_(*after))
+    if through is not None:
+        query = query.filter(tuple_(models.Transaction.transacted_at, models.Transaction.id) <= tuple_(*through))
+    if transaction_type is not None:
+        query = query.filter(models.Transaction.type == transaction_type)
+    if transacted_from is not None:
+        query = query.filter(models.Transaction.transacted_at >= transacted_from)
+    if transacted_to is not None:
+        query = query.filter(models.Transaction.transacted_at < transacted_to)
+    if min_amount is not None:
+        query = query.filter(models.Transaction.amount >= min_amount)
+    if max_amount is not None:
+        query = query.filter(models.Transaction.amount <= max_amount)
+
+    query = query.order_by(models.Transaction.transacted_at.desc(), models.Transaction.id.desc()).limit(limit)
+    result = await db.execute(query)
+    return result.scalars().all()
+
+
+async def get_balance_at(db: AsyncSession, wallet: WalletRef, at: datetime) -> Optional[BalanceAt]:
+    """
+    Balance of the wallet right after its last transaction at or before `at`, with the wallet's current status:
+    one seek on the (wallet_id, transacted_at, id) index, falling back to the latest checkpoint for history that
+    has left the transactions table. None when the wallet is not in `db`; the balance of a wallet that is not
+    enabled is not looked up any further.
+    """
+    state = await get_status_and_balance_at(db, wallet, at)
+    if state is None or state.status != WalletStatus.ENABLED.value or state.balance is not None:
+        return state
+    return state._replace(balance=await get_checkpoint_balance_at(db, wallet, at))
+
+
+async def get_status_and_balance_at(db: AsyncSession, wallet: WalletRef, at: datetime) -> Optional[BalanceAt]:
+    """
+    The wallet's current status with get_last_balance_at, in one query; None when the wallet is not in `db`
+    """
+    row = (await db.execute(
+        select(models.Wallet.status, _last_balance_query(wallet, at).scalar_subquery())
+        .filter(models.Wallet.id == wallet.id))).one_or_none()
+    return BalanceAt(*row) if row is not None else None
+
+
+async def get_last_balance_at(db: AsyncSession, wallet: WalletRef, at: datetime,
+                              through: Optional[Tuple[datetime, str]] = None) -> Optional[float]:
+    """
+    Running balance stored on the wallet's last transaction at or before `at` (and at or before the keyset
+    position `through`), or None when there is no such transaction in this table
+    """
+    return (await db.execute(_last_balance_query(wallet, at, through))).scalar_one_or_none()
+
+
+def _last_balance_query(wallet: WalletRef, at: datetime, through: Optional[Tuple[datetime, str]] = None):
+    query = select(models.Transaction.balance_after).filter(
+        models.Transaction.wallet_id == wallet.id, models.Transaction.transacted_at <= at)
+    if through is not None:
+        query = query.filter(tuple_(models.Transaction.transacted_at, models.Transaction.id) <= tuple_(*through))
+    return query.order_by(models.Transaction.transacted_at.desc(), models.Transaction.id.desc()).limit(1)
+
+
+async def get_checkpoint_balance_at(db: AsyncSession, wallet: WalletRef, at: datetime) -> float:
+    """
+    Balance from the wallet's latest checkpoint at or before `at`, 0 when there is none
+    """
+    checkpoint = (await db.execute(
+        select(models.BalanceCheckpoint.balance)
+        .filter(models.BalanceCheckpoint.wallet_id == wallet.id, models.BalanceCheckpoint.transacted_at <= at)
+        .order_by(models.BalanceCheckpoint.transacted_at.desc())
+        .limit(1))).scalar_one_or_none()
+    return checkpoint if checkpoint is not None else 0.0
+
+
+async def get_summary(db: AsyncSession, wallet: WalletRef, from_day: Optional[date] = None,
+                      to_day: Optional[date] = None):
+    """
+    Per-type totals over an inclusive day range, read from the daily rollups: the cost depends on the
+    number of days in the range, not on the number of transactions. Every row also carries the wallet's current
+    status; a wallet without rollups in the range gets a single row with no type, and a wallet that is not in
+    `db` none at all.
+    """
+    rollup = models.DailyRollup
+    joined = rollup.wallet_id == models.Wallet.id
+    if from_day is not None:
+        joined &= rollup.day >= from_day
+    if to_day is not None:
+        joined &= rollup.day <= to_day
+    query = (
+        select(models.Wallet.status, rollup.type,
+               func.sum(rollup.total_amount).label("total_amount"),
+               func.sum(rollup.transaction_count).label("transaction_count"))
+        .outerjoin(rollup, joined)
+        .filter(models.Wallet.id == wallet.id)
+        .group_by(models.Wallet.status, rollup.type)
+    )
+    return (await db.execute(query)).all()
+
+
+def rollups_from_transactions():
+    """
+    INSERT ... SELECT ... GROUP BY filling daily_rollups from the raw transactions, so the database aggregates
+    in one streaming pass over the table
+    """
+    day = func.date(models.Transaction.transacted_at)
+    return insert(models.DailyRollup).from_select(
+        ["wallet_id", "day", "type", "total_amount", "transaction_count"],
+        select(models.Transaction.wallet_id, day, models.Transaction.type,
+               func.sum(models.Transaction.amount), func.count())
+        .group_by(models.Transaction.wallet_id, day, models.Transaction.type)
+    )
+
+
+async def rebuild_rollups(db: AsyncSession, archived: List[dict] = ()) -> int:
+    """
+    Regenerates every daily rollup from the raw transactions, then adds the `archived` rollups of transactions
+    that have left the table (see archive.archived_rollups). Returns the number of rollup rows.
+    """
+    await db.execute(delete(models.DailyRollup))
+    await db.execute(rollups_from_transactions())
+    if archived:
+        await _bump_rollups(db, list(archived))
+    count = (await db.execute(select(func.count()).select_from(models.DailyRollup))).scalar_one()
+    await db.commit()
+    return count
+
+
+async def stream_transactions(db: AsyncSession, wallet: WalletRef, partition_size: int = 1000,
+                              through: Optional[Tuple[datetime, str]] = None):
+    """
+    Yields the wallet's full ledger, oldest first, in partitions of plain rows, up to and including the keyset
+    position `through` when it is given. The rows come from a server-side cursor (yield_per) and never enter
+    the identity map, so memory stays flat for any history size.
+    """
+    query = select(*models.Transaction.__table__.columns).filter(models.Transaction.wallet_id == wallet.id)
+    if through is not None:
+        query = query.filter(tuple_(models.Transaction.transacted_at, models.Transaction.id) <= tuple_(*through))
+    query = (
+        query.order_by(models.Transaction.transacted_at, models.Transaction.id)
+        .execution_options(yield_per=partition_size)
+    )
+    result = await db.stream(query)
+    async for partition in result.partitions():
+        yield partition
+
+
+async def get_enable_wallet(db: AsyncSession, wallet: models.Wallet, commit: bool = True):
     if wallet.status == "enabled":
         raise ValueError("Wallet is already enabled")
 
+    await _start(db, commit)
+    if not commit:
+        wallet = await db.merge(wallet, load=False)
     wallet.status = WalletStatus.ENABLED.value
     wallet.enabled_at = datetime.now()
-    db.commit()
-    db.refresh(wallet)
+    _invalidate_on_commit(db, wallet.token)
+    _bump_version(db, wallet)
+    await _finish(db, commit)
     return wallet
 
 
-def add_deposit(db: Session, wallet: models.Wallet, amount: float, reference_id: str) -> models.Transaction:
-    transaction = _handle_transaction(db, wallet, amount, reference_id, TransactionType.DEPOSIT)
-    wallet.balance += amount
-    db.commit()
-    db.refresh(transaction)
+async def add_deposit(db: AsyncSession, wallet: WalletRef, amount: float, reference_id: str,
+                      commit: bool = True) -> models.Transaction:
+    await _start(db, commit)
+    try:
+        transaction = await _apply_transaction(db, wallet, amount, reference_id, TransactionType.DEPOSIT, commit)
+    except (ValueError, WalletNotFound):
+        await _abort(db, commit)
+        raise
+    await _finish(db, commit)
     return transaction
 
 
-def make_withdrawal(db: Session, wallet: models.Wallet, amount: float, reference_id: str) -> models.Transaction:
-    if wallet.balance < amount:
-        raise ValueError("Insufficient balance")
-    transaction = _handle_transaction(db, wallet, amount, reference_id, TransactionType.WITHDRAWAL)
-    wallet.balance -= amount
-    db.commit()
-    db.refresh(transaction)
+async def make_withdrawal(db: AsyncSession, wallet: WalletRef, amount: float, reference_id: str,
+                          commit: bool = True) -> models.Transaction:
+    await _start(db, commit)
+    try:
+        transaction = await _apply_transaction(db, wallet, amount, reference_id, TransactionType.WITHDRAWAL, commit)
+    except (ValueError, WalletNotFound):
+        await _abort(db, commit)
+        raise
+    await _finish(db, commit)
     return transaction
 
 
-def disable_wallet(db: Session, wallet: models.Wallet):
+class BatchItemResult(NamedTuple):
+    reference_id: str
+    type: str
+    transaction: Optional[models.Transaction] = None
+    error: Optional[str] = None
+
+
+async def apply_batch(db: AsyncSession, wallet: WalletRef, items, attempts: int = 3) -> List[BatchItemResult]:
+    """
+    Applies many deposits/withdrawals (objects with type, amount and reference_id) in one DB transaction:
+    one set-based reference_id lookup, one balance read, one conditional balance UPDATE for the net change,
+    bulk INSERTs of the references and the transactions, and one commit. Items are decided in order against the
+    running balance and each gets its own result. The whole batch is retried if a concurrent writer moves the
+    balance or takes a reference_id.
+    """
+    for _ in range(attempts):
+        try:
+            results = await _apply_batch(db, wallet, items)
+        except IntegrityError:
+            await db.rollback()
+            continue
+        if results is not None:
+            return results
+    raise ValueError("Wallet is busy, retry the batch")
+
+
+async def _apply_batch(db: AsyncSession, wallet: WalletRef, items):
+    await begin_write(db)
+    wallet_id = wallet.id
+    reference_ids = [item.reference_id for item in items]
+    existing = {
+        reference.reference_id: (reference, transaction)
+        for reference, transaction in await db.execute(
+            _references_query(wallet_id).filter(models.TransactionReference.reference_id.in_(reference_ids)))
+    }
+    row = (await db.execute(
+        select(models.Wallet.balance, models.Wallet.status).filter(models.Wallet.id == wallet_id))).one_or_none()
+    if row is None:
+        await db.rollback()
+        raise WalletNotFound()
+    enabled = row.status == WalletStatus.ENABLED.value
+
+    results = []
+    rows = []
+    seen = set()
+    offset = 0.0
+    lowest_offset = 0.0
+    for item in items:
+        if item.reference_id in existing:
+            reference, original = existing[item.reference_id]
+            if (reference.type, reference.amount) == (item.type, item.amount):
+                original = original if original is not None else _recorded_transaction(reference)
+                results.append(BatchItemResult(item.reference_id, item.type, transaction=original))
+            else:
+                results.append(BatchItemResult(item.reference_id, item.type, error="Reference ID already exists"))
+            continue
+        if item.reference_id in seen:
+            results.append(BatchItemResult(item.reference_id, item.type, error="Reference ID already exists"))
+            continue
+        if not enabled:
+            results.append(BatchItemResult(item.reference_id, item.type, error="Wallet disabled"))
+            continue
+
+        if item.type == TransactionType.DEPOSIT.value:
+            offset += item.amount
+        elif row.balance + offset >= item.amount:
+            offset -= item.amount
+            lowest_offset = min(lowest_offset, offset)
+        else:
+            results.append(BatchItemResult(item.reference_id, item.type, error="Insufficient balance"))
+            continue
+
+        seen.add(item.reference_id)
+        rows.append((len(results), {
+            "id": str(uuid4()),
+            "status": TransactionStatus.SUCCESS.value,
+            "type": item.type,
+            "amount": item.amount,
+            "reference_id": item.reference_id,
+            "wallet_id": wallet_id
+        }))
+        results.append(None)
+
+    if rows:
+        moved = (await db.execute(
+            _balance_update(wallet_id, offset, required=-lowest_offset, transactions=len(rows)))).one_or_none()
+        if moved is None:
+            await db.rollback()
+            return None
+        _remember_version_on_commit(db, wallet_id, moved.version)
+
+        now = datetime.now()
+        balance = moved.balance - offset
+        transaction_count = moved.transaction_count - len(rows)
+        checkpoints = []
+        for index, (position, values) in enumerate(rows):
+            balance += values["amount"] if values["type"] == TransactionType.DEPOSIT.value else -values["amount"]
+            transaction_count += 1
+            values["transacted_at"] = now + timedelta(microseconds=index)
+            values["balance_after"] = balance
+            if transaction_count % CHECKPOINT_INTERVAL == 0:
+                checkpoints.append({
+                    "wallet_id": wallet_id,
+                    "transaction_id": values["id"],
+                    "transacted_at": values["transacted_at"],
+                    "transaction_count": transaction_count,
+                    "balance": balance
+                })
+            results[position] = BatchItemResult(values["reference_id"], values["type"],
+                                                transaction=models.Transaction(**values))
+
+        await db.execute(insert(models.TransactionReference), [_reference_values(values) for _, values in rows])
+        await db.execute(insert(models.Transaction), [values for _, values in rows])
+        if checkpoints:
+            await db.execute(insert(models.BalanceCheckpoint), checkpoints)
+        if not _rollups_by_trigger(db):
+            rollups = {}
+            for _, values in rows:
+                key = (values["transacted_at"].date(), values["type"])
+                total_amount, transaction_count = rollups.get(key, (0.0, 0))
+                rollups[key] = (total_amount + values["amount"], transaction_count + 1)
+            await _bump_rollups(db, [
+                {"wallet_id": wallet_id, "day": day, "type": transaction_type, "total_amount": total_amount,
+                 "transaction_count": transaction_count}
+                for (day, transaction_type), (total_amount, transaction_count) in rollups.items()
+            ])
+    await db.commit()
+    return results
+
+
+async def disable_wallet(db: AsyncSession, wallet: models.Wallet, commit: bool = True):
     if wallet.status == "disabled":
         raise ValueError("Wallet is already disabled")
 
+    await _start(db, commit)
+    if not commit:
+        wallet = await db.merge(wallet, load=False)
     wallet.status = WalletStatus.DISABLED.value
     wallet.disabled_at = datetime.now()
-    db.commit()
-    db.refresh(wallet)
+    _invalidate_on_commit(db, wallet.token)
+    _bump_version(db, wallet)
+    await _finish(db, commit)
     return wallet
 
 
-def _commit_and_refresh(db: Session, instance):
-    db.add(instance)
-    db.commit()
-    db.refresh(instance)
+async def _start(db: AsyncSession, commit: bool):
+    """
+    Begins the write transaction of an operation that commits itself; the group-commit writer has begun its own
+    """
+    if commit:
+        await begin_write(db)
 
 
-def _handle_transaction(db: Session, wallet: models.Wallet, amount: float, reference_id: str,
-                        transaction_type: TransactionType):
-    existing_transaction = db.query(models.Transaction).filter(
-        models.Transaction.reference_id == reference_id).one_or_none()
-    if existing_transaction:
-        raise ValueError("Reference ID already exists")
+async def _finish(db: AsyncSession, commit: bool):
+    """
+    Commits the write, or only flushes it when the caller (the group-commit writer) owns the transaction.
+    Nothing is refreshed afterwards: defaults are generated client-side and sessions keep their state on commit.
+    """
+    if not commit:
+        await db.flush()
+        return
+    await db.commit()
+
+
+async def _abort(db: AsyncSession, commit: bool):
+    if commit:
+        await db.rollback()
+
+
+def _invalidate_on_commit(db: AsyncSession, token: str):
+    db.info.setdefault("invalidated_tokens", set()).add(token)
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_cached_wallets(session):
+    for token in session.info.pop("invalidated_tokens", ()):
+        wallet_cache.invalidate(token)
+    for wallet_id, version in session.info.pop("committed_versions", {}).items():
+        remember_version(wallet_id, version)
+    for wallet_id in session.info.pop("changed_wallets", ()):
+        wallet_versions.invalidate(wallet_id)
+
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_versions(session):
+    session.info.pop("committed_versions", None)
+
+
+def _remember_version_on_commit(db: AsyncSession, wallet_id: str, version: int):
+    db.info.setdefault("committed_versions", {})[wallet_id] = version
+
+
+def _bump_version(db: AsyncSession, wallet: models.Wallet):
+    """
+    Increments the version in SQL rather than from the loaded value, so a status change racing a balance
+    update cannot give two different states the same version. The new value is only known to the database,
+    so the version map drops the wallet on commit instead of storing it.
+    """
+    wallet.version = models.Wallet.version + 1
+    db.info.setdefault("changed_wallets", set()).add(wallet.id)
+
 
-    transaction = models.Transaction(
-        status=TransactionStatus.SUCCESS.value,
-        transacted_at=datetime.now(),
-        type=transaction_type.value,
-        amount=amount,
-        reference_id=reference_id,
-        wallet_id=wallet.id
+def _insert(db: AsyncSession, entity):
+    """
+    Dialect-specific INSERT, which is what provides on_conflict_do_nothing/do_update
+    """
+    dialect = postgresql if db.get_bind().dialect.name == "postgresql" else sqlite
+    return dialect.insert(entity)
+
+
+def _balance_update(wallet_id: str, delta: float, required: float, transactions: int = 1):
+    """
+    UPDATE ... SET balance = balance + delta, only for an enabled wallet holding at least `required`.
+    Also counts the wallet's transactions, which decides when a balance checkpoint is due, and bumps its version.
+    """
+    statement = (
+        update(models.Wallet)
+        .where(models.Wallet.id == wallet_id, models.Wallet.status == WalletStatus.ENABLED.value)
+        .values(balance=models.Wallet.balance + delta,
+                transaction_count=models.Wallet.transaction_count + transactions,
+                version=models.Wallet.version + 1)
+        .returning(models.Wallet.balance, models.Wallet.transaction_count, models.Wallet.version)
+        .execution_options(synchronize_session=False)
     )
-    db.add(transaction)
+    if required > 0:
+        statement = statement.where(models.Wallet.balance >= required)
+    return statement
+
+
+async def _apply_transaction(db: AsyncSession, wallet: WalletRef, amount: float, reference_id: str,
+                             transaction_type: TransactionType, commit: bool) -> models.Transaction:
+    """
+    Moves the balance with a single conditional UPDATE ... RETURNING, so concurrent requests cannot overdraw or
+    lose updates, then records the reference_id with the resulting running balance, ON CONFLICT DO NOTHING on
+    the (wallet_id, reference_id) key of transaction_references, and inserts the transaction row. The wallet row
+    is locked from the UPDATE on, so transacted_at follows the order in which balances were applied and the
+    running balances stay consistent with (transacted_at, id) ordering.
+
+    A reference_id that the wallet already used is only looked up once the UPDATE or the reference INSERT has
+    failed. When it was used for the same type and amount the request is a retry: the balance change is undone
+    and the original result is returned, also when the original transaction has been archived since. Any other
+    reuse is rejected. Outside the group-commit writer the undo is a rollback, which expires the objects the
+    session had loaded.
+    """
+    wallet_id = wallet.id
+    delta = amount if transaction_type == TransactionType.DEPOSIT else -amount
+    moved = (await db.execute(_balance_update(wallet_id, delta, required=-delta))).one_or_none()
+    if moved is None:
+        original = await _original_transaction(db, wallet_id, amount, reference_id, transaction_type)
+        if original is not None:
+            return original
+        current_status = (await db.execute(
+            select(models.Wallet.status).filter(models.Wallet.id == wallet_id))).scalar_one_or_none()
+        if current_status is None:
+            raise WalletNotFound()
+        if current_status != WalletStatus.ENABLED.value:
+            raise ValueError("Wallet disabled")
+        raise ValueError("Insufficient balance")
+
+    values = {
+        "id": str(uuid4()),
+        "status": TransactionStatus.SUCCESS.value,
+        "transacted_at": datetime.now(),
+        "type": transaction_type.value,
+        "amount": amount,
+        "reference_id": reference_id,
+        "wallet_id": wallet_id,
+        "balance_after": moved.balance
+    }
+    recorded = (await db.execute(
+        _insert(db, models.TransactionReference)
+        .values(_reference_values(values))
+        .on_conflict_do_nothing(index_elements=[models.TransactionReference.wallet_id,
+                                                models.TransactionReference.reference_id])
+        .returning(models.TransactionReference.transaction_id))).scalar_one_or_none()
+    if recorded is None:
+        if not commit:
+            # The group-commit writer rolls the operation's savepoint back and still returns the original.
+            raise Discard(await _original_transaction(db, wallet_id, amount, reference_id, transaction_type))
+        await db.rollback()
+        return await _original_transaction(db, wallet_id, amount, reference_id, transaction_type)
+
+    transaction = (await db.execute(
+        insert(models.Transaction).values(values).returning(models.Transaction))).scalar_one()
+    _remember_version_on_commit(db, wallet_id, moved.version)
+    await _record_bookkeeping(db, wallet_id, transaction, moved.transaction_count)
     return transaction
+
+
+async def _original_transaction(db: AsyncSession, wallet_id: str, amount: float, reference_id: str,
+                                transaction_type: TransactionType) -> Optional[models.Transaction]:
+    """
+    The wallet's transaction that already used `reference_id`, None when there is none. Takes the wallet's id
+    rather than the wallet, which a rollback may just have expired.
+    """
+    row = (await db.execute(
+        _references_query(wallet_id).filter(models.TransactionReference.reference_id == reference_id))).one_or_none()
+    if row is None:
+        return None
+    reference, transaction = row
+    if (reference.type, reference.amount) != (transaction_type.value, amount):
+        raise ValueError("Reference ID already exists")
+    return transaction if transaction is not None else _recorded_transaction(reference)
+
+
+def _references_query(wallet_id: str):
+    """
+    The wallet's references with their transactions, None for transactions that have been archived. Loading a
+    transaction that is still in the hot table refreshes it in the session, which a rollback may have expired.
+    """
+    return (
+        select(models.TransactionReference, models.Transaction)
+        .outerjoin(models.Transaction, models.Transaction.id == models.TransactionReference.transaction_id)
+        .filter(models.TransactionReference.wallet_id == wallet_id)
+    )
+
+
+def _reference_values(transaction: dict) -> dict:
+    """
+    The transaction_references row recording a transaction, from the transaction's column values
+    """
+    return {
+        "wallet_id": transaction["wallet_id"],
+        "reference_id": transaction["reference_id"],
+        "transaction_id": transaction["id"],
+        "type": transaction["type"],
+        "amount": transaction["amount"],
+        "transacted_at": transaction["transacted_at"],
+        "balance_after": transaction["balance_after"]
+    }
+
+
+def _recorded_transaction(reference: models.TransactionReference) -> models.Transaction:
+    """
+    The transaction a reference records, rebuilt from the reference alone since the transaction may have been
+    archived. Transactions are only ever recorded once they succeeded.
+    """
+    return models.Transaction(id=reference.transaction_id, status=TransactionStatus.SUCCESS.value,
+                              transacted_at=reference.transacted_at, type=reference.type, amount=reference.amount,
+                              reference_id=reference.reference_id, wallet_id=reference.wallet_id,
+                              balance_after=reference.balance_after)
+
+
+async def _record_bookkeeping(db: AsyncSession, wallet_id: str, transaction: models.Transaction,
+                              transaction_count: int):
+    """
+    Adds the transaction to its daily rollup unless the database does (see _rollups_by_trigger), and writes a
+    balance checkpoint when one is due
+    """
+    if not _rollups_by_trigger(db):
+        await _bump_rollups(db, [{
+            "wallet_id": wallet_id,
+            "day": transaction.transacted_at.date(),
+            "type": transaction.type,
+            "total_amount": transaction.amount,
+            "transaction_count": 1
+        }])
+
+    if transaction_count % CHECKPOINT_INTERVAL == 0:
+        await db.execute(insert(models.BalanceCheckpoint).values(
+            wallet_id=wallet_id,
+            transaction_id=transaction.id,
+            transacted_at=transaction.transacted_at,
+            transaction_count=transaction_count,
+            balance=transaction.balance_after
+        ))
+
+
+def _rollups_by_trigger(db: AsyncSession) -> bool:
+    """
+    SQLite maintains daily rollups with the transactions_daily_rollup trigger, see models.DAILY_ROLLUP_TRIGGER
+    """
+    return db.get_bind().dialect.name == "sqlite"
+
+
+async def _bump_rollups(db: AsyncSession, rollups):
+    """
+    Adds amounts and counts to the (wallet_id, day, type) rollup rows with INSERT ... ON CONFLICT DO UPDATE
+    """
+    statement = _insert(db, models.DailyRollup.__table__)
+    statement = statement.on_conflict_do_update(
+        index_elements=["wallet_id", "day", "type"],
+        set_={
+            "total_amount": models.DailyRollup.total_amount + statement.excluded.total_amount,
+            "transaction_count": models.DailyRollup.transaction_count + statement.excluded.transaction_count
+        }
+    )
+    await db.execute(statement, rollups)
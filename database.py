@@ -1,12 +1,353 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from sqlalchemy.ext.declarative import declarative_base
+import asyncio
+import os
+import weakref
+from typing import NamedTuple
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./mini_wallet.db"
+from sqlalchemy import create_engine, event, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
+from sqlalchemy.orm import Session, declarative_base
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+
+from cache import TTLCache
+
+SQLALCHEMY_DATABASE_URL = os.getenv("WALLET_DATABASE_URL", "sqlite+aiosqlite:///./mini_wallet.db")
+READ_YOUR_WRITES_SECONDS = float(os.getenv("WALLET_READ_YOUR_WRITES_SECONDS", "2"))
+SHARD_COUNT = int(os.getenv("WALLET_SHARDS", "1"))
+
+# Named engine profiles. "pragmas" are applied to every new SQLite connection, "engine" is passed to
+# create_async_engine. Numbers can be overridden per deployment, see _profile_from_env.
+ENGINE_PROFILES = {
+    # Driver defaults: rollback journal, full sync, no busy timeout, a new connection per session.
+    "sqlite-default": {
+        "pragmas": {},
+        "engine": {}
+    },
+    # WAL lets readers run alongside the single writer; synchronous=NORMAL only fsyncs at checkpoints.
+    "sqlite-wal": {
+        "pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "busy_timeout": 5000,
+            "mmap_size": 268435456,
+            "cache_size": -65536,
+            "temp_store": "MEMORY"
+        },
+        "engine": {
+            # The aiosqlite dialect defaults to NullPool; keeping connections means the pragmas are paid once.
+            "poolclass": AsyncAdaptedQueuePool,
+            "pool_size": 5,
+            "max_overflow": 10
+        }
+    },
+    # Client/server databases (e.g. postgresql+asyncpg://...).
+    "server": {
+        "pragmas": {},
+        "engine": {
+            "pool_size": 10,
+            "max_overflow": 20,
+            "pool_pre_ping": True,
+            "pool_recycle": 1800
+        }
+    }
+}
+
+PRAGMA_OVERRIDES = {
+    "synchronous": "WALLET_SQLITE_SYNCHRONOUS",
+    "busy_timeout": "WALLET_SQLITE_BUSY_TIMEOUT",
+    "mmap_size": "WALLET_SQLITE_MMAP_SIZE",
+    "cache_size": "WALLET_SQLITE_CACHE_SIZE"
+}
+
+ENGINE_OVERRIDES = {
+    "pool_size": ("WALLET_DB_POOL_SIZE", int),
+    "max_overflow": ("WALLET_DB_MAX_OVERFLOW", int),
+    "pool_recycle": ("WALLET_DB_POOL_RECYCLE", int),
+    "pool_pre_ping": ("WALLET_DB_POOL_PRE_PING", lambda value: value.lower() in ("1", "true", "yes"))
+}
+
+
+def default_profile_name(url: str) -> str:
+    return "sqlite-wal" if url.startswith("sqlite") else "server"
+
+
+def _profile_from_env(name: str):
+    if name not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown engine profile {name!r}, expected one of {sorted(ENGINE_PROFILES)}")
+    pragmas = dict(ENGINE_PROFILES[name]["pragmas"])
+    for pragma, variable in PRAGMA_OVERRIDES.items():
+        if pragma in pragmas and variable in os.environ:
+            pragmas[pragma] = os.environ[variable]
+    options = dict(ENGINE_PROFILES[name]["engine"])
+    for option, (variable, convert) in ENGINE_OVERRIDES.items():
+        if option in options and variable in os.environ:
+            options[option] = convert(os.environ[variable])
+    return pragmas, options
+
+
+def make_engine(url: str, profile: str = None, read_only: bool = False):
+    """
+    Create the async engine for `url` with a named profile (WALLET_DB_PROFILE, defaulting to sqlite-wal for
+    SQLite URLs and server otherwise). For SQLite the driver's own transaction handling is turned off and
+    BEGIN is emitted explicitly, which is what makes SAVEPOINTs (used by the group-commit writer) work.
+    Transactions begin deferred, so request sessions only take the write lock when they write; writes that
+    read first begin with BEGIN IMMEDIATE through begin_write, which queues them for the write lock.
+    """
+    pragmas, options = _profile_from_env(
+        profile or os.getenv("WALLET_DB_PROFILE") or default_profile_name(str(url)))
+    if read_only:
+        # The journal mode is a property of the database file, only the primary may change it.
+        pragmas.pop("journal_mode", None)
+    async_engine = create_async_engine(url, **options)
+    if async_engine.dialect.name == "sqlite":
+        event.listen(async_engine.sync_engine, "connect", _disable_driver_transactions)
+        event.listen(async_engine.sync_engine, "begin", _begin_read if read_only else _begin)
+        if pragmas:
+            event.listen(async_engine.sync_engine, "connect", _pragma_setter(pragmas))
+        busy_timeout = int(pragmas.get("busy_timeout", 0))
+        if busy_timeout > 0 and not read_only:
+            _write_queues[async_engine.sync_engine] = _WriteQueue(busy_timeout / 1000)
+    return async_engine
+
+
+def _disable_driver_transactions(dbapi_connection, connection_record):
+    dbapi_connection.isolation_level = None
+
+
+def _begin_read(conn):
+    conn.exec_driver_sql("BEGIN")
+
+
+def _begin(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE" if conn.get_execution_options().get(BEGIN_IMMEDIATE) else "BEGIN")
+
+
+def _begin_write(conn):
+    conn.exec_driver_sql("BEGIN IMMEDIATE")
+
+
+# Execution option making a SQLite connection begin its transaction with BEGIN IMMEDIATE, see begin_write.
+BEGIN_IMMEDIATE = "sqlite_begin_immediate"
+
+
+class _WriteQueue:
+    """
+    The turns of this process's writers at the write lock of one SQLite database, see begin_write
+    """
+
+    def __init__(self, timeout: float):
+        self.timeout = timeout
+        self._loop = None
+        self._lock = None
+
+    def lock(self) -> asyncio.Lock:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            # An asyncio lock belongs to one event loop, and tests and commands run several in turn.
+            self._loop, self._lock = loop, asyncio.Lock()
+        return self._lock
+
+
+_write_queues = weakref.WeakKeyDictionary()
+
+
+async def _wait_for_turn(lock: asyncio.Lock, timeout: float) -> bool:
+    """
+    Waits up to `timeout` seconds to acquire `lock`. Returns whether it is held; a cancelled wait never leaves it
+    held.
+    """
+    acquiring = asyncio.ensure_future(lock.acquire())
+    try:
+        done, _ = await asyncio.wait([acquiring], timeout=timeout)
+    except BaseException:
+        acquiring.add_done_callback(lambda task: task.cancelled() or lock.release())
+        acquiring.cancel()
+        raise
+    if not done:
+        acquiring.cancel()
+    return bool(done)
+
+
+async def begin_write(db: AsyncSession):
+    """
+    Begins the session's transaction as a write transaction: BEGIN IMMEDIATE on SQLite, which takes the write
+    lock up front, waiting for it on busy_timeout. A deferred transaction that reads and then writes fails with
+    "database is locked" straight away, without waiting, when another writer committed in between. A read
+    transaction the session is already in, such as the token lookup of a request, is committed first; writes
+    re-check what they depend on in their conditional UPDATEs.
+
+    The writers of one process queue for their turn first and hold it until their transaction ends. SQLite's
+    busy handler polls with growing sleeps and lets whoever polls first in, so under many concurrent writers
+    some waited past busy_timeout and failed. A writer whose turn does not come within busy_timeout goes on to
+    BEGIN IMMEDIATE anyway and waits there, like a writer in another process.
+    """
+    if db.in_transaction():
+        await db.commit()
+    engine = db.sync_session.bind
+    queue = _write_queues.get(engine) if engine is not None else None
+    if queue is not None:
+        lock = queue.lock()
+        if await _wait_for_turn(lock, queue.timeout):
+            db.info[WRITE_TURN] = lock
+    await db.connection(execution_options={BEGIN_IMMEDIATE: True})
+
+
+# Session.info key of the write turn a session holds, see begin_write.
+WRITE_TURN = "write_turn"
+
+
+@event.listens_for(Session, "after_transaction_end")
+def _end_write_turn(session, transaction):
+    if transaction.parent is None and WRITE_TURN in session.info:
+        session.info.pop(WRITE_TURN).release()
+
+
+def _pragma_setter(pragmas):
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in pragmas.items():
+            cursor.execute(f"PRAGMA {pragma}={value}")
+        cursor.close()
+
+    return set_pragmas
+
+
+def read_only_url(url: str):
+    """
+    The same SQLite file opened with mode=ro, so reads use their own connections and can never write.
+    Returns None for other databases, whose reads go to the primary unless WALLET_READ_DATABASE_URL is set.
+    """
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or parsed.database in (None, "", ":memory:"):
+        return None
+    return parsed.set(database=f"file:{parsed.database}", query={"mode": "ro", "uri": "true"})
+
+
+def shard_url(url: str, index: int) -> str:
+    """
+    URL of shard `index`. Shard 0 is the configured database itself, so a single-shard deployment keeps using
+    its file; the other SQLite shards sit next to it (mini_wallet.db, mini_wallet.shard1.db, ...).
+    """
+    if index == 0:
+        return url
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or parsed.database in (None, "", ":memory:"):
+        raise ValueError("Set WALLET_SHARD_URLS to shard a database that is not a SQLite file")
+    stem, extension = os.path.splitext(parsed.database)
+    return parsed.set(database=f"{stem}.shard{index}{extension}").render_as_string(hide_password=False)
+
+
+class Shard(NamedTuple):
+    index: int
+    engine: object
+    read_engine: object
+    sessions: async_sessionmaker
+    read_sessions: async_sessionmaker
+
+
+def _open_shard(index: int, url: str, read_url: str = None) -> Shard:
+    primary = make_engine(url)
+    read_url = read_url or read_only_url(url)
+    reader = make_engine(read_url, read_only=True) if read_url else primary
+    return Shard(
+        index,
+        primary,
+        reader,
+        async_sessionmaker(bind=primary, autoflush=False, expire_on_commit=False, info={"shard": index}),
+        async_sessionmaker(bind=reader, autoflush=False, expire_on_commit=False, info={"shard": index})
+    )
+
+
+class ShardSet:
+    """
+    The shards of the deployment, indexed like a list. A shard's engines are created the first time it is used,
+    so importing the app does not build connection pools for shards a process never touches. Callbacks passed
+    to on_open run once for every shard as it is opened, e.g. to instrument its engines.
+    """
+
+    def __init__(self, urls, read_url: str = None):
+        self.urls = urls
+        self.read_url = read_url
+        self._opened = {}
+        self._listeners = []
+
+    def __len__(self) -> int:
+        return len(self.urls)
+
+    def __getitem__(self, index: int) -> Shard:
+        shard = self._opened.get(index)
+        if shard is None:
+            shard = self._opened[index] = _open_shard(
+                index, self.urls[index], self.read_url if index == 0 else None)
+            for listener in self._listeners:
+                listener(shard)
+        return shard
+
+    def __iter__(self):
+        return (self[index] for index in range(len(self)))
+
+    def opened(self):
+        return [self._opened[index] for index in sorted(self._opened)]
+
+    def on_open(self, listener):
+        self._listeners.append(listener)
+        for shard in self.opened():
+            listener(shard)
+
+
+SHARD_URLS = [url.strip() for url in os.getenv("WALLET_SHARD_URLS", "").split(",") if url.strip()] or [
+    shard_url(SQLALCHEMY_DATABASE_URL, index) for index in range(SHARD_COUNT)]
+READ_DATABASE_URL = os.getenv("WALLET_READ_DATABASE_URL") or read_only_url(SHARD_URLS[0])
+shards = ShardSet(SHARD_URLS, READ_DATABASE_URL)
+
+# Shard 0 is the whole database when there is a single shard.
+_SHARD_0_ATTRIBUTES = {"engine": "engine", "SessionLocal": "sessions", "read_engine": "read_engine",
+                       "ReadSessionLocal": "read_sessions"}
+
+
+def __getattr__(name):
+    if name in _SHARD_0_ATTRIBUTES:
+        return getattr(shards[0], _SHARD_0_ATTRIBUTES[name])
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+# Tokens that wrote within the last READ_YOUR_WRITES_SECONDS; their reads stay on the primary.
+recent_writers = TTLCache(maxsize=100000, ttl=READ_YOUR_WRITES_SECONDS)
+
+
+def pin_to_primary(token: str):
+    if READ_YOUR_WRITES_SECONDS > 0:
+        recent_writers.set(token, True)
+
+
+def is_pinned_to_primary(token: str) -> bool:
+    return recent_writers.get(token) is not None
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
 Base = declarative_base()
+
+
+def schema_engine(url: str):
+    """
+    Short-lived synchronous engine for schema changes, usable before any event loop exists. SQLite connections
+    always begin with BEGIN IMMEDIATE, so DDL and backfills run in one transaction.
+    """
+    parsed = make_url(url)
+    sync_engine = create_engine(parsed.set(drivername=parsed.get_backend_name()))
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _disable_driver_transactions)
+        event.listen(sync_engine, "begin", _begin_write)
+    return sync_engine
+
+
+def batch_read_engine(url: str):
+    """
+    Synchronous, read-only engine for batch jobs that run outside the event loop, e.g. in worker processes.
+    SQLite connections open the file with mode=ro and begin with a plain BEGIN, so every transaction reads one
+    snapshot of the database.
+    """
+    parsed = make_url(read_only_url(url) or url)
+    sync_engine = create_engine(parsed.set(drivername=parsed.get_backend_name()))
+    if sync_engine.dialect.name == "sqlite":
+        event.listen(sync_engine, "connect", _disable_driver_transactions)
+        event.listen(sync_engine, "begin", _begin_read)
+    return sync_engine
@@ -1,39 +1,205 @@
-from fastapi import FastAPI, Depends, HTTPException, status, Form, Header
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, status, Header, Query, Request
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import Optional
-import secrets
+from datetime import date, datetime
+from uuid import uuid4
+import csv
+import io
+import os
+
+from admission import AdmissionMiddleware, rate_limiter_from_env, write_gate_from_env
+from archive import get_transactions_page, get_balance_at, stream_transactions
+from crud import create_wallet, get_wallet_by_token, get_wallet, get_wallet_identity, get_summary, add_deposit, \
+    make_withdrawal, apply_batch, disable_wallet, get_enable_wallet, get_wallet_state, cached_wallet_identity, \
+    cached_wallet_version, remember_version, WalletNotFound
+from database import shards, pin_to_primary, is_pinned_to_primary, recent_writers
+from cache import wallet_cache, wallet_versions
+from fastapi.responses import Response, StreamingResponse, PlainTextResponse
+from metrics import MetricsMiddleware, Gauge, registry, instrument_engine, pool_gauges, cache_gauges, \
+    admission_gauges
+from migrations import LATEST_VERSION, outdated_shards
+from schemas import BatchRequest, InitRequest, DepositRequest, DisableWalletRequest
+from serializers import ORJSONResponse, request_body, request_body_openapi, negotiated_response, wallet_body, \
+    deposit_body, withdrawal_body, transaction_list, ndjson_rows
+from sharding import StaleRouteMiddleware, shard_for_wallet, mint_token, resolve_shard, shard_routes
+from writer import coalescer_from_env
+from commons import check_wallet_status, format_balance, datetime_conversion, extract_token, encode_cursor, \
+    decode_cursor, wallet_etag, etag_matches
+
+app = FastAPI(default_response_class=ORJSONResponse)
+# One group-commit writer per shard, each shard being its own single-writer database. A writer opens sessions
+# through shards[index] when it first writes, so the shard's engines are still only created on first use.
+write_coalescers = [coalescer_from_env(lambda index=index: shards[index].sessions()) for index in range(len(shards))]
+group_commit = [(str(index), coalescer) for index, coalescer in enumerate(write_coalescers) if coalescer]
+
+# Innermost, so a request it runs again is neither counted nor admitted twice.
+app.add_middleware(StaleRouteMiddleware)
+
+# Added before the metrics middleware, so it runs inside it and the requests it turns away are still counted.
+rate_limiter = rate_limiter_from_env()
+write_gate = write_gate_from_env()
+if rate_limiter is not None or write_gate is not None:
+    app.add_middleware(AdmissionMiddleware, limiter=rate_limiter, gate=write_gate)
+
+METRICS_ENABLED = os.getenv("WALLET_METRICS", "1") == "1"
+if METRICS_ENABLED:
+    app.add_middleware(MetricsMiddleware)
+    # Filled in as shards are opened; the pool gauges read it at scrape time.
+    engines = {}
+
+    def instrument_shard(shard):
+        name = "primary" if len(shards) == 1 else f"shard{shard.index}"
+        opened = {name: shard.engine}
+        if shard.read_engine is not shard.engine:
+            opened["read" if len(shards) == 1 else f"{name}-read"] = shard.read_engine
+        for label, instrumented in opened.items():
+            instrument_engine(instrumented, label)
+        engines.update(opened)
+
+    shards.on_open(instrument_shard)
+    caches = {"wallet_identity": wallet_cache, "wallet_versions": wallet_versions,
+              "recent_writers": recent_writers, "shard_routes": shard_routes}
+    for gauge in pool_gauges(engines) + cache_gauges(caches) + admission_gauges(rate_limiter, write_gate):
+        registry.register(gauge)
+    if group_commit:
+        def coalescer_values(field):
+            return lambda: [((index,), getattr(coalescer, field)) for index, coalescer in group_commit]
+
+        registry.register(Gauge("wallet_group_commit_queue_depth", "Writes waiting for the group-commit writer",
+                                ("shard",), coalescer_values("queue_depth")))
+        registry.register(Gauge("wallet_group_commit_writes", "Writes committed by the group-commit writer",
+                                ("shard",), coalescer_values("writes")))
+        registry.register(Gauge("wallet_group_commit_commits", "Commits issued by the group-commit writer",
+                                ("shard",), coalescer_values("commits")))
+
+
+@app.on_event("startup")
+async def check_schema_version():
+    """
+    Refuse to start against a database that `python manage.py migrate` has not brought up to date
+    """
+    outdated = await outdated_shards()
+    if outdated:
+        behind = ", ".join(f"shard {index} is at version {max(version, 0)}" for index, version in outdated)
+        raise RuntimeError(f"Database schema is behind version {LATEST_VERSION} ({behind}), "
+                           f"run python manage.py migrate")
 
-from crud import create_wallet, get_wallet_by_token, add_deposit, make_withdrawal, disable_wallet, get_enable_wallet
-from database import SessionLocal, engine, Base
-from fastapi.responses import JSONResponse
-from commons import check_wallet_status, format_balance, datetime_conversion, extract_token
 
-Base.metadata.create_all(bind=engine)
+@app.on_event("startup")
+async def start_write_coalescer():
+    for _, coalescer in group_commit:
+        await coalescer.start()
 
-app = FastAPI()
 
+@app.on_event("shutdown")
+async def stop_write_coalescer():
+    for _, coalescer in group_commit:
+        await coalescer.stop()
 
-def get_db():
-    db = SessionLocal()
-    try:
+
+async def get_db(authorization: Optional[str] = Header(None)):
+    """
+    Session on the primary of the caller's shard, for handlers that write. The caller's token is pinned to the
+    primary afterwards, so its reads see its own writes during the read-your-writes window.
+    """
+    token = extract_token(authorization) if authorization and authorization.startswith('Token ') else None
+    shard = await resolve_shard(token) if token else 0
+    async with shards[shard].sessions() as db:
+        yield db
+    if token:
+        pin_to_primary(token)
+
+
+async def get_read_db(authorization: Optional[str] = Header(None)):
+    """
+    Session on the read-only pool of the caller's shard (a mode=ro SQLite connection or a replica), unless the
+    caller is pinned to the primary
+    """
+    token = extract_token(authorization) if authorization and authorization.startswith('Token ') else None
+    shard = shards[await resolve_shard(token) if token else 0]
+    async with (shard.sessions if token and is_pinned_to_primary(token) else shard.read_sessions)() as db:
+        yield db
+
+
+async def get_new_wallet_db():
+    """
+    Session on the shard a new wallet is placed on; the wallet id that placed it there is in db.info["wallet_id"]
+    """
+    wallet_id = str(uuid4())
+    async with shards[shard_for_wallet(wallet_id)].sessions() as db:
+        db.info["wallet_id"] = wallet_id
         yield db
-    finally:
-        db.close()
 
 
-@app.post("/api/v1/init", status_code=status.HTTP_201_CREATED)
-async def initialize_account(customer_xid: str = Form(None), db: Session = Depends(get_db)):
+async def run_write(db: AsyncSession, operation, **kwargs):
+    """
+    Run a crud write on the request's session, or queue it on the shard's group-commit writer when enabled.
+    The writer works in a session of its own, so the request session's read transaction (the token lookup) is
+    ended first: the request holds no snapshot, and no connection, while its write waits in the queue.
+    """
+    write_coalescer = write_coalescers[db.info.get("shard", 0)]
+    if write_coalescer is None:
+        return await operation(db=db, **kwargs)
+    await db.commit()
+    return await write_coalescer.submit(operation, **kwargs)
+
+
+# Responses are per token and change with every write: clients may keep them but must revalidate with the ETag.
+REVALIDATE = "private, no-cache"
+
+
+def versioned(response, etag: str):
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = REVALIDATE
+    return response
+
+
+def cached_version_matching(wallet_id: str, if_none_match: Optional[str]) -> Optional[int]:
+    """
+    The wallet's version from the version map when it shows the client's copy is current, so that a 304 needs
+    no query; None when the map has no entry or the copy is outdated. A status change bumps the version and
+    drops the wallet from the map on commit, so a disabled wallet is never answered from it by the worker that
+    disabled it; other workers may do so until their entry expires, WALLET_VERSION_CACHE_TTL seconds at most.
+    """
+    version = cached_wallet_version(wallet_id) if if_none_match else None
+    if version is not None and etag_matches(if_none_match, wallet_etag(wallet_id, version)):
+        return version
+    return None
+
+
+def not_modified(wallet_id: str, version: int) -> Response:
+    return versioned(Response(status_code=status.HTTP_304_NOT_MODIFIED), wallet_etag(wallet_id, version))
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    """
+    Prometheus text exposition of the request, database, pool and cache metrics.
+
+    Returns:
+        PlainTextResponse: The metrics in Prometheus text format 0.0.4.
+    """
+    if not METRICS_ENABLED:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/api/v1/init", status_code=status.HTTP_201_CREATED, openapi_extra=request_body_openapi(InitRequest))
+async def initialize_account(request: Request, body: InitRequest = Depends(request_body(InitRequest)),
+                             db: AsyncSession = Depends(get_new_wallet_db)):
     """
     Initialize an account for a given customer.
 
     Args:
-        db (Session): Database session instance.
-        customer_xid (str): customer_xid for a single customer
+        request (Request): The incoming request, used to pick the response format.
+        body (InitRequest): customer_xid for a single customer, as form fields, JSON or MessagePack.
+        db (AsyncSession): Session on the shard the new wallet is placed on.
 
     Returns:
-        JSONResponse: A response indicating success or failure of account initialization.
+        Response: A response indicating success or failure of account initialization, in JSON or MessagePack.
     """
 
+    customer_xid = body.customer_xid
     if customer_xid is None:
         content = {
             "data": {
@@ -47,8 +213,9 @@ async def initialize_account(customer_xid: str = Form(None), db: Session = Depen
         }
         raise HTTPException(status_code=400, detail=content)
 
-    token = secrets.token_hex(20)
-    wallet = create_wallet(db=db, customer_xid=customer_xid, token=token)
+    token = mint_token(db.info.get("shard", 0))
+    wallet = await create_wallet(db=db, customer_xid=customer_xid, token=token, wallet_id=db.info.get("wallet_id"))
+    pin_to_primary(token)
 
     content = {
         "data": {
@@ -58,27 +225,27 @@ async def initialize_account(customer_xid: str = Form(None), db: Session = Depen
         "status": "success"
     }
 
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=content)
+    return negotiated_response(request, content, status.HTTP_201_CREATED)
 
 
 @app.post("/api/v1/wallet", status_code=status.HTTP_201_CREATED)
-async def enable_wallet(db: Session = Depends(get_db), authorization: Optional[str] = Header(None)):
+async def enable_wallet(db: AsyncSession = Depends(get_db), authorization: Optional[str] = Header(None)):
     """
     Enable a wallet for a given customer using their token.
 
     Args:
-        db (Session): Database session instance.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response indicating success or failure of enabling the wallet.
+        ORJSONResponse: A response indicating success or failure of enabling the wallet.
     """
 
     token = extract_token(authorization)
     try:
-        wallet = get_wallet_by_token(db=db, token=token)
+        wallet = await get_wallet_by_token(db=db, token=token)
         if wallet is None:
-            raise HTTPException(status_code=404, detail="Wallet not found")
+            raise WalletNotFound()
 
         if wallet.status == 'enabled':
             content = {
@@ -89,7 +256,7 @@ async def enable_wallet(db: Session = Depends(get_db), authorization: Optional[s
             }
             raise HTTPException(status_code=400, detail=content)
 
-        wallet = get_enable_wallet(db=db, wallet=wallet)
+        wallet = await run_write(db, get_enable_wallet, wallet=wallet)
 
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -97,120 +264,295 @@ async def enable_wallet(db: Session = Depends(get_db), authorization: Optional[s
     content = {
         "status": "success",
         "data": {
-            "wallet": {
-                "id": wallet.id,
-                "owned_by": wallet.customer_xid,
-                "status": wallet.status,
-                "enabled_at": datetime_conversion(wallet.enabled_at),
-                "balance": format_balance(wallet.balance)
-            }
+            "wallet": wallet_body(wallet)
         }
     }
 
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=content)
+    return ORJSONResponse(status_code=status.HTTP_201_CREATED, content=content)
 
 
 @app.get("/api/v1/wallet", status_code=status.HTTP_200_OK)
-async def get_wallet_balance(db: Session = Depends(get_db), authorization: Optional[str] = Header(None)):
+async def get_wallet_balance(db: AsyncSession = Depends(get_read_db), authorization: Optional[str] = Header(None),
+                             if_none_match: Optional[str] = Header(None)):
+    """
+    Get the balance of a wallet for a given customer using their token. The response carries an ETag of the
+    wallet's version; a request whose If-None-Match still matches it gets 304 Not Modified.
+
+    Args:
+        db (AsyncSession): Database session instance.
+        authorization (str): Authorization header containing customer's token.
+        if_none_match (str): ETag of the copy the client already holds, if any.
+
+    Returns:
+        ORJSONResponse: A response containing the wallet's balance, or an empty 304 response.
+    """
+
+    token = extract_token(authorization)
+    identity = await get_wallet_identity(db=db, token=token)
+    check_wallet_status(identity)
+    cached_version = cached_version_matching(identity.id, if_none_match)
+    if cached_version is not None:
+        return not_modified(identity.id, cached_version)
+
+    # The cached identity may be up to WALLET_AUTH_CACHE_TTL seconds old when another worker changed the status.
+    wallet = await get_wallet(db=db, wallet_id=identity.id)
+    check_wallet_status(wallet)
+    remember_version(wallet.id, wallet.version)
+    etag = wallet_etag(wallet.id, wallet.version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(wallet.id, wallet.version)
+
+    content = {
+        "status": "success",
+        "data": {
+            "wallet": wallet_body(wallet)
+        }
+    }
+
+    return versioned(ORJSONResponse(status_code=status.HTTP_200_OK, content=content), etag)
+
+
+@app.get("/api/v1/wallet/balance", status_code=status.HTTP_200_OK)
+async def get_wallet_balance_at(at: datetime, db: AsyncSession = Depends(get_read_db),
+                                authorization: Optional[str] = Header(None)):
     """
-    Get the balance of a wallet for a given customer using their token.
+    Get the balance a wallet had at a point in time, using the running balance stored on its transactions,
+    archived ones included.
 
     Args:
-        db (Session): Database session instance.
+        at (datetime): Point in time to get the balance for.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response containing the wallet's balance.
+        ORJSONResponse: A response containing the wallet's balance as of `at`.
     """
 
     token = extract_token(authorization)
-    wallet = get_wallet_by_token(db=db, token=token)
+    wallet = await get_wallet_identity(db=db, token=token)
     check_wallet_status(wallet)
 
+    # The cached identity may be up to WALLET_AUTH_CACHE_TTL seconds old when another worker changed the status,
+    # so the status is read again together with the balance.
+    balance = await get_balance_at(db=db, wallet=wallet, at=at)
+    check_wallet_status(balance)
+
     content = {
         "status": "success",
         "data": {
-            "wallet": {
+            "balance": {
                 "id": wallet.id,
-                "owned_by": wallet.customer_xid,
-                "status": wallet.status,
-                "enabled_at": datetime_conversion(wallet.enabled_at),
-                "balance": format_balance(wallet.balance)
+                "at": datetime_conversion(at),
+                "balance": format_balance(balance.balance)
             }
         }
     }
 
-    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content=content)
 
 
-@app.get("/api/v1/wallet/transactions", status_code=status.HTTP_200_OK)
-async def get_wallet_transactions(db: Session = Depends(get_db), authorization: Optional[str] = Header(None)):
+@app.get("/api/v1/wallet/summary", status_code=status.HTTP_200_OK)
+async def get_wallet_summary(from_day: Optional[date] = None, to_day: Optional[date] = None,
+                             db: AsyncSession = Depends(get_read_db), authorization: Optional[str] = Header(None)):
     """
-    Get the transactions of a wallet for a given customer using their token.
+    Get deposit and withdrawal totals of a wallet over a range of days, served from the daily rollups.
 
     Args:
-        db (Session): Database session instance.
+        from_day (date): First day of the range, inclusive; omit it to start at the first transaction.
+        to_day (date): Last day of the range, inclusive; omit it to end at the latest transaction.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response containing the wallet's transactions.
+        ORJSONResponse: A response containing the amount and count totals per transaction type.
     """
 
     token = extract_token(authorization)
-    wallet = get_wallet_by_token(db=db, token=token)
+    wallet = await get_wallet_identity(db=db, token=token)
     check_wallet_status(wallet)
 
-    transactions = wallet.transactions
+    # As for the balance, the status is read again together with the totals.
+    rows = await get_summary(db=db, wallet=wallet, from_day=from_day, to_day=to_day)
+    check_wallet_status(rows[0] if rows else None)
+
+    totals = {
+        transaction_type: {"amount": 0, "count": 0}
+        for transaction_type in ("deposit", "withdrawal")
+    }
+    for row in rows:
+        if row.type is not None:
+            totals[row.type] = {"amount": format_balance(row.total_amount), "count": row.transaction_count}
 
-    transactions_response = [
-        {
-            "id": transaction.id,
-            "status": transaction.status,
-            "transacted_at": datetime_conversion(transaction.transacted_at),
-            "type": transaction.type,
-            "amount": format_balance(transaction.amount),
-            "reference_id": transaction.reference_id
+    content = {
+        "status": "success",
+        "data": {
+            "summary": {
+                "from_day": from_day.isoformat() if from_day else None,
+                "to_day": to_day.isoformat() if to_day else None,
+                "deposits": totals["deposit"],
+                "withdrawals": totals["withdrawal"]
+            }
         }
-        for transaction in transactions
-    ]
+    }
+
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+@app.get("/api/v1/wallet/transactions", status_code=status.HTTP_200_OK)
+async def get_wallet_transactions(limit: int = Query(100, ge=1, le=1000), cursor: Optional[str] = None,
+                                  type: Optional[str] = Query(None, pattern="^(deposit|withdrawal)$"),
+                                  transacted_from: Optional[datetime] = None, transacted_to: Optional[datetime] = None,
+                                  min_amount: Optional[float] = None, max_amount: Optional[float] = None,
+                                  db: AsyncSession = Depends(get_read_db), authorization: Optional[str] = Header(None),
+                                  if_none_match: Optional[str] = Header(None)):
+    """
+    Get one page of the transactions of a wallet for a given customer using their token, newest first. Pages
+    continue into archived transactions once the recent ones run out. Like the balance, the page carries an
+    ETag of the wallet's version and is answered with 304 Not Modified, before any transaction is read, while
+    If-None-Match still matches it.
+
+    Args:
+        limit (int): Maximum number of transactions in the page.
+        cursor (str): Opaque `next_cursor` from the previous page; omit it for the first page.
+        type (str): Only return transactions of this type (deposit or withdrawal).
+        transacted_from (datetime): Only return transactions at or after this time.
+        transacted_to (datetime): Only return transactions before this time.
+        min_amount (float): Only return transactions of at least this amount.
+        max_amount (float): Only return transactions of at most this amount.
+        db (AsyncSession): Database session instance.
+        authorization (str): Authorization header containing customer's token.
+        if_none_match (str): ETag of the copy the client already holds, if any.
+
+    Returns:
+        ORJSONResponse: A response containing the page of transactions and the cursor of the next page, or an
+        empty 304 response.
+    """
+
+    token = extract_token(authorization)
+    after = decode_cursor(cursor) if cursor else None
+    identity = cached_wallet_identity(token)
+    if identity is not None:
+        check_wallet_status(identity)
+        cached_version = cached_version_matching(identity.id, if_none_match)
+        if cached_version is not None:
+            return not_modified(identity.id, cached_version)
+
+    # The wallet's version is read in the same transaction as the page, before it, so the ETag never claims a
+    # newer page than is sent.
+    wallet = await get_wallet_state(db=db, token=token)
+    check_wallet_status(wallet)
+    etag = wallet_etag(wallet.id, wallet.version)
+    if etag_matches(if_none_match, etag):
+        return not_modified(wallet.id, wallet.version)
+
+    transactions = await get_transactions_page(
+        db=db,
+        wallet=wallet,
+        limit=limit + 1,
+        after=after,
+        transaction_type=type,
+        transacted_from=transacted_from,
+        transacted_to=transacted_to,
+        min_amount=min_amount,
+        max_amount=max_amount,
+        archived=wallet.archived
+    )
+    has_more = len(transactions) > limit
+    transactions = transactions[:limit]
 
     content = {
         "status": "success",
         "data": {
-            "transactions": transactions_response
+            "transactions": transaction_list(transactions),
+            "next_cursor": encode_cursor(transactions[-1]) if has_more else None
         }
     }
 
-    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+    return versioned(ORJSONResponse(status_code=status.HTTP_200_OK, content=content), etag)
+
+
+EXPORT_COLUMNS = ["id", "status", "transacted_at", "type", "amount", "reference_id", "balance_after"]
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+
+
+@app.get("/api/v1/wallet/transactions/export", status_code=status.HTTP_200_OK)
+async def export_wallet_transactions(format: str = Query("ndjson", pattern="^(ndjson|csv)$"),
+                                     db: AsyncSession = Depends(get_read_db),
+                                     authorization: Optional[str] = Header(None)):
+    """
+    Stream the full ledger of a wallet, oldest first and archived transactions included, as NDJSON or CSV.
+    Amounts are exported unrounded so the ledger can be reconciled exactly.
+
+    Args:
+        format (str): Output format, either ndjson or csv.
+        db (AsyncSession): Database session instance.
+        authorization (str): Authorization header containing customer's token.
+
+    Returns:
+        StreamingResponse: The ledger, written out while rows are still being read from the database.
+    """
 
+    token = extract_token(authorization)
+    wallet = await get_wallet_state(db=db, token=token)
+    check_wallet_status(wallet)
 
-@app.post("/api/v1/wallet/deposits", status_code=status.HTTP_201_CREATED)
-async def add_money_to_wallet(amount: float = Form(...), reference_id: str = Form(...), db: Session = Depends(get_db),
-                              authorization: Optional[str] = Header(None)):
+    async def ndjson_lines():
+        async for partition in stream_transactions(db=db, wallet=wallet, archived=wallet.archived):
+            yield ndjson_rows(partition)
+
+    async def csv_lines():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        async for partition in stream_transactions(db=db, wallet=wallet, archived=wallet.archived):
+            writer.writerows(
+                (row.id, row.status, datetime_conversion(row.transacted_at), row.type, row.amount, row.reference_id,
+                 row.balance_after)
+                for row in partition
+            )
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    headers = {"Content-Disposition": f'attachment; filename="{wallet.id}.{format}"'}
+    return StreamingResponse(
+        ndjson_lines() if format == "ndjson" else csv_lines(),
+        media_type=EXPORT_MEDIA_TYPES[format],
+        headers=headers
+    )
+
+
+@app.post("/api/v1/wallet/deposits", status_code=status.HTTP_201_CREATED,
+          openapi_extra=request_body_openapi(DepositRequest))
+async def add_money_to_wallet(request: Request, body: DepositRequest = Depends(request_body(DepositRequest)),
+                              db: AsyncSession = Depends(get_db), authorization: Optional[str] = Header(None)):
     """
     Add money to a wallet for a given customer using their token.
 
     Args:
-        amount (float): Amount to be deposited.
-        db (Session): Database session instance.
-        reference_id (str): Reference ID for the transaction.
+        request (Request): The incoming request, used to pick the response format.
+        body (DepositRequest): Amount and reference ID, as form fields, JSON or MessagePack.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response indicating success or failure of the deposit.
+        Response: A response indicating success or failure of the deposit, in JSON or MessagePack.
     """
 
     token = extract_token(authorization)
-    wallet = get_wallet_by_token(db=db, token=token)
+    wallet = await get_wallet_identity(db=db, token=token)
 
     check_wallet_status(wallet)
 
     try:
-        transaction = add_deposit(
-            db=db,
+        transaction = await run_write(
+            db,
+            add_deposit,
             wallet=wallet,
-            amount=amount,
-            reference_id=reference_id
+            amount=body.amount,
+            reference_id=body.reference_id
         )
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
@@ -218,94 +560,136 @@ async def add_money_to_wallet(amount: float = Form(...), reference_id: str = For
     content = {
         "status": "success",
         "data": {
-            "deposit": {
-                "id": transaction.id,
-                "deposited_by": wallet.customer_xid,
-                "status": transaction.status,
-                "deposited_at": datetime_conversion(transaction.transacted_at),
-                "amount": format_balance(transaction.amount),
-                "reference_id": transaction.reference_id
-            }
+            "deposit": deposit_body(transaction, wallet.customer_xid)
         }
     }
 
-    return JSONResponse(status_code=status.HTTP_201_CREATED, content=content)
+    return negotiated_response(request, content, status.HTTP_201_CREATED)
 
 
-@app.post("/api/v1/wallet/withdrawals", status_code=status.HTTP_201_CREATED)
-async def make_a_withdrawal(amount: float = Form(...), reference_id: str = Form(...), db: Session = Depends(get_db),
-                            authorization: Optional[str] = Header(None)):
+@app.post("/api/v1/wallet/withdrawals", status_code=status.HTTP_201_CREATED,
+          openapi_extra=request_body_openapi(DepositRequest))
+async def make_a_withdrawal(request: Request, body: DepositRequest = Depends(request_body(DepositRequest)),
+                            db: AsyncSession = Depends(get_db), authorization: Optional[str] = Header(None)):
     """
     Make a withdrawal from a wallet for a given customer using their token.
 
     Args:
-        amount (float): Amount to be withdrawn.
-        db (Session): Database session instance.
-        reference_id (str): Reference ID for the transaction.
+        request (Request): The incoming request, used to pick the response format.
+        body (DepositRequest): Amount and reference ID, as form fields, JSON or MessagePack.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response indicating success or failure of the withdrawal.
+        Response: A response indicating success or failure of the withdrawal, in JSON or MessagePack.
     """
 
     token = extract_token(authorization)
-    wallet = get_wallet_by_token(db=db, token=token)
+    wallet = await get_wallet_identity(db=db, token=token)
     check_wallet_status(wallet)
 
     try:
-        transaction = make_withdrawal(db=db, wallet=wallet, amount=amount, reference_id=reference_id)
+        transaction = await run_write(db, make_withdrawal, wallet=wallet, amount=body.amount,
+                                      reference_id=body.reference_id)
     except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
 
     content = {
         "status": "success",
         "data": {
-            "withdrawal": {
+            "withdrawal": withdrawal_body(transaction, wallet.customer_xid)
+        }
+    }
+
+    return negotiated_response(request, content, status.HTTP_201_CREATED)
+
+
+@app.post("/api/v1/wallet/batch", status_code=status.HTTP_200_OK)
+async def apply_wallet_batch(batch: BatchRequest, db: AsyncSession = Depends(get_db),
+                             authorization: Optional[str] = Header(None)):
+    """
+    Apply many deposits and withdrawals to a wallet in one database transaction.
+
+    Args:
+        batch (BatchRequest): Items with type, amount and reference_id, applied in order.
+        db (AsyncSession): Database session instance.
+        authorization (str): Authorization header containing customer's token.
+
+    Returns:
+        ORJSONResponse: A response with one result per item, in request order.
+    """
+
+    token = extract_token(authorization)
+    wallet = await get_wallet_identity(db=db, token=token)
+    check_wallet_status(wallet)
+
+    try:
+        results = await apply_batch(db=db, wallet=wallet, items=batch.items)
+    except ValueError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
+    results_response = []
+    for result in results:
+        if result.error is not None:
+            results_response.append({
+                "reference_id": result.reference_id,
+                "type": result.type,
+                "status": "fail",
+                "error": result.error
+            })
+            continue
+        transaction = result.transaction
+        results_response.append({
+            "reference_id": result.reference_id,
+            "type": result.type,
+            "status": "success",
+            "transaction": {
                 "id": transaction.id,
-                "withdrawn_by": wallet.customer_xid,
                 "status": transaction.status,
-                "withdrawn_at": datetime_conversion(transaction.transacted_at),
-                "amount": format_balance(transaction.amount),
-                "reference_id": transaction.reference_id
+                "transacted_at": datetime_conversion(transaction.transacted_at),
+                "amount": format_balance(transaction.amount)
             }
+        })
+
+    content = {
+        "status": "success",
+        "data": {
+            "results": results_response
         }
     }
 
-    return content
+    return ORJSONResponse(status_code=status.HTTP_200_OK, content=content)
 
 
-@app.patch("/api/v1/wallet", status_code=status.HTTP_200_OK)
-async def disable_user_wallet(is_disabled: bool = Form(...), db: Session = Depends(get_db),
-                              authorization: Optional[str] = Header(None)):
+@app.patch("/api/v1/wallet", status_code=status.HTTP_200_OK,
+           openapi_extra=request_body_openapi(DisableWalletRequest))
+async def disable_user_wallet(request: Request,
+                              body: DisableWalletRequest = Depends(request_body(DisableWalletRequest)),
+                              db: AsyncSession = Depends(get_db), authorization: Optional[str] = Header(None)):
     """
     Disable a user's wallet using their token.
 
     Args:
-        is_disabled (bool): Flag indicating whether to disable the wallet or not.
-        db (Session): Database session instance.
+        request (Request): The incoming request, used to pick the response format.
+        body (DisableWalletRequest): is_disabled flag, as form fields, JSON or MessagePack.
+        db (AsyncSession): Database session instance.
         authorization (str): Authorization header containing customer's token.
 
     Returns:
-        JSONResponse: A response indicating success or failure of disabling the wallet.
+        Response: A response indicating success or failure of disabling the wallet, in JSON or MessagePack.
     """
 
     token = extract_token(authorization)
-    wallet = get_wallet_by_token(db=db, token=token)
+    wallet = await get_wallet_by_token(db=db, token=token)
     check_wallet_status(wallet)
 
-    if is_disabled:
-        wallet = disable_wallet(db=db, wallet=wallet)
+    if body.is_disabled:
+        wallet = await run_write(db, disable_wallet, wallet=wallet)
 
     content = {
         "status": "success",
         "data": {
-            "wallet": {
-                "id": wallet.id,
-                "owned_by": wallet.customer_xid,
-                "status": wallet.status,
-                "disabled_at": datetime_conversion(wallet.disabled_at),
-                "balance": format_balance(wallet.balance)
-            }
+            "wallet": wallet_body(wallet, "disabled_at")
         }
     }
-    return content
+    return negotiated_response(request, content)
@@ -0,0 +1,184 @@
+"""
+Maintenance commands for the wallet database.
+
+    python manage.py migrate [--status]
+    python manage.py rebuild-rollups
+    python manage.py archive [--older-than-days DAYS] [--dry-run]
+    python manage.py rebalance [--dry-run]
+    python manage.py move-wallet WALLET_ID --to SHARD
+    python manage.py provision CUSTOMERS_FILE --output MAPPING_CSV [--resume] [--chunk-size ROWS]
+    python manage.py reconcile [--full] [--workers PROCESSES] [--report REPORT_JSON]
+"""
+import argparse
+import asyncio
+import csv
+import json
+import os
+import sys
+from itertools import islice
+
+import archive
+import crud
+import migrations
+import provisioning
+import reconcile
+import sharding
+from database import SHARD_URLS, shards
+
+
+async def migrate(args):
+    if args.status:
+        for index, version in migrations.schema_versions():
+            state = "up to date" if version == migrations.LATEST_VERSION else "pending migrations"
+            print(f"Shard {index}: version {max(version, 0)} of {migrations.LATEST_VERSION}, {state}")
+        return
+    for index, before, after in migrations.migrate_all():
+        if before == after:
+            print(f"Shard {index}: already at version {after}")
+        else:
+            print(f"Shard {index}: migrated from version {before} to {after}")
+
+
+async def rebuild_rollups(args):
+    for shard in shards:
+        async with shard.sessions() as db:
+            count = await crud.rebuild_rollups(db, await archive.archived_rollups(db))
+        print(f"Rebuilt {count} daily rollups on shard {shard.index}")
+    await archive.dispose_engines()
+
+
+async def archive_transactions(args):
+    cutoff = archive.archive_cutoff(args.older_than_days)
+    for shard in shards:
+        count = await archive.archive_transactions(shard.sessions, cutoff, dry_run=args.dry_run)
+        action = "would archive" if args.dry_run else "archived"
+        print(f"Shard {shard.index}: {action} {count} transactions made before {cutoff:%Y-%m-%d}")
+    await archive.dispose_engines()
+
+
+async def rebalance(args):
+    moved = 0
+    for shard in shards:
+        misplaced = await sharding.misplaced_wallets(shard.index)
+        print(f"Shard {shard.index}: {len(misplaced)} wallets belong on another shard")
+        if args.dry_run:
+            continue
+        for wallet_id, target in misplaced:
+            if await sharding.move_wallet(wallet_id, shard.index, target):
+                moved += 1
+    if not args.dry_run:
+        print(f"Moved {moved} wallets")
+
+
+async def move_wallet(args):
+    if not 0 <= args.to < len(shards):
+        sys.exit(f"Shard {args.to} does not exist, there are {len(shards)} shards")
+    for shard in shards:
+        if shard.index != args.to and await sharding.move_wallet(args.wallet_id, shard.index, args.to):
+            print(f"Moved wallet {args.wallet_id} from shard {shard.index} to shard {args.to}")
+            return
+    sys.exit(f"Wallet {args.wallet_id} was not found outside shard {args.to}")
+
+
+def _mapping_rows(path: str) -> int:
+    """
+    Customers already in a mapping file. A line cut short by an interruption is removed, its customer is
+    provisioned (or found) again.
+    """
+    with open(path, "rb+") as mapping:
+        content = mapping.read()
+        complete = content.rfind(b"\n") + 1
+        mapping.truncate(complete)
+    return max(content.count(b"\n", 0, complete) - 1, 0)
+
+
+async def provision(args):
+    done = 0
+    if os.path.exists(args.output):
+        if not args.resume:
+            sys.exit(f"{args.output} already exists, pass --resume to continue the run that wrote it")
+        done = _mapping_rows(args.output)
+
+    source = sys.stdin if args.customers == "-" else open(args.customers)
+    with source, open(args.output, "a", newline="") as mapping:
+        writer = csv.writer(mapping)
+        if mapping.tell() == 0:
+            writer.writerow(["customer_xid", "token"])
+
+        def write_mapping(rows):
+            writer.writerows(rows)
+            mapping.flush()
+
+        customer_xids = islice(provisioning.read_customer_xids(source), done, None)
+        result = await provisioning.provision_wallets(customer_xids, write_mapping, chunk_size=args.chunk_size)
+    print(f"Created {result.created} wallets, {result.existing} customers already had one"
+          + (f", skipped {done} customers already in {args.output}" if done else ""))
+
+
+async def reconcile_ledger(args):
+    report = reconcile.reconcile(SHARD_URLS, workers=args.workers, full=args.full)
+    for shard in report["shards"]:
+        # The report may be going to standard output.
+        print(f"Shard {shard['shard']}: {shard['mode']} pass checked {shard['wallets_checked']} wallets and "
+              f"{shard['transactions_checked']} transactions, {shard['mismatches']} mismatches", file=sys.stderr)
+
+    if args.report == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.report, "w") as output:
+            json.dump(report, output, indent=2)
+    if report["mismatches"]:
+        sys.exit(1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upgrade = commands.add_parser("migrate", help="apply pending schema migrations to every shard")
+    upgrade.add_argument("--status", action="store_true", help="only show the schema version of every shard")
+    upgrade.set_defaults(handler=migrate)
+
+    rebuild = commands.add_parser("rebuild-rollups", help="regenerate daily_rollups from the transactions table")
+    rebuild.set_defaults(handler=rebuild_rollups)
+
+    cold = commands.add_parser("archive", help="move old transactions to the monthly archive databases")
+    cold.add_argument("--older-than-days", type=int, help="archive horizon, WALLET_ARCHIVE_AFTER_DAYS by default")
+    cold.add_argument("--dry-run", action="store_true", help="only count the transactions that would move")
+    cold.set_defaults(handler=archive_transactions)
+
+    balance = commands.add_parser("rebalance", help="move every wallet to the shard its id hashes to, "
+                                                    "e.g. after raising WALLET_SHARDS")
+    balance.add_argument("--dry-run", action="store_true", help="only count the wallets that would move")
+    balance.set_defaults(handler=rebalance)
+
+    move = commands.add_parser("move-wallet", help="move one wallet to another shard")
+    move.add_argument("wallet_id")
+    move.add_argument("--to", type=int, required=True, help="index of the target shard")
+    move.set_defaults(handler=move_wallet)
+
+    bulk = commands.add_parser("provision", help="create wallets for every customer xid in a file, one per line, "
+                                                 "and write the customer_xid,token mapping as CSV")
+    bulk.add_argument("customers", help="file of customer xids, - for standard input")
+    bulk.add_argument("--output", required=True, help="CSV file the mapping is written to")
+    bulk.add_argument("--resume", action="store_true",
+                      help="continue an interrupted run, skipping the customers already in --output")
+    bulk.add_argument("--chunk-size", type=int, default=provisioning.PROVISION_CHUNK_SIZE,
+                      help="customers per transaction")
+    bulk.set_defaults(handler=provision)
+
+    check = commands.add_parser("reconcile", help="check every wallet's balance and transaction count against its "
+                                                  "transactions; exits with 1 when any disagree")
+    check.add_argument("--full", action="store_true",
+                       help="check every wallet, not only those with transactions since the last pass")
+    check.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes")
+    check.add_argument("--report", default="-", help="file the JSON report is written to, - for standard output")
+    check.set_defaults(handler=reconcile_ledger)
+
+    args = parser.parse_args(argv)
+    asyncio.run(args.handler(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,341 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Optional
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+COUNT_BUCKETS = (1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+def _format_labels(names, values, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Histogram:
+    """
+    Fixed-bucket histogram. Observations land in a single (non-cumulative) bucket so that observe() is one
+    bisect and two additions; the cumulative counts Prometheus expects are computed when rendering.
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(float(bound))}"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}"
+            yield f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}"
+
+
+class Gauge:
+    """
+    Gauge read when /metrics is scraped; `collect` returns a list of (label values, value) pairs
+    """
+
+    def __init__(self, name: str, documentation: str, labelnames, collect):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in self.collect():
+            yield f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+REQUEST_LATENCY = registry.register(Histogram(
+    "wallet_http_request_duration_seconds", "Time spent serving a request, by route", ("method", "route")))
+REQUESTS = registry.register(Counter(
+    "wallet_http_requests_total", "Requests served, by route and status code", ("method", "route", "status")))
+REQUEST_QUERIES = registry.register(Histogram(
+    "wallet_http_request_db_queries", "Database statements executed per request, by route", ("method", "route"),
+    buckets=COUNT_BUCKETS))
+REQUEST_DB_TIME = registry.register(Histogram(
+    "wallet_http_request_db_duration_seconds", "Time spent in database statements and commits per request, "
+    "by route", ("method", "route")))
+QUERIES = registry.register(Counter("wallet_db_queries_total", "Database statements executed", ("engine",)))
+QUERY_LATENCY = registry.register(Histogram(
+    "wallet_db_query_duration_seconds", "Time spent executing a statement", ("engine",), buckets=QUERY_BUCKETS))
+COMMIT_LATENCY = registry.register(Histogram(
+    "wallet_db_commit_duration_seconds", "Time spent committing a transaction, which includes the fsync",
+    buckets=QUERY_BUCKETS))
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_seconds")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+# Set by MetricsMiddleware for the duration of a request; the engine hooks add to it.
+current_request: ContextVar[Optional[RequestStats]] = ContextVar("current_request", default=None)
+_commit_started: ContextVar[Optional[float]] = ContextVar("commit_started", default=None)
+
+
+def instrument_engine(engine, name: str):
+    """
+    Count and time every statement run on `engine` (labelled `name`), and time its commits.
+    Accepts an async engine or a plain synchronous one.
+    """
+    sync_engine = getattr(engine, "sync_engine", engine)
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        context._metrics_started = time.perf_counter()
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - context._metrics_started
+        QUERIES.inc(name)
+        QUERY_LATENCY.observe(elapsed, name)
+        stats = current_request.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.db_seconds += elapsed
+
+    @event.listens_for(sync_engine, "commit")
+    def commit(conn):
+        _commit_started.set(time.perf_counter())
+
+
+@event.listens_for(Session, "after_commit")
+def _record_commit(session):
+    started = _commit_started.get()
+    if started is None:
+        return
+    _commit_started.set(None)
+    elapsed = time.perf_counter() - started
+    COMMIT_LATENCY.observe(elapsed)
+    stats = current_request.get()
+    if stats is not None:
+        stats.db_seconds += elapsed
+
+
+def pool_gauges(engines):
+    """
+    Connection pool gauges for a {label: async engine} mapping. Pools without a fixed size (NullPool) are skipped.
+    """
+    def collect(method):
+        def values():
+            return [((name,), getattr(engine.pool, method)()) for name, engine in engines.items()
+                    if hasattr(engine.pool, method)]
+        return values
+
+    return [
+        Gauge("wallet_db_pool_size", "Configured size of the connection pool", ("engine",), collect("size")),
+        Gauge("wallet_db_pool_checked_out", "Connections in use", ("engine",), collect("checkedout")),
+        Gauge("wallet_db_pool_checked_in", "Idle connections in the pool", ("engine",), collect("checkedin")),
+        Gauge("wallet_db_pool_overflow", "Connections beyond pool_size, negative while the pool is filling",
+              ("engine",), collect("overflow"))
+    ]
+
+
+def cache_gauges(caches):
+    """
+    Size and hit ratio gauges for a {label: TTLCache} mapping
+    """
+    def collect(field):
+        return lambda: [((name,), cache.stats()[field]) for name, cache in caches.items()]
+
+    return [
+        Gauge("wallet_cache_entries", "Entries held in the cache", ("cache",), collect("size")),
+        Gauge("wallet_cache_hit_ratio", "Hits divided by lookups since start", ("cache",), collect("hit_ratio")),
+        Gauge("wallet_cache_hits", "Cache hits since start", ("cache",), collect("hits")),
+        Gauge("wallet_cache_misses", "Cache misses since start", ("cache",), collect("misses")),
+        Gauge("wallet_cache_evictions", "Entries evicted to stay within maxsize", ("cache",), collect("evictions"))
+    ]
+
+
+def admission_gauges(limiter, gate):
+    """
+    Gauges for the admission.RateLimiter and admission.WriteGate in front of the app; either may be None
+    """
+    gauges = []
+    if limiter is not None:
+        gauges += [
+            Gauge("wallet_rate_limit_tokens", "Tokens with a bucket in the rate limiter", (),
+                  lambda: [((), len(limiter))]),
+            Gauge("wallet_rate_limit_decisions", "Requests allowed or limited by the per-token rate limiter since "
+                  "start", ("outcome",), lambda: [(("allowed",), limiter.allowed), (("limited",), limiter.limited)]),
+            Gauge("wallet_rate_limit_evictions", "Token buckets dropped to stay within the token limit", (),
+                  lambda: [((), limiter.evictions)])
+        ]
+    if gate is not None:
+        gauges += [
+            Gauge("wallet_write_slots_in_use", "Writes holding one of the write slots", (),
+                  lambda: [((), gate.active)]),
+            Gauge("wallet_writes_waiting", "Writes waiting for a write slot", (), lambda: [((), gate.waiting)]),
+            Gauge("wallet_write_hold_seconds", "Moving average of how long a write holds its slot", (),
+                  lambda: [((), gate.hold_seconds)]),
+            Gauge("wallet_writes_admitted", "Writes given a write slot since start", (), lambda: [((), gate.admitted)]),
+            Gauge("wallet_writes_shed", "Writes answered with 503 since start, by reason", ("reason",),
+                  lambda: [((reason,), count) for reason, count in gate.shed.items()])
+        ]
+    return gauges
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware recording latency, status code, statement count and database time for every HTTP request.
+    Requests are labelled by route template (e.g. /api/v1/wallet/deposits), never by raw path.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        status_code = 500
+        stats = RequestStats()
+        token = current_request.set(stats)
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            current_request.reset(token)
+            route = scope.get("route")
+            labels = (scope["method"], route.path if route is not None else "unmatched")
+            REQUEST_LATENCY.observe(elapsed, *labels)
+            REQUESTS.inc(*labels, str(status_code))
+            REQUEST_QUERIES.observe(stats.queries, *labels)
+            REQUEST_DB_TIME.observe(stats.db_seconds, *labels)
+
+
+TRANSACTION_CONTROL = ("BEGIN", "BEGIN IMMEDIATE", "COMMIT")
+
+
+class QueryCounter:
+    """
+    Context manager recording every statement and commit sent through the given engines, with the number of rows
+    each statement returned. Used by the query budget tests:
+
+        with QueryCounter(shard.engine, shard.read_engine) as queries:
+            ...
+        assert queries.count <= 4
+
+    Row counts come from the aiosqlite adapter, which buffers the result of a non-streaming cursor before the
+    after_cursor_execute event fires; rows read through a streaming cursor are not counted.
+    """
+
+    def __init__(self, *engines):
+        self.engines = list(dict.fromkeys(getattr(engine, "sync_engine", engine) for engine in engines))
+        self.statements = []
+
+    @property
+    def count(self) -> int:
+        return len(self.statements)
+
+    @property
+    def rows(self) -> int:
+        return sum(rows for _, rows in self.statements)
+
+    def repeated(self):
+        """
+        Statements sent more than once, the usual sign of an N+1 pattern. BEGIN and COMMIT are left out: a
+        request may run more than one transaction.
+        """
+        seen = {}
+        for statement, _ in self.statements:
+            if statement in TRANSACTION_CONTROL:
+                continue
+            seen[statement] = seen.get(statement, 0) + 1
+        return {statement: times for statement, times in seen.items() if times > 1}
+
+    def _record_statement(self, conn, cursor, statement, parameters, context, executemany):
+        rows = getattr(cursor, "_rows", None)
+        self.statements.append((statement, len(rows) if isinstance(rows, list) else 0))
+
+    def _record_commit(self, conn):
+        self.statements.append(("COMMIT", 0))
+
+    def __enter__(self):
+        self.statements = []
+        for engine in self.engines:
+            event.listen(engine, "after_cursor_execute", self._record_statement)
+            event.listen(engine, "commit", self._record_commit)
+        return self
+
+    def __exit__(self, *exc_info):
+        for engine in self.engines:
+            event.remove(engine, "after_cursor_execute", self._record_statement)
+            event.remove(engine, "commit", self._record_commit)
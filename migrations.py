@@ -0,0 +1,275 @@
+"""
+Versioned schema migrations, applied by `python manage.py migrate` (and by server.py before it starts workers).
+
+Each shard records the migrations applied to it in the schema_version table. An empty database is created
+straight at the latest version from the models. A database created before versioning, by the create_all the
+app used to run on import, starts at version 0 and goes through every migration; each one only adds what is
+missing, because such a database has the tables of whichever release created it but none of the later columns.
+
+To change the schema, change the models and append a Migration that brings an existing database to the same
+shape. Never edit a migration that has been released.
+"""
+from collections import defaultdict
+from datetime import datetime
+from typing import Callable, List, NamedTuple, Tuple
+from uuid import uuid4
+
+from sqlalchemy import Column, DateTime, Integer, MetaData, String, Table, func, insert, inspect, select, text
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+
+import archive
+import crud
+import models
+from database import Base, SHARD_URLS, batch_read_engine, schema_engine, shards
+
+schema_version = Table(
+    "schema_version", MetaData(),
+    Column("version", Integer, primary_key=True),
+    Column("description", String, nullable=False),
+    Column("applied_at", DateTime, nullable=False)
+)
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable
+
+
+def _create_tables(conn, *model_classes):
+    Base.metadata.create_all(conn, tables=[model_class.__table__ for model_class in model_classes])
+
+
+def _columns(conn, table: str) -> set:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def _initial_schema(conn):
+    _create_tables(conn, models.Wallet, models.Transaction)
+
+
+# Running balance of every transaction in ledger order, written in one pass with a window function.
+BACKFILL_BALANCE_AFTER = """
+UPDATE transactions SET balance_after = running.balance
+FROM (
+    SELECT id, SUM(CASE WHEN type = 'deposit' THEN amount ELSE -amount END)
+               OVER (PARTITION BY wallet_id ORDER BY transacted_at, id) AS balance
+    FROM transactions
+) AS running
+WHERE running.id = transactions.id
+"""
+
+
+def _ledger_bookkeeping(conn):
+    if "transaction_count" not in _columns(conn, "wallets"):
+        conn.execute(text("ALTER TABLE wallets ADD COLUMN transaction_count INTEGER NOT NULL DEFAULT 0"))
+        conn.execute(text("UPDATE wallets SET transaction_count = "
+                          "(SELECT COUNT(*) FROM transactions WHERE transactions.wallet_id = wallets.id)"))
+    if "balance_after" not in _columns(conn, "transactions"):
+        conn.execute(text("ALTER TABLE transactions ADD COLUMN balance_after FLOAT"))
+        conn.execute(text(BACKFILL_BALANCE_AFTER))
+
+    existing = {index["name"]: index for index in inspect(conn).get_indexes("transactions")}
+    for index in models.Transaction.__table__.indexes:
+        found = existing.get(index.name)
+        if found is not None and bool(found["unique"]) == bool(index.unique):
+            continue
+        if found is not None:
+            conn.execute(text(f"DROP INDEX {index.name}"))
+        try:
+            index.create(conn)
+        except IntegrityError:
+            raise RuntimeError(f"Cannot create {index.name}: transactions has duplicate values for it, "
+                               f"remove them and migrate again")
+
+    if not inspect(conn).has_table("daily_rollups"):
+        _create_tables(conn, models.DailyRollup)
+        conn.execute(crud.rollups_from_transactions())
+
+    if not inspect(conn).has_table("balance_checkpoints"):
+        _create_tables(conn, models.BalanceCheckpoint)
+        transaction = models.Transaction
+        numbered = select(
+            transaction.id, transaction.wallet_id, transaction.transacted_at, transaction.balance_after,
+            func.row_number().over(partition_by=transaction.wallet_id,
+                                   order_by=(transaction.transacted_at, transaction.id)).label("position")
+        ).subquery()
+        checkpoints = [
+            {"id": str(uuid4()), "wallet_id": row.wallet_id, "transaction_id": row.id,
+             "transacted_at": row.transacted_at, "transaction_count": row.position, "balance": row.balance_after}
+            for row in conn.execute(select(numbered).where(numbered.c.position % crud.CHECKPOINT_INTERVAL == 0))
+        ]
+        if checkpoints:
+            conn.execute(insert(models.BalanceCheckpoint), checkpoints)
+
+
+def _wallet_directory(conn):
+    _create_tables(conn, models.WalletDirectory)
+
+
+def _archived_months(conn):
+    _create_tables(conn, models.ArchivedMonth)
+
+
+def _wallet_versions(conn):
+    if "version" not in _columns(conn, "wallets"):
+        conn.execute(text("ALTER TABLE wallets ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+
+def _drop_wallet_id_index(conn):
+    conn.execute(text("DROP INDEX IF EXISTS ix_wallets_id"))
+
+
+def _reconciliation_runs(conn):
+    _create_tables(conn, models.ReconciliationRun)
+
+
+def _daily_rollup_trigger(conn):
+    if conn.dialect.name == "sqlite":
+        conn.execute(models.DAILY_ROLLUP_TRIGGER)
+
+
+def _per_wallet_reference_ids(conn):
+    # Reference ids were unique per shard until now, so they are unique per wallet already.
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_transactions_wallet_id_reference_id "
+                      "ON transactions (wallet_id, reference_id)"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_transactions_reference_id"))
+
+
+REFERENCE_COLUMNS = ["wallet_id", "reference_id", "transaction_id", "type", "amount", "transacted_at",
+                     "balance_after"]
+
+
+def _transaction_references(conn):
+    _create_tables(conn, models.TransactionReference)
+    transaction = models.Transaction
+    conn.execute(insert(models.TransactionReference).from_select(
+        REFERENCE_COLUMNS,
+        select(transaction.wallet_id, transaction.reference_id, transaction.id, transaction.type,
+               transaction.amount, transaction.transacted_at, transaction.balance_after)
+        .where(transaction.reference_id.isnot(None))))
+
+    # Archived transactions keep their references too. Rows an interrupted archival run left in both tiers are
+    # already in.
+    months = defaultdict(list)
+    for wallet_id, month in conn.execute(select(models.ArchivedMonth.wallet_id, models.ArchivedMonth.month)):
+        months[month].append(wallet_id)
+    dialect = postgresql if conn.dialect.name == "postgresql" else sqlite
+    statement = dialect.insert(models.TransactionReference).on_conflict_do_nothing()
+    archived = archive.archived_transactions.c
+    for month, wallet_ids in sorted(months.items()):
+        engine = batch_read_engine(archive.archive_url(month))
+        try:
+            with engine.connect() as archive_conn:
+                for start in range(0, len(wallet_ids), archive.ARCHIVE_WALLET_BATCH):
+                    result = archive_conn.execution_options(yield_per=archive.ARCHIVE_CHUNK_SIZE).execute(
+                        select(archived.wallet_id, archived.reference_id, archived.id.label("transaction_id"),
+                               archived.type, archived.amount, archived.transacted_at, archived.balance_after)
+                        .where(archived.wallet_id.in_(wallet_ids[start:start + archive.ARCHIVE_WALLET_BATCH]),
+                               archived.reference_id.isnot(None)))
+                    for rows in result.mappings().partitions():
+                        conn.execute(statement, [dict(row) for row in rows])
+        finally:
+            engine.dispose()
+
+
+def _forget_rowid_marks(conn):
+    # Earlier marks are transactions rowids, which say nothing about the reference sequence: the next pass is full.
+    conn.execute(text("UPDATE reconciliation_runs SET high_water_mark = NULL"))
+
+
+MIGRATIONS = [
+    Migration(1, "wallets and transactions", _initial_schema),
+    Migration(2, "running balances, transaction counts, daily rollups and balance checkpoints",
+              _ledger_bookkeeping),
+    Migration(3, "wallet directory for moved wallets", _wallet_directory),
+    Migration(4, "manifest of archived transaction months", _archived_months),
+    Migration(5, "wallet versions for conditional GETs", _wallet_versions),
+    Migration(6, "drop the index duplicating the wallets primary key", _drop_wallet_id_index),
+    Migration(7, "reconciliation runs and their high-water marks", _reconciliation_runs),
+    Migration(8, "trigger maintaining daily rollups on SQLite", _daily_rollup_trigger),
+    Migration(9, "reference ids unique per wallet instead of per shard", _per_wallet_reference_ids),
+    Migration(10, "reference ids kept in the hot database when transactions are archived",
+              _transaction_references),
+    Migration(11, "reconciliation marks taken from the reference sequence", _forget_rowid_marks),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _current_version(conn) -> int:
+    """
+    Version of the database behind `conn`: 0 for a database from before versioning, -1 for an empty one
+    """
+    inspector = inspect(conn)
+    if inspector.has_table(schema_version.name):
+        return conn.execute(select(func.max(schema_version.c.version))).scalar() or 0
+    return 0 if inspector.has_table(models.Wallet.__tablename__) else -1
+
+
+def _stamp(conn, migration: Migration):
+    conn.execute(insert(schema_version).values(
+        version=migration.version, description=migration.description, applied_at=datetime.now()))
+
+
+def migrate(url: str) -> Tuple[int, int]:
+    """
+    Bring the database at `url` to LATEST_VERSION. Every migration runs in its own transaction together with
+    its schema_version row, so an interrupted run resumes where it stopped, and concurrent runs wait for each
+    other instead of applying a migration twice. Returns the versions before and after.
+    """
+    engine = schema_engine(url)
+    try:
+        with engine.begin() as conn:
+            start = _current_version(conn)
+            schema_version.create(conn, checkfirst=True)
+            if start == -1:
+                Base.metadata.create_all(conn)
+                for migration in MIGRATIONS:
+                    _stamp(conn, migration)
+                return 0, LATEST_VERSION
+
+        for migration in MIGRATIONS:
+            with engine.begin() as conn:
+                if _current_version(conn) >= migration.version:
+                    continue
+                migration.apply(conn)
+                _stamp(conn, migration)
+        return start, LATEST_VERSION
+    finally:
+        engine.dispose()
+
+
+def migrate_all() -> List[Tuple[int, int, int]]:
+    """
+    Migrate every shard; returns (shard, version before, version after) for each
+    """
+    return [(index, *migrate(url)) for index, url in enumerate(SHARD_URLS)]
+
+
+def schema_versions() -> List[Tuple[int, int]]:
+    """
+    (shard, version) for every shard, with 0 for a database from before versioning and -1 for an empty one
+    """
+    versions = []
+    for index, url in enumerate(SHARD_URLS):
+        engine = schema_engine(url)
+        try:
+            with engine.connect() as conn:
+                versions.append((index, _current_version(conn)))
+        finally:
+            engine.dispose()
+    return versions
+
+
+async def outdated_shards() -> List[Tuple[int, int]]:
+    """
+    (shard, version) for every shard the app's own engines see below LATEST_VERSION
+    """
+    outdated = []
+    for shard in shards:
+        async with shard.engine.connect() as conn:
+            version = await conn.run_sync(_current_version)
+        if version < LATEST_VERSION:
+            outdated.append((shard.index, version))
+    return outdated
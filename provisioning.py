@@ -0,0 +1,143 @@
+"""
+Bulk wallet provisioning, run by `python manage.py provision`.
+
+Customer xids are read as a stream and handled in chunks. For every chunk, wallet ids and tokens come from one
+read of the system's random source each. The wallets are inserted with executemany, one transaction per shard,
+and the customer -> token mapping is written out once the chunk has committed. Customers that already have a
+wallet get their existing token back instead of a second wallet, so a run that was interrupted is simply run
+again: with `resume`, the input rows already in the mapping are skipped, and the one chunk that may have
+committed without being written out is recognised in the database.
+"""
+import os
+import secrets
+from itertools import islice
+from typing import Callable, Dict, Iterable, Iterator, List, NamedTuple, Tuple
+
+from sqlalchemy import insert, select
+
+import models
+from crud import WalletStatus
+from database import shards
+from sharding import shard_for_wallet
+
+PROVISION_CHUNK_SIZE = 50000
+# Rows per executemany and customer xids per IN (...) lookup, well below SQLite's bound parameter limit.
+STATEMENT_CHUNK_SIZE = 5000
+TOKEN_BYTES = 20
+# Page cache for the bulk connection (negative: KiB). The wallet indexes are keyed on random ids and tokens,
+# so inserts touch pages all over them.
+SQLITE_CACHE_SIZE = -262144
+WALLET_COLUMNS = ["id", "customer_xid", "status", "balance", "token", "transaction_count", "version"]
+
+
+class ProvisionResult(NamedTuple):
+    created: int
+    existing: int
+
+
+def read_customer_xids(lines: Iterable[str]) -> Iterator[str]:
+    """
+    One customer xid per line; surrounding whitespace and blank lines are ignored
+    """
+    for line in lines:
+        customer_xid = line.strip()
+        if customer_xid:
+            yield customer_xid
+
+
+def _chunks(items: Iterable, size: int) -> Iterator[list]:
+    iterator = iter(items)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _wallet_ids(count: int) -> List[str]:
+    """
+    `count` random (version 4) UUIDs, formatted from a single read of the random source
+    """
+    raw = bytearray(os.urandom(16 * count))
+    raw[6::16] = bytes(byte & 0x0f | 0x40 for byte in raw[6::16])
+    raw[8::16] = bytes(byte & 0x3f | 0x80 for byte in raw[8::16])
+    digits = raw.hex()
+    return [f"{digits[i:i + 8]}-{digits[i + 8:i + 12]}-{digits[i + 12:i + 16]}-{digits[i + 16:i + 20]}-"
+            f"{digits[i + 20:i + 32]}" for i in range(0, 32 * count, 32)]
+
+
+def _new_wallets(customer_xids: List[str]) -> Dict[int, List[tuple]]:
+    """
+    Rows (in WALLET_COLUMNS order) for new wallets of `customer_xids`, grouped by the shard they are placed on
+    and sorted by id, so that consecutive inserts land close together in the primary key
+    """
+    token_hex = secrets.token_bytes(TOKEN_BYTES * len(customer_xids)).hex()
+    width = 2 * TOKEN_BYTES
+    sharded = len(shards) > 1
+    status = WalletStatus.DISABLED.value
+    by_shard = {}
+    for index, (wallet_id, customer_xid) in enumerate(zip(_wallet_ids(len(customer_xids)), customer_xids)):
+        token = token_hex[width * index:width * (index + 1)]
+        shard = shard_for_wallet(wallet_id) if sharded else 0
+        by_shard.setdefault(shard, []).append(
+            (wallet_id, customer_xid, status, 0, f"{shard}.{token}" if sharded else token, 0, 0))
+    for rows in by_shard.values():
+        rows.sort()
+    return by_shard
+
+
+async def _existing_tokens(customer_xids: List[str]) -> Dict[str, str]:
+    """
+    Tokens of wallets the customers already have on any shard. A customer with several wallets always gets the
+    same one, so that re-runs agree.
+    """
+    wallet = models.Wallet
+    tokens = {}
+    for shard in shards:
+        async with shard.engine.connect() as conn:
+            for part in _chunks(customer_xids, STATEMENT_CHUNK_SIZE):
+                rows = await conn.execute(
+                    select(wallet.customer_xid, wallet.token).where(wallet.customer_xid.in_(part))
+                    .order_by(wallet.id))
+                for customer_xid, token in rows:
+                    tokens.setdefault(customer_xid, token)
+    return tokens
+
+
+async def _insert(shard: int, rows: List[tuple]):
+    """
+    Inserts the rows in one transaction. The statement is compiled once and the rows go straight to the
+    driver's executemany, which skips SQLAlchemy's per-row parameter processing.
+    """
+    async with shards[shard].engine.begin() as conn:
+        if conn.dialect.name == "sqlite":
+            await conn.exec_driver_sql(f"PRAGMA cache_size = {SQLITE_CACHE_SIZE}")
+        compiled = insert(models.Wallet.__table__).compile(dialect=conn.dialect, column_keys=WALLET_COLUMNS)
+        if compiled.positional:
+            order = [WALLET_COLUMNS.index(name) for name in compiled.positiontup]
+            parameters = [tuple(row[index] for index in order) for row in rows] \
+                if order != list(range(len(WALLET_COLUMNS))) else rows
+        else:
+            parameters = [dict(zip(WALLET_COLUMNS, row)) for row in rows]
+        for part in _chunks(parameters, STATEMENT_CHUNK_SIZE):
+            await conn.exec_driver_sql(compiled.string, part)
+
+
+async def provision_wallets(customer_xids: Iterable[str], write_mapping: Callable[[List[Tuple[str, str]]], None],
+                            chunk_size: int = PROVISION_CHUNK_SIZE) -> ProvisionResult:
+    """
+    Makes sure every customer in `customer_xids` has a wallet, creating disabled wallets like POST /api/v1/init
+    does. `write_mapping` gets the (customer_xid, token) pairs of every chunk, in input order, after the chunk
+    has committed; a customer listed twice gets the same token twice.
+    """
+    created = existing = 0
+    for chunk in _chunks(customer_xids, chunk_size):
+        tokens = await _existing_tokens(list(dict.fromkeys(chunk)))
+        existing += len(tokens)
+        missing = [customer_xid for customer_xid in dict.fromkeys(chunk) if customer_xid not in tokens]
+        for shard, rows in _new_wallets(missing).items():
+            await _insert(shard, rows)
+            tokens.update((row[1], row[4]) for row in rows)
+            created += len(rows)
+        write_mapping([(customer_xid, tokens[customer_xid]) for customer_xid in chunk])
+    return ProvisionResult(created, existing)
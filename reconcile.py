@@ -0,0 +1,229 @@
+"""
+Ledger reconciliation, run by `python manage.py reconcile`.
+
+A wallet's balance has to equal its opening balance, carried over from the archive, plus the signed sum of the
+transactions still in the hot table, and its transaction_count has to equal the number of its archived and hot
+transactions. A full pass checks every wallet of a shard with one streaming GROUP BY wallet_id over the
+transactions table, split into wallet id ranges that a pool of processes aggregates side by side, each over its
+own read-only connection.
+
+Every pass records in reconciliation_runs the highest transaction_references sequence it covered. Every
+transaction is written with its reference, so the next pass only re-checks the wallets with references past that
+high-water mark, found with a range scan of the sequence. The sequence is AUTOINCREMENT, so it keeps going up
+when moves delete the newest references; plain rowids would be handed out again and their rows skipped. A
+balance that changed without a transaction row is only caught by a full pass. Only SQLite, with its single
+writer, commits sequence values in order: on other databases every pass is a full one.
+"""
+import math
+import multiprocessing
+from concurrent.futures import Executor, ProcessPoolExecutor
+from datetime import datetime
+from itertools import repeat
+from typing import List, NamedTuple, Optional, Sequence, Tuple, Union
+
+from sqlalchemy import and_, case, func, insert, select, true
+
+import models
+from crud import TransactionType
+from database import batch_read_engine, schema_engine
+
+# Wallet id ranges per worker process, so that a range heavier than the others does not leave the rest of the
+# pool idle at the end of a full pass.
+RANGES_PER_WORKER = 4
+# Touched wallets per incremental task, bound as one IN (...) list.
+WALLET_BATCH = 500
+# Balances are floats, and are summed here in another order than they were applied in.
+BALANCE_TOLERANCE = 1e-6
+
+
+class WalletRange(NamedTuple):
+    """
+    Wallet ids from `low` (inclusive) to `high` (exclusive); None leaves that end open
+    """
+    low: Optional[str]
+    high: Optional[str]
+
+
+WalletScope = Union[WalletRange, Sequence[str]]
+
+
+class LedgerCheck(NamedTuple):
+    wallets: int
+    transactions: int
+    mismatches: List[dict]
+
+
+def wallet_ranges(count: int) -> List[WalletRange]:
+    """
+    `count` ranges splitting the id space evenly. Wallet ids are random UUIDs, so their wallets split evenly too;
+    ids of any other shape sort into the first or the last range.
+    """
+    bounds = [None] + [f"{(index << 32) // count:08x}" for index in range(1, count)] + [None]
+    return [WalletRange(low, high) for low, high in zip(bounds, bounds[1:])]
+
+
+def _in_scope(column, scope: WalletScope):
+    if not isinstance(scope, WalletRange):
+        return column.in_(scope)
+    conditions = []
+    if scope.low is not None:
+        conditions.append(column >= scope.low)
+    if scope.high is not None:
+        conditions.append(column < scope.high)
+    return and_(true(), *conditions)
+
+
+_engines = {}
+
+
+def _engine(url: str):
+    engine = _engines.get(url)
+    if engine is None:
+        engine = _engines[url] = batch_read_engine(url)
+    return engine
+
+
+def check_wallets(url: str, scope: WalletScope) -> LedgerCheck:
+    """
+    Compares the wallets in `scope` with their ledger, all in one read transaction so that an archival run
+    moving their transactions meanwhile cannot make them disagree. Runs in the worker processes.
+    """
+    transaction, wallet = models.Transaction.__table__, models.Wallet.__table__
+    months, checkpoint = models.ArchivedMonth.__table__, models.BalanceCheckpoint.__table__
+    signed = case((transaction.c.type == TransactionType.DEPOSIT.value, transaction.c.amount),
+                  else_=-transaction.c.amount)
+    ledger = (
+        select(transaction.c.wallet_id, func.sum(signed).label("total"), func.count().label("transactions"))
+        .where(_in_scope(transaction.c.wallet_id, scope))
+        .group_by(transaction.c.wallet_id)
+        .subquery()
+    )
+
+    with _engine(url).begin() as conn:
+        # The balance after a wallet's last archived transaction is checkpointed when it is archived.
+        archived = {}
+        for row in conn.execute(
+                select(months.c.wallet_id, months.c.transaction_count, months.c.last_transaction_id)
+                .where(_in_scope(months.c.wallet_id, scope))
+                .order_by(months.c.wallet_id, months.c.month)):
+            count = archived.get(row.wallet_id, (0, None))[0]
+            archived[row.wallet_id] = (count + row.transaction_count, row.last_transaction_id)
+        openings = {}
+        if archived:
+            openings = {
+                (row.wallet_id, row.transaction_id): row.balance
+                for row in conn.execute(
+                    select(checkpoint.c.wallet_id, checkpoint.c.transaction_id, checkpoint.c.balance)
+                    .where(_in_scope(checkpoint.c.wallet_id, scope),
+                           checkpoint.c.transaction_id.in_(
+                               select(months.c.last_transaction_id).where(_in_scope(months.c.wallet_id, scope)))))
+            }
+
+        wallets = transactions = 0
+        mismatches = []
+        for row in conn.execute(
+                select(wallet.c.id, wallet.c.balance, wallet.c.transaction_count, ledger.c.total,
+                       ledger.c.transactions)
+                .select_from(wallet.outerjoin(ledger, ledger.c.wallet_id == wallet.c.id))
+                .where(_in_scope(wallet.c.id, scope))):
+            wallets += 1
+            transactions += row.transactions or 0
+            archived_count, last_archived = archived.get(row.id, (0, None))
+            opening = openings.get((row.id, last_archived), 0.0)
+            expected_balance = opening + (row.total or 0.0)
+            expected_count = archived_count + (row.transactions or 0)
+            balance = row.balance or 0.0
+            if row.transaction_count != expected_count or not math.isclose(
+                    balance, expected_balance, rel_tol=1e-12, abs_tol=BALANCE_TOLERANCE):
+                mismatches.append({
+                    "wallet_id": row.id,
+                    "balance": balance,
+                    "expected_balance": expected_balance,
+                    "difference": balance - expected_balance,
+                    "transaction_count": row.transaction_count,
+                    "expected_transaction_count": expected_count,
+                    "opening_balance": opening,
+                    "archived_transactions": archived_count
+                })
+    return LedgerCheck(wallets, transactions, mismatches)
+
+
+def _marks(url: str, full: bool) -> Tuple[Optional[int], Optional[int], List[str]]:
+    """
+    (previous high-water mark, current one, wallets touched in between); the previous mark is None when this
+    pass has to be a full one, the current one is None on databases other than SQLite
+    """
+    runs, references = models.ReconciliationRun, models.TransactionReference
+    engine = batch_read_engine(url)
+    try:
+        with engine.begin() as conn:
+            if conn.dialect.name != "sqlite":
+                return None, None, []
+            mark = conn.execute(select(func.max(references.sequence))).scalar() or 0
+            since = None if full else conn.execute(
+                select(runs.high_water_mark).where(runs.high_water_mark.is_not(None))
+                .order_by(runs.id.desc()).limit(1)).scalar()
+            if since is None:
+                return None, mark, []
+            touched = conn.execute(
+                select(references.wallet_id).distinct().where(references.sequence > since)).scalars().all()
+            return since, mark, touched
+    finally:
+        engine.dispose()
+
+
+def reconcile_shard(index: int, url: str, executor: Executor, workers: int,
+                    full: bool = False) -> Tuple[dict, List[dict]]:
+    """
+    One pass over the shard at `url`, fanned out over `executor`: a full one when `full` is set or no earlier
+    pass left a high-water mark, otherwise over the wallets touched since. The pass is recorded in
+    reconciliation_runs. Returns its summary and its mismatches.
+    """
+    started_at = datetime.now()
+    since, mark, touched = _marks(url, full)
+    if since is None:
+        mode, scopes = "full", wallet_ranges(workers * RANGES_PER_WORKER)
+    else:
+        mode, scopes = "incremental", [touched[i:i + WALLET_BATCH] for i in range(0, len(touched), WALLET_BATCH)]
+
+    checks = list(executor.map(check_wallets, repeat(url), scopes))
+    mismatches = [{"shard": index, **mismatch} for check in checks for mismatch in check.mismatches]
+    summary = {
+        "shard": index,
+        "mode": mode,
+        "since": since,
+        "high_water_mark": mark,
+        "wallets_checked": sum(check.wallets for check in checks),
+        "transactions_checked": sum(check.transactions for check in checks),
+        "mismatches": len(mismatches)
+    }
+
+    engine = schema_engine(url)
+    try:
+        with engine.begin() as conn:
+            conn.execute(insert(models.ReconciliationRun).values(
+                mode=mode, started_at=started_at, finished_at=datetime.now(), high_water_mark=mark,
+                wallets_checked=summary["wallets_checked"], mismatches=len(mismatches)))
+    finally:
+        engine.dispose()
+    return summary, mismatches
+
+
+def reconcile(urls: Sequence[str], workers: int, full: bool = False) -> dict:
+    """
+    Reconciles every shard in `urls` with a pool of `workers` processes; returns the report of the run
+    """
+    started_at = datetime.now()
+    shard_summaries, mismatches = [], []
+    # Spawned rather than forked: the parent may already hold database connections and their threads.
+    with ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        for index, url in enumerate(urls):
+            summary, shard_mismatches = reconcile_shard(index, url, executor, workers, full)
+            shard_summaries.append(summary)
+            mismatches += shard_mismatches
+    return {
+        "started_at": started_at.isoformat(),
+        "finished_at": datetime.now().isoformat(),
+        "shards": shard_summaries,
+        "mismatches": mismatches
+    }
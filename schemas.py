@@ -1,5 +1,5 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Literal, Optional
+from pydantic import BaseModel, Field
 from datetime import datetime
 
 
@@ -35,11 +35,28 @@ class TransactionBase(BaseModel):
         from_attributes = True
 
 
+class InitRequest(BaseModel):
+    customer_xid: Optional[str] = None
+
+
 class DepositRequest(BaseModel):
     amount: float
     reference_id: str
 
 
+class BatchItem(BaseModel):
+    """
+    BatchItem class defines one deposit or withdrawal of a batch request
+    """
+    type: Literal["deposit", "withdrawal"]
+    amount: float = Field(gt=0)
+    reference_id: str
+
+
+class BatchRequest(BaseModel):
+    items: List[BatchItem] = Field(min_length=1, max_length=10000)
+
+
 class DisableWalletRequest(BaseModel):
     is_disabled: bool
 
@@ -0,0 +1,146 @@
+"""
+Request and response bodies for wallets and transactions. Responses are encoded with orjson, or with
+MessagePack when the client asks for it; request bodies may be form encoded, JSON or MessagePack.
+
+orjson writes datetimes natively in the same ISO 8601 form as datetime.isoformat(), so the builders below pass
+them through instead of converting each one to a string first, and amounts are truncated with int() exactly
+like commons.format_balance. The builders are plain functions over attributes so they work the same for ORM
+objects, rows and cached identities.
+"""
+from datetime import date, datetime
+
+import msgpack
+import orjson
+from fastapi import HTTPException, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import ORJSONResponse, Response
+from pydantic import ValidationError
+
+__all__ = ["ORJSONResponse", "MsgpackResponse", "request_body", "request_body_openapi", "negotiated_response",
+           "wallet_body", "deposit_body", "withdrawal_body", "transaction_list", "ndjson_rows"]
+
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def _msgpack_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialize {type(value).__name__} to MessagePack")
+
+
+class MsgpackResponse(Response):
+    media_type = "application/msgpack"
+
+    def render(self, content) -> bytes:
+        return msgpack.packb(content, default=_msgpack_default)
+
+
+def request_body(model):
+    """
+    Dependency parsing the request body into `model`, chosen by Content-Type: application/json and
+    application/msgpack bodies are decoded directly, anything else is read as form fields. Invalid bodies get
+    the same 422 response as FastAPI's own validation.
+    """
+    async def parse(request: Request):
+        content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+        try:
+            if content_type == "application/json":
+                return model.model_validate_json(await request.body())
+            if content_type in MSGPACK_MEDIA_TYPES:
+                return model.model_validate(msgpack.unpackb(await request.body()))
+            return model.model_validate(dict(await request.form()))
+        except ValidationError as e:
+            raise RequestValidationError(e.errors())
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Malformed request body")
+
+    return parse
+
+
+def request_body_openapi(model) -> dict:
+    """
+    openapi_extra documenting the body formats request_body(model) accepts, which FastAPI cannot infer
+    """
+    schema = model.model_json_schema()
+    media_types = ["application/x-www-form-urlencoded", "application/json", *MSGPACK_MEDIA_TYPES[:1]]
+    content = {media_type: {"schema": schema} for media_type in media_types}
+    return {"requestBody": {"required": True, "content": content}}
+
+
+def negotiated_response(request: Request, content, status_code: int = 200) -> Response:
+    """
+    MessagePack when the Accept header asks for it, JSON otherwise
+    """
+    accept = request.headers.get("accept", "")
+    if any(media_type in accept for media_type in MSGPACK_MEDIA_TYPES):
+        return MsgpackResponse(content, status_code=status_code)
+    return ORJSONResponse(content, status_code=status_code)
+
+
+def wallet_body(wallet, timestamp: str = "enabled_at") -> dict:
+    """
+    A wallet as returned by the wallet endpoints; `timestamp` is enabled_at or disabled_at
+    """
+    return {
+        "id": wallet.id,
+        "owned_by": wallet.customer_xid,
+        "status": wallet.status,
+        timestamp: getattr(wallet, timestamp),
+        "balance": int(wallet.balance)
+    }
+
+
+def deposit_body(transaction, customer_xid: str) -> dict:
+    return {
+        "id": transaction.id,
+        "deposited_by": customer_xid,
+        "status": transaction.status,
+        "deposited_at": transaction.transacted_at,
+        "amount": int(transaction.amount),
+        "reference_id": transaction.reference_id
+    }
+
+
+def withdrawal_body(transaction, customer_xid: str) -> dict:
+    return {
+        "id": transaction.id,
+        "withdrawn_by": customer_xid,
+        "status": transaction.status,
+        "withdrawn_at": transaction.transacted_at,
+        "amount": int(transaction.amount),
+        "reference_id": transaction.reference_id
+    }
+
+
+def transaction_list(transactions) -> list:
+    return [
+        {
+            "id": transaction.id,
+            "status": transaction.status,
+            "transacted_at": transaction.transacted_at,
+            "type": transaction.type,
+            "amount": int(transaction.amount),
+            "reference_id": transaction.reference_id
+        }
+        for transaction in transactions
+    ]
+
+
+def ndjson_rows(rows) -> bytes:
+    """
+    One NDJSON line per exported row, with the amounts unrounded
+    """
+    dumps = orjson.dumps
+    option = orjson.OPT_APPEND_NEWLINE
+    return b"".join(
+        dumps({
+            "id": row.id,
+            "status": row.status,
+            "transacted_at": row.transacted_at,
+            "type": row.type,
+            "amount": row.amount,
+            "reference_id": row.reference_id,
+            "balance_after": row.balance_after
+        }, option=option)
+        for row in rows
+    )
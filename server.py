@@ -0,0 +1,96 @@
+"""
+Production entry point for the wallet API.
+
+    python server.py                  # one worker per available core, uvloop + httptools
+    python server.py --workers 4
+    python server.py --dev            # single process with auto-reload, for local development
+
+Pending schema migrations are applied once here before the workers start (see migrations.py), so they do not
+race each other on startup. Workers are separate processes with their own caches, metrics and group-commit writer.
+SIGTERM and SIGINT stop accepting connections and let in-flight requests finish for up to --graceful-shutdown
+seconds; the app's shutdown handlers then flush the group-commit queue.
+"""
+import argparse
+import os
+import sys
+
+import uvicorn
+
+
+def default_workers() -> int:
+    """
+    One worker per core this process may run on, which respects CPU pinning and container cpusets
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def _env_int(name: str, default):
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default=os.getenv("WALLET_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=_env_int("WALLET_PORT", 8000))
+    parser.add_argument("--workers", type=int, default=_env_int("WALLET_WORKERS", 0),
+                        help="worker processes, 0 for one per available core")
+    parser.add_argument("--keep-alive", type=int, default=_env_int("WALLET_KEEP_ALIVE", 5),
+                        help="seconds an idle keep-alive connection stays open")
+    parser.add_argument("--backlog", type=int, default=_env_int("WALLET_BACKLOG", 2048),
+                        help="pending connections the listening socket queues")
+    parser.add_argument("--limit-concurrency", type=int, default=_env_int("WALLET_LIMIT_CONCURRENCY", None),
+                        help="connections plus tasks per worker before new requests get 503")
+    parser.add_argument("--graceful-shutdown", type=int, default=_env_int("WALLET_GRACEFUL_SHUTDOWN", 30),
+                        help="seconds in-flight requests get to finish on shutdown")
+    parser.add_argument("--no-migrate", dest="migrate", action="store_false",
+                        help="do not apply pending schema migrations before starting")
+    parser.add_argument("--dev", action="store_true", help="single process with auto-reload and the default loop")
+    return parser.parse_args(argv)
+
+
+def server_options(args) -> dict:
+    """
+    Keyword arguments for uvicorn.run built from the parsed command line
+    """
+    options = {
+        "host": args.host,
+        "port": args.port,
+        "timeout_keep_alive": args.keep_alive,
+        "backlog": args.backlog,
+        "limit_concurrency": args.limit_concurrency,
+        "timeout_graceful_shutdown": args.graceful_shutdown,
+    }
+    if args.dev:
+        return {**options, "reload": True}
+    return {
+        **options,
+        "workers": args.workers or default_workers(),
+        "loop": "uvloop",
+        "http": "httptools",
+        "proxy_headers": True,
+        "server_header": False,
+    }
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    options = server_options(args)
+    if not args.dev:
+        for module in ("uvloop", "httptools"):
+            try:
+                __import__(module)
+            except ImportError:
+                sys.exit(f"{module} is not installed, run pip install -r requirements.txt or use --dev")
+
+    if args.migrate:
+        from migrations import migrate_all
+        migrate_all()
+
+    uvicorn.run("main:app", **options)
+
+
+if __name__ == "__main__":
+    main()
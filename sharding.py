@@ -0,0 +1,215 @@
+"""
+Routing of wallets across the database shards in database.shards.
+
+A new wallet is placed on shard crc32(wallet id) % shard count, and its token starts with that shard
+("3.9f0c..."). Tokens minted before sharding have no prefix and belong to shard 0, where all wallets lived.
+When a wallet is moved, a WalletDirectory row on the token's home shard records where it went, so resolving a
+token costs at most one primary-key lookup on a cold token and nothing on a warm one.
+"""
+import os
+import secrets
+import zlib
+from collections import deque
+from datetime import datetime
+
+from sqlalchemy import delete, insert, select
+
+import models
+from cache import TTLCache, wallet_cache
+from commons import scope_token
+from crud import WalletNotFound
+from database import begin_write, shards
+from serializers import ORJSONResponse
+
+COPY_CHUNK_SIZE = 5000
+
+# token -> shard currently holding its wallet
+shard_routes = TTLCache(maxsize=100000, ttl=float(os.getenv("WALLET_SHARD_ROUTE_TTL", "30")))
+
+
+def shard_for_wallet(wallet_id: str, shard_count: int = None) -> int:
+    return zlib.crc32(wallet_id.encode()) % (shard_count or len(shards))
+
+
+def mint_token(shard: int) -> str:
+    token = secrets.token_hex(20)
+    return token if len(shards) == 1 else f"{shard}.{token}"
+
+
+def home_shard(token: str) -> int:
+    """
+    The shard a token was minted on
+    """
+    prefix, separator, _ = token.partition(".")
+    if separator and prefix.isdigit() and int(prefix) < len(shards):
+        return int(prefix)
+    return 0
+
+
+async def resolve_shard(token: str) -> int:
+    """
+    The shard currently holding the wallet of `token`
+    """
+    if len(shards) == 1:
+        return 0
+    shard = shard_routes.get(token)
+    if shard is not None:
+        return shard
+
+    shard = home_shard(token)
+    async with shards[shard].read_sessions() as db:
+        moved = (await db.execute(
+            select(models.WalletDirectory.shard).filter(models.WalletDirectory.token == token))).scalar_one_or_none()
+    if moved is not None:
+        shard = moved
+    shard_routes.set(token, shard)
+    return shard
+
+
+async def move_wallet(wallet_id: str, source: int, target: int) -> bool:
+    """
+    Copy a wallet with its transactions, references, checkpoints, rollups and archive manifest from shard
+    `source` to shard `target`, point its token at the target and delete it from the source. The source shard
+    stays locked for writes while the wallet is copied, so nothing written to it is lost. Rerunning after an
+    interruption is safe: a copy left on the target is replaced, and a source row the directory already points
+    away from is only deleted. Archived transactions stay where they are, archive databases are shared by all
+    shards.
+
+    Returns False when the wallet is not on the source shard.
+    """
+    tables = [models.Transaction.__table__, models.TransactionReference.__table__,
+              models.BalanceCheckpoint.__table__, models.DailyRollup.__table__, models.ArchivedMonth.__table__]
+
+    async with shards[source].sessions() as source_db:
+        await begin_write(source_db)
+        wallet = (await source_db.execute(
+            select(models.Wallet.__table__).filter(models.Wallet.id == wallet_id))).mappings().one_or_none()
+        if wallet is None:
+            return False
+        token = wallet["token"]
+        home = home_shard(token)
+
+        if await _current_shard(token, home, source_db if home == source else None) == source:
+            async with shards[target].sessions() as target_db:
+                await begin_write(target_db)
+                for table in reversed(tables):
+                    await target_db.execute(delete(table).where(table.c.wallet_id == wallet_id))
+                await target_db.execute(delete(models.Wallet).where(models.Wallet.id == wallet_id))
+                await target_db.execute(insert(models.Wallet.__table__), [dict(wallet)])
+                for table in tables:
+                    if table is models.DailyRollup.__table__:
+                        # Copied transactions may have filled rollups on the target already (see
+                        # models.DAILY_ROLLUP_TRIGGER); the source's also cover archived transactions.
+                        await target_db.execute(delete(table).where(table.c.wallet_id == wallet_id))
+                    result = await source_db.stream(
+                        select(table).where(table.c.wallet_id == wallet_id).execution_options(
+                            yield_per=COPY_CHUNK_SIZE))
+                    async for rows in result.mappings().partitions():
+                        copied = [dict(row) for row in rows]
+                        if table is models.TransactionReference.__table__:
+                            # Numbered anew on the target, which also shows reconcile.py the wallet has changed.
+                            for row in copied:
+                                del row["sequence"]
+                        await target_db.execute(insert(table), copied)
+                await target_db.commit()
+
+            if home == source:
+                await _point_token(source_db, token, wallet_id, target, home)
+            else:
+                async with shards[home].sessions() as home_db:
+                    await _point_token(home_db, token, wallet_id, target, home)
+                    await home_db.commit()
+
+        for table in tables:
+            await source_db.execute(delete(table).where(table.c.wallet_id == wallet_id))
+        await source_db.execute(delete(models.Wallet).where(models.Wallet.id == wallet_id))
+        await source_db.commit()
+
+    shard_routes.invalidate(token)
+    wallet_cache.invalidate(token)
+    return True
+
+
+async def _current_shard(token: str, home: int, home_db=None) -> int:
+    query = select(models.WalletDirectory.shard).filter(models.WalletDirectory.token == token)
+    if home_db is not None:
+        moved = (await home_db.execute(query)).scalar_one_or_none()
+    else:
+        async with shards[home].sessions() as db:
+            moved = (await db.execute(query)).scalar_one_or_none()
+    return home if moved is None else moved
+
+
+async def _point_token(home_db, token: str, wallet_id: str, target: int, home: int):
+    await home_db.execute(delete(models.WalletDirectory).where(models.WalletDirectory.token == token))
+    if target != home:
+        home_db.add(models.WalletDirectory(token=token, wallet_id=wallet_id, shard=target, moved_at=datetime.now()))
+        await home_db.flush()
+
+
+async def misplaced_wallets(shard: int):
+    """
+    Ids of the wallets on `shard` whose id hashes to another shard, as (wallet id, target shard) pairs
+    """
+    async with shards[shard].read_sessions() as db:
+        ids = (await db.execute(select(models.Wallet.id))).scalars().all()
+    return [(wallet_id, shard_for_wallet(wallet_id)) for wallet_id in ids if shard_for_wallet(wallet_id) != shard]
+
+
+class StaleRouteMiddleware:
+    """
+    ASGI middleware answering crud.WalletNotFound with 404 Wallet not found. With several shards the request is
+    first run once more: another process may have moved the wallet since this one cached its route, so the
+    token's route and auth cache entry are dropped and the token is resolved again through the wallet directory.
+    The request body is kept for the second run. A response that has already started is never run again.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        token = scope_token(scope)
+        if token is not None and len(shards) > 1:
+            received = []
+
+            async def recording_receive():
+                message = await receive()
+                received.append(message)
+                return message
+
+            if not await self._run(scope, recording_receive, send):
+                return
+            shard_routes.invalidate(token)
+            wallet_cache.invalidate(token)
+            replayed = deque(received)
+
+            async def replaying_receive():
+                return replayed.popleft() if replayed else await receive()
+
+            receive = replaying_receive
+
+        if await self._run(scope, receive, send):
+            response = ORJSONResponse(status_code=404, content={"detail": "Wallet not found"})
+            await response(scope, receive, send)
+
+    async def _run(self, scope, receive, send) -> bool:
+        """
+        Runs the request; True when it found no wallet before starting its response
+        """
+        started = False
+
+        async def tracking_send(message):
+            nonlocal started
+            started = True
+            await send(message)
+
+        try:
+            await self.app(scope, receive, tracking_send)
+        except WalletNotFound:
+            if started:
+                raise
+            return True
+        return False
@@ -0,0 +1,84 @@
+import asyncio
+
+import httpx
+import pytest
+
+from admission import AdmissionMiddleware, RateLimiter, WriteGate
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_rate_limiter_refills_and_stays_bounded():
+    clock = FakeClock()
+    limiter = RateLimiter(rate=2, burst=2, maxsize=2, clock=clock)
+
+    assert limiter.acquire("a") == 0 and limiter.acquire("a") == 0
+    assert limiter.acquire("a") == pytest.approx(0.5)
+    clock.now = 0.25
+    assert limiter.acquire("a") == pytest.approx(0.25)
+    clock.now = 0.5
+    assert limiter.acquire("a") == 0
+    assert (limiter.allowed, limiter.limited) == (3, 2)
+
+    limiter.acquire("b")
+    limiter.acquire("c")
+    assert len(limiter) == 2 and limiter.evictions == 1
+    assert limiter.acquire("a") == 0, "an evicted key starts with a full bucket"
+
+
+@pytest.mark.anyio
+async def test_write_gate_queues_in_order_then_sheds():
+    gate = WriteGate(limit=1, max_queue=1, max_wait=0.2)
+    first = await gate.acquire()
+    assert gate.refusal() is None
+
+    second = asyncio.create_task(gate.acquire())
+    await asyncio.sleep(0)
+    assert gate.waiting == 1
+    assert gate.refusal()[0] == "queue_full"
+
+    gate.release(first)
+    assert await second is not None
+    assert (gate.active, gate.waiting) == (1, 0)
+
+    assert await gate.acquire() is None
+    assert gate.shed == {"queue_full": 1, "overloaded": 0, "timeout": 1}
+
+    gate.hold_seconds = 1.0
+    assert gate.refusal()[0] == "overloaded"
+    gate.release(gate.clock())
+    assert gate.active == 0 and gate.refusal() is None
+
+
+@pytest.mark.anyio
+async def test_middleware_answers_429_and_503_with_retry_after():
+    release = asyncio.Event()
+
+    async def app(scope, receive, send):
+        if scope["method"] == "POST":
+            await release.wait()
+        await send({"type": "http.response.start", "status": 200, "headers": []})
+        await send({"type": "http.response.body", "body": b"ok"})
+
+    limiter = RateLimiter(rate=1, burst=1, maxsize=10)
+    gate = WriteGate(limit=1, max_queue=0, max_wait=1)
+    async with httpx.AsyncClient(app=AdmissionMiddleware(app, limiter, gate), base_url="http://test") as client:
+        assert (await client.get("/", headers={"Authorization": "Token noisy"})).status_code == 200
+        limited = await client.get("/", headers={"Authorization": "Token noisy"})
+        assert limited.status_code == 429 and limited.headers["Retry-After"] == "1"
+        assert (await client.get("/")).status_code == 200
+
+        write = asyncio.create_task(client.post("/"))
+        while not gate.active:
+            await asyncio.sleep(0)
+        shed = await client.post("/")
+        assert shed.status_code == 503 and "Retry-After" in shed.headers
+        release.set()
+        assert (await write).status_code == 200
+    assert gate.active == 0
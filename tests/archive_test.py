@@ -0,0 +1,101 @@
+import uuid
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, select, update
+
+import archive
+import crud
+import models
+import schemas
+
+OLD_TIMES = [datetime(2020, 1, 10), datetime(2020, 1, 20), datetime(2020, 1, 30),
+             datetime(2020, 2, 10), datetime(2020, 2, 20), datetime(2020, 2, 28)]
+CUTOFF = datetime(2021, 1, 1)
+
+
+@pytest.fixture
+async def ledger(session_factory, enabled_wallet, monkeypatch, tmp_path):
+    """
+    Eight deposits of 10, 20, ... 80, the first six moved back into January and February 2020. Returns the
+    ledger oldest first, as it reads before archiving.
+    """
+    monkeypatch.setenv("WALLET_ARCHIVE_DIR", str(tmp_path / "archive"))
+    async with session_factory() as db:
+        for amount in range(10, 90, 10):
+            await crud.add_deposit(db, enabled_wallet, amount, str(uuid.uuid4()))
+        rows = [partition async for partition in crud.stream_transactions(db, enabled_wallet)][0]
+        for row, transacted_at in zip(rows, OLD_TIMES):
+            await db.execute(update(models.Transaction).where(models.Transaction.id == row.id)
+                             .values(transacted_at=transacted_at))
+        await db.commit()
+        ledger = [partition async for partition in crud.stream_transactions(db, enabled_wallet)][0]
+    yield ledger
+    await archive.dispose_engines()
+
+
+async def _all_pages(session_factory, wallet, limit):
+    ids, after = [], None
+    async with session_factory() as db:
+        while True:
+            page = await archive.get_transactions_page(db, wallet, limit=limit + 1, after=after)
+            ids += [transaction.id for transaction in page[:limit]]
+            if len(page) <= limit:
+                return ids
+            after = (page[limit - 1].transacted_at, page[limit - 1].id)
+
+
+@pytest.mark.anyio
+async def test_archived_transactions_leave_the_hot_table_but_not_the_history(session_factory, enabled_wallet,
+                                                                             ledger):
+    assert await archive.archive_transactions(session_factory, CUTOFF, dry_run=True) == 6
+    assert await archive.archive_transactions(session_factory, CUTOFF) == 6
+    assert await archive.archive_transactions(session_factory, CUTOFF) == 0
+
+    async with session_factory() as db:
+        assert (await db.execute(select(func.count()).select_from(models.Transaction))).scalar() == 2
+        months = await archive.archived_months(db, enabled_wallet.id, newest_first=False)
+        assert [(month.month, month.transaction_count) for month in months] == [("2020-01", 3), ("2020-02", 3)]
+
+        exported = [row.id async for partition in archive.stream_transactions(db, enabled_wallet, partition_size=2)
+                    for row in partition]
+        assert exported == [row.id for row in ledger]
+
+        assert await archive.get_balance_at(db, enabled_wallet, datetime(2020, 1, 25)) == ("enabled", 30)
+        assert await archive.get_balance_at(db, enabled_wallet, datetime(2020, 12, 31)) == ("enabled", 210)
+        assert await archive.get_balance_at(db, enabled_wallet, datetime(2019, 12, 31)) == ("enabled", 0)
+        assert await crud.get_checkpoint_balance_at(db, enabled_wallet, datetime(2020, 12, 31)) == 210
+
+    assert await _all_pages(session_factory, enabled_wallet, limit=3) == [row.id for row in reversed(ledger)]
+
+
+@pytest.mark.anyio
+async def test_rows_copied_by_an_interrupted_run_are_not_read_twice(session_factory, enabled_wallet, ledger):
+    assert await archive.archive_transactions(session_factory, datetime(2020, 2, 1)) == 3
+    # The next run stopped after appending to the archive, before removing the rows from the hot table.
+    await archive._append_to_archives([dict(row._mapping) for row in ledger[3:6]])
+
+    assert await _all_pages(session_factory, enabled_wallet, limit=4) == [row.id for row in reversed(ledger)]
+
+    assert await archive.archive_transactions(session_factory, CUTOFF) == 3
+    assert await _all_pages(session_factory, enabled_wallet, limit=4) == [row.id for row in reversed(ledger)]
+
+
+@pytest.mark.anyio
+async def test_archived_references_are_still_replayed(session_factory, enabled_wallet, ledger):
+    assert await archive.archive_transactions(session_factory, CUTOFF) == 6
+    first, second = ledger[0], ledger[1]
+
+    async with session_factory() as db:
+        replayed = await crud.add_deposit(db, enabled_wallet, first.amount, first.reference_id)
+        assert (replayed.id, replayed.balance_after) == (first.id, first.balance_after)
+        with pytest.raises(ValueError, match="Reference ID already exists"):
+            await crud.make_withdrawal(db, enabled_wallet, first.amount, first.reference_id)
+
+        results = await crud.apply_batch(db, enabled_wallet, [
+            schemas.BatchItem(type="deposit", amount=second.amount, reference_id=second.reference_id)])
+        assert results[0].transaction.id == second.id
+
+    async with session_factory() as db:
+        assert (await crud.get_wallet(db, enabled_wallet.id)).balance == 360
+        assert (await db.execute(select(func.count()).select_from(models.Transaction))).scalar() == 2
@@ -0,0 +1,68 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+# Tests that go through the app's own engines use a throwaway database, set before database.py reads it.
+APP_DATABASE_DIRECTORY = tempfile.mkdtemp()
+os.environ["WALLET_DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(APP_DATABASE_DIRECTORY, 'wallet.db')}"
+
+from cache import wallet_cache, wallet_versions  # noqa: E402
+from database import Base, make_engine  # noqa: E402
+from migrations import migrate_all  # noqa: E402
+import models  # noqa: F401,E402  registers the tables on Base.metadata
+
+
+@pytest.fixture(scope="session", autouse=True)
+def app_database():
+    migrate_all()
+    yield
+    shutil.rmtree(APP_DATABASE_DIRECTORY, ignore_errors=True)
+
+
+@pytest.fixture
+def anyio_backend():
+    return "asyncio"
+
+
+@pytest.fixture(autouse=True)
+def clear_wallet_cache():
+    wallet_cache.clear()
+    wallet_versions.clear()
+    yield
+    wallet_cache.clear()
+    wallet_versions.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_rate_limiter():
+    """
+    Tests share a handful of tokens, so every test starts with full buckets
+    """
+    main = sys.modules.get("main")
+    if main is not None and main.rate_limiter is not None:
+        main.rate_limiter.clear()
+
+
+@pytest.fixture
+async def session_factory(tmp_path):
+    """
+    Session factory bound to a throwaway SQLite database with the full schema
+    """
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'wallet_test.db'}")
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.create_all)
+    yield async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    await engine.dispose()
+
+
+@pytest.fixture
+async def enabled_wallet(session_factory):
+    async with session_factory() as db:
+        wallet = models.Wallet(customer_xid="test_customer_xid", token="test_token", status="enabled", balance=0)
+        db.add(wallet)
+        await db.commit()
+        return wallet
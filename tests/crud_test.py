@@ -1,8 +1,13 @@
+import asyncio
 from unittest import mock
-from datetime import datetime
-from sqlalchemy.orm import Session
+from datetime import datetime, timedelta
+import pytest
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
 import crud
+import schemas
 import models
+from metrics import QueryCounter
 
 
 def get_mock_wallet():
@@ -25,32 +30,319 @@ def get_mock_transaction():
     )
 
 
-def test_create_wallet():
-    with mock.patch.object(Session, 'add', return_value=None) as mock_add, \
-            mock.patch.object(Session, 'commit', return_value=None) as mock_commit, \
-            mock.patch.object(Session, 'refresh', return_value=None) as mock_refresh:
-        db = Session()
-        wallet = crud.create_wallet(db, "test_customer_xid", "test_token")
+@pytest.mark.anyio
+async def test_create_wallet():
+    with mock.patch.object(AsyncSession, 'add', return_value=None) as mock_add, \
+            mock.patch.object(AsyncSession, 'commit', return_value=None) as mock_commit, \
+            mock.patch.object(AsyncSession, 'refresh', return_value=None) as mock_refresh:
+        db = AsyncSession()
+        wallet = await crud.create_wallet(db, "test_customer_xid", "test_token")
 
         assert wallet.customer_xid == "test_customer_xid"
         assert wallet.token == "test_token"
 
 
-def test_get_wallet_by_token():
-    with mock.patch.object(Session, 'query', return_value=mock.MagicMock(filter=mock.MagicMock(
-            return_value=mock.MagicMock(one_or_none=mock.MagicMock(return_value=get_mock_wallet()))))):
-        db = Session()
-        wallet = crud.get_wallet_by_token(db, "test_token")
+@pytest.mark.anyio
+async def test_get_wallet_by_token():
+    with mock.patch.object(AsyncSession, 'execute', return_value=mock.MagicMock(
+            scalar_one_or_none=mock.MagicMock(return_value=get_mock_wallet()))):
+        db = AsyncSession()
+        wallet = await crud.get_wallet_by_token(db, "test_token")
 
         assert wallet.token == "test_token"
 
 
-def test_get_enable_wallet():
-    with mock.patch.object(Session, 'commit', return_value=None) as mock_commit, \
-            mock.patch.object(Session, 'refresh', return_value=None) as mock_refresh:
-        db = Session()
+@pytest.mark.anyio
+async def test_get_enable_wallet():
+    with mock.patch.object(AsyncSession, 'commit', return_value=None) as mock_commit, \
+            mock.patch.object(AsyncSession, 'refresh', return_value=None) as mock_refresh, \
+            mock.patch.object(AsyncSession, 'connection', return_value=None):
+        db = AsyncSession()
         wallet = get_mock_wallet()
         wallet.status = "disabled"
-        enabled_wallet = crud.get_enable_wallet(db, wallet)
+        enabled_wallet = await crud.get_enable_wallet(db, wallet)
 
         assert enabled_wallet.status == "enabled"
+
+
+@pytest.mark.anyio
+async def test_add_deposit_updates_balance_atomically(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        transaction = await crud.add_deposit(db, enabled_wallet, 150, "ref_deposit")
+
+        assert transaction.type == "deposit"
+        wallet = await crud.get_wallet(db, enabled_wallet.id)
+        assert wallet.balance == 150
+
+
+@pytest.mark.anyio
+async def test_make_withdrawal_insufficient_balance_leaves_no_transaction(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        wallet = await crud.get_wallet_by_token(db, "test_token")
+        with pytest.raises(ValueError, match="Insufficient balance"):
+            await crud.make_withdrawal(db, wallet, 10, "ref_withdrawal")
+
+    async with session_factory() as db:
+        assert await crud.get_transactions_page(db, enabled_wallet, limit=10) == []
+
+
+@pytest.mark.anyio
+async def test_concurrent_withdrawals_cannot_overdraw(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        await crud.add_deposit(db, enabled_wallet, 100, "ref_seed")
+
+    async def withdraw(reference_id):
+        async with session_factory() as db:
+            try:
+                await crud.make_withdrawal(db, enabled_wallet, 60, reference_id)
+                return True
+            except ValueError:
+                return False
+
+    results = await asyncio.gather(withdraw("ref_a"), withdraw("ref_b"))
+
+    assert results.count(True) == 1
+    async with session_factory() as db:
+        wallet = await crud.get_wallet_by_token(db, "test_token")
+        assert wallet.balance == 40
+
+
+@pytest.mark.anyio
+async def test_retried_deposit_replays_original_transaction(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        original = await crud.add_deposit(db, enabled_wallet, 150, "ref_retry")
+
+    async with session_factory() as db:
+        replayed = await crud.add_deposit(db, enabled_wallet, 150, "ref_retry")
+
+        assert replayed.id == original.id
+        wallet = await crud.get_wallet_by_token(db, "test_token")
+        assert wallet.balance == 150
+
+
+@pytest.mark.anyio
+async def test_deposit_inserts_its_row_with_the_running_balance(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        await crud.add_deposit(db, enabled_wallet, 100, "ref_first")
+
+    with QueryCounter(session_factory.kw["bind"]) as queries:
+        async with session_factory() as db:
+            transaction = await crud.add_deposit(db, enabled_wallet, 50, "ref_second")
+
+    assert transaction.balance_after == 150
+    writes = [statement.split()[:3] for statement, _ in queries.statements
+              if statement.startswith(("INSERT", "UPDATE"))]
+    assert writes[:3] == [["UPDATE", "wallets", "SET"], ["INSERT", "INTO", "transaction_references"],
+                          ["INSERT", "INTO", "transactions"]]
+    assert ["UPDATE", "transactions", "SET"] not in writes
+
+
+@pytest.mark.anyio
+async def test_retry_with_a_wallet_loaded_in_the_same_session(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        wallet = await crud.get_wallet(db, enabled_wallet.id)
+        original = await crud.add_deposit(db, wallet, 150, "ref_same_session")
+
+        assert (await crud.add_deposit(db, wallet, 150, "ref_same_session")).id == original.id
+        assert (await crud.get_wallet(db, enabled_wallet.id)).balance == 150
+
+
+@pytest.mark.anyio
+async def test_reference_id_reused_for_other_operation_is_rejected(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        await crud.add_deposit(db, enabled_wallet, 150, "ref_reused")
+
+    async with session_factory() as db:
+        with pytest.raises(ValueError, match="Reference ID already exists"):
+            await crud.make_withdrawal(db, enabled_wallet, 150, "ref_reused")
+
+
+@pytest.mark.anyio
+async def test_reference_ids_are_unique_per_wallet(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        other = await crud.create_wallet(db, "other_customer", "other_token")
+        other.status = crud.WalletStatus.ENABLED.value
+        await db.commit()
+        await crud.add_deposit(db, enabled_wallet, 150, "ref_shared")
+        shared = await crud.add_deposit(db, other, 40, "ref_shared")
+
+    assert shared.wallet_id == other.id
+    async with session_factory() as db:
+        assert (await crud.get_wallet(db, enabled_wallet.id)).balance == 150
+        assert (await crud.get_wallet(db, other.id)).balance == 40
+
+
+@pytest.mark.anyio
+async def test_get_transactions_page_walks_keyset_and_filters(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        for index in range(5):
+            await crud.add_deposit(db, enabled_wallet, 100, f"ref_deposit_{index}")
+        await crud.make_withdrawal(db, enabled_wallet, 50, "ref_withdrawal")
+
+    async with session_factory() as db:
+        seen = []
+        after = None
+        while True:
+            page = await crud.get_transactions_page(db, enabled_wallet, limit=2, after=after)
+            if not page:
+                break
+            seen.extend(page)
+            after = (page[-1].transacted_at, page[-1].id)
+
+        assert len(seen) == 6
+        assert len({transaction.id for transaction in seen}) == 6
+        assert [t.transacted_at for t in seen] == sorted((t.transacted_at for t in seen), reverse=True)
+
+        withdrawals = await crud.get_transactions_page(db, enabled_wallet, limit=10, transaction_type="withdrawal")
+        assert [transaction.reference_id for transaction in withdrawals] == ["ref_withdrawal"]
+
+        large = await crud.get_transactions_page(db, enabled_wallet, limit=10, min_amount=75)
+        assert len(large) == 5
+
+
+@pytest.mark.anyio
+async def test_stream_transactions_yields_ledger_in_partitions(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        for index in range(5):
+            await crud.add_deposit(db, enabled_wallet, 100, f"ref_stream_{index}")
+
+    async with session_factory() as db:
+        partitions = [partition async for partition in crud.stream_transactions(db, enabled_wallet, partition_size=2)]
+
+        assert [len(partition) for partition in partitions] == [2, 2, 1]
+        assert [row.reference_id for partition in partitions for row in partition] == [
+            f"ref_stream_{index}" for index in range(5)]
+
+
+@pytest.mark.anyio
+async def test_get_wallet_identity_is_cached_until_status_changes(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        identity = await crud.get_wallet_identity(db, "test_token")
+        assert identity.status == "enabled"
+
+        with mock.patch.object(AsyncSession, 'execute') as mock_execute:
+            assert await crud.get_wallet_identity(db, "test_token") == identity
+            mock_execute.assert_not_called()
+
+        wallet = await crud.get_wallet_by_token(db, "test_token")
+        await crud.disable_wallet(db, wallet)
+
+        assert (await crud.get_wallet_identity(db, "test_token")).status == "disabled"
+        assert crud.cached_wallet_identity("test_token") is None
+
+
+@pytest.mark.anyio
+async def test_reads_see_a_status_change_made_by_another_worker(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        identity = await crud.get_wallet_identity(db, "test_token")
+        # Another worker disables the wallet; this worker's cache still holds it as enabled.
+        await db.execute(update(models.Wallet).where(models.Wallet.id == enabled_wallet.id).values(status="disabled"))
+        await db.commit()
+
+        assert (await crud.get_balance_at(db, identity, datetime.now())).status == "disabled"
+        assert [row.status for row in await crud.get_summary(db, identity)] == ["disabled"]
+
+        # A disabled wallet is never cached, so enabling it elsewhere is seen on the next lookup.
+        assert (await crud.get_wallet_state(db, "test_token")).status == "disabled"
+        await db.execute(update(models.Wallet).where(models.Wallet.id == enabled_wallet.id).values(status="enabled"))
+        await db.commit()
+        assert (await crud.get_wallet_identity(db, "test_token")).status == "enabled"
+
+
+@pytest.mark.anyio
+async def test_every_mutation_bumps_the_wallet_version(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        assert await crud.get_wallet_version(db, enabled_wallet.id) == 0
+
+        await crud.add_deposit(db, enabled_wallet, 100, "ref_version_deposit")
+        assert crud.cached_wallet_version(enabled_wallet.id) == 1
+        await crud.make_withdrawal(db, enabled_wallet, 40, "ref_version_withdrawal")
+        await crud.apply_batch(db, enabled_wallet, [
+            schemas.BatchItem(type="deposit", amount=5, reference_id="ref_version_batch_1"),
+            schemas.BatchItem(type="deposit", amount=5, reference_id="ref_version_batch_2")])
+        assert crud.cached_wallet_version(enabled_wallet.id) == 3
+
+        with pytest.raises(ValueError):
+            await crud.make_withdrawal(db, enabled_wallet, 1000, "ref_version_overdraw")
+        assert await crud.get_wallet_version(db, enabled_wallet.id) == 3
+
+        wallet = await crud.get_wallet_by_token(db, "test_token")
+        await crud.disable_wallet(db, wallet)
+        assert crud.cached_wallet_version(enabled_wallet.id) is None
+        assert await crud.get_wallet_version(db, enabled_wallet.id) == 4
+        await crud.get_enable_wallet(db, wallet)
+        assert await crud.get_wallet_version(db, enabled_wallet.id) == 5
+
+
+@pytest.mark.anyio
+async def test_apply_batch_reports_each_item_and_moves_net_balance(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        await crud.add_deposit(db, enabled_wallet, 100, "ref_existing")
+
+    items = [
+        schemas.BatchItem(type="deposit", amount=50, reference_id="ref_batch_1"),
+        schemas.BatchItem(type="withdrawal", amount=500, reference_id="ref_batch_2"),
+        schemas.BatchItem(type="withdrawal", amount=120, reference_id="ref_batch_3"),
+        schemas.BatchItem(type="deposit", amount=100, reference_id="ref_existing"),
+        schemas.BatchItem(type="deposit", amount=10, reference_id="ref_batch_1"),
+    ]
+    async with session_factory() as db:
+        results = await crud.apply_batch(db, enabled_wallet, items)
+
+    assert [result.error for result in results] == [
+        None, "Insufficient balance", None, None, "Reference ID already exists"]
+    async with session_factory() as db:
+        wallet = await crud.get_wallet(db, enabled_wallet.id)
+        assert wallet.balance == 30
+        page = await crud.get_transactions_page(db, enabled_wallet, limit=10)
+        assert len(page) == 3
+
+
+@pytest.mark.anyio
+async def test_running_balance_answers_point_in_time_queries(session_factory, enabled_wallet, monkeypatch):
+    monkeypatch.setattr(crud, "CHECKPOINT_INTERVAL", 2)
+    async with session_factory() as db:
+        first = await crud.add_deposit(db, enabled_wallet, 100, "ref_first")
+        second = await crud.make_withdrawal(db, enabled_wallet, 30, "ref_second")
+        results = await crud.apply_batch(db, enabled_wallet, [
+            schemas.BatchItem(type="deposit", amount=5, reference_id="ref_third"),
+            schemas.BatchItem(type="deposit", amount=5, reference_id="ref_fourth"),
+        ])
+
+    assert (first.balance_after, second.balance_after) == (100, 70)
+    assert [result.transaction.balance_after for result in results] == [75, 80]
+    async with session_factory() as db:
+        assert await crud.get_balance_at(db, enabled_wallet, first.transacted_at - timedelta(seconds=1)) == (
+            "enabled", 0)
+        assert await crud.get_balance_at(db, enabled_wallet, first.transacted_at) == ("enabled", 100)
+        assert await crud.get_balance_at(db, enabled_wallet, second.transacted_at) == ("enabled", 70)
+        assert await crud.get_balance_at(db, enabled_wallet, datetime.now()) == ("enabled", 80)
+
+        checkpoints = (await db.execute(
+            select(models.BalanceCheckpoint).order_by(models.BalanceCheckpoint.transaction_count))).scalars().all()
+        assert [(checkpoint.transaction_count, checkpoint.balance) for checkpoint in checkpoints] == [(2, 70), (4, 80)]
+
+
+@pytest.mark.anyio
+async def test_rollups_are_maintained_and_rebuilt(session_factory, enabled_wallet):
+    async with session_factory() as db:
+        await crud.add_deposit(db, enabled_wallet, 100, "ref_deposit_1")
+        await crud.add_deposit(db, enabled_wallet, 50, "ref_deposit_2")
+        await crud.make_withdrawal(db, enabled_wallet, 30, "ref_withdrawal")
+        await crud.apply_batch(db, enabled_wallet, [
+            schemas.BatchItem(type="deposit", amount=5, reference_id="ref_batch_1"),
+            schemas.BatchItem(type="withdrawal", amount=5, reference_id="ref_batch_2"),
+        ])
+
+    today = datetime.now().date()
+    async with session_factory() as db:
+        maintained = {row.type: (row.total_amount, row.transaction_count)
+                      for row in await crud.get_summary(db, enabled_wallet, from_day=today, to_day=today)}
+        assert maintained == {"deposit": (155, 3), "withdrawal": (35, 2)}
+        assert await crud.get_summary(db, enabled_wallet, to_day=today - timedelta(days=1)) == [
+            ("enabled", None, None, None)]
+
+        assert await crud.rebuild_rollups(db) == 2
+        rebuilt = {row.type: (row.total_amount, row.transaction_count)
+                   for row in await crud.get_summary(db, enabled_wallet)}
+        assert rebuilt == maintained
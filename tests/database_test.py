@@ -0,0 +1,154 @@
+import anyio
+import pytest
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import BEGIN_IMMEDIATE, WRITE_TURN, begin_write, make_engine, read_only_url, pin_to_primary, \
+    is_pinned_to_primary, recent_writers
+
+
+@pytest.fixture(autouse=True)
+def clear_recent_writers():
+    recent_writers.clear()
+    yield
+    recent_writers.clear()
+
+
+@pytest.mark.anyio
+async def test_sqlite_wal_profile_applies_pragmas(tmp_path, monkeypatch):
+    monkeypatch.setenv("WALLET_SQLITE_BUSY_TIMEOUT", "1234")
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'profile.db'}", profile="sqlite-wal")
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA journal_mode"))).scalar() == "wal"
+        assert (await conn.execute(text("PRAGMA synchronous"))).scalar() == 1
+        assert (await conn.execute(text("PRAGMA busy_timeout"))).scalar() == 1234
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_sqlite_default_profile_keeps_driver_settings(tmp_path):
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'profile.db'}", profile="sqlite-default")
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("PRAGMA journal_mode"))).scalar() == "delete"
+    await engine.dispose()
+
+
+def test_unknown_profile_is_rejected():
+    with pytest.raises(ValueError, match="Unknown engine profile"):
+        make_engine("sqlite+aiosqlite://", profile="turbo")
+
+
+def test_read_only_url_reopens_sqlite_file_in_ro_mode():
+    url = read_only_url("sqlite+aiosqlite:///./mini_wallet.db")
+
+    assert url.database == "file:./mini_wallet.db"
+    assert dict(url.query) == {"mode": "ro", "uri": "true"}
+    assert read_only_url("sqlite+aiosqlite://") is None
+    assert read_only_url("postgresql+asyncpg://wallet@db/wallet") is None
+
+
+@pytest.mark.anyio
+async def test_read_only_engine_cannot_write(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}"
+    primary = make_engine(url)
+    async with primary.begin() as conn:
+        await conn.execute(text("CREATE TABLE wallets (id TEXT)"))
+    reader = make_engine(read_only_url(url), read_only=True)
+
+    async with reader.connect() as conn:
+        assert (await conn.execute(text("SELECT count(*) FROM wallets"))).scalar() == 0
+        with pytest.raises(OperationalError, match="readonly"):
+            await conn.execute(text("INSERT INTO wallets VALUES ('1')"))
+
+    await reader.dispose()
+    await primary.dispose()
+
+
+def test_writers_are_pinned_to_primary():
+    assert not is_pinned_to_primary("writer_token")
+
+    pin_to_primary("writer_token")
+
+    assert is_pinned_to_primary("writer_token")
+    assert not is_pinned_to_primary("reader_token")
+
+
+@pytest.mark.anyio
+async def test_concurrent_read_then_write_transactions_wait_for_each_other(tmp_path):
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}")
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE wallets (id TEXT, balance INTEGER)"))
+        await conn.execute(text("INSERT INTO wallets VALUES ('1', 0)"))
+
+    async def read_then_write():
+        async with engine.connect() as conn:
+            await conn.execution_options(**{BEGIN_IMMEDIATE: True})
+            await conn.begin()
+            balance = (await conn.execute(text("SELECT balance FROM wallets"))).scalar()
+            await anyio.sleep(0.01)
+            await conn.execute(text("UPDATE wallets SET balance = :balance"), {"balance": balance + 1})
+            await conn.commit()
+
+    async with anyio.create_task_group() as group:
+        for _ in range(5):
+            group.start_soon(read_then_write)
+
+    async with engine.connect() as conn:
+        assert (await conn.execute(text("SELECT balance FROM wallets"))).scalar() == 5
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_open_read_transaction_does_not_block_a_writer(tmp_path, monkeypatch):
+    monkeypatch.setenv("WALLET_SQLITE_BUSY_TIMEOUT", "100")
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}")
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE wallets (id TEXT, balance INTEGER)"))
+        await conn.execute(text("INSERT INTO wallets VALUES ('1', 0)"))
+    sessions = async_sessionmaker(bind=engine)
+
+    async with sessions() as reader, sessions() as writer:
+        await reader.execute(text("SELECT balance FROM wallets"))
+        await writer.execute(text("SELECT balance FROM wallets"))
+        await begin_write(writer)
+        await writer.execute(text("UPDATE wallets SET balance = 1"))
+        await writer.commit()
+        assert reader.in_transaction()
+
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_writers_of_one_process_take_turns_in_order(tmp_path, monkeypatch):
+    monkeypatch.setenv("WALLET_SQLITE_BUSY_TIMEOUT", "2000")
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'primary.db'}")
+    async with engine.begin() as conn:
+        await conn.execute(text("CREATE TABLE writes (position INTEGER)"))
+    sessions = async_sessionmaker(bind=engine)
+    turns = []
+
+    async def write(position):
+        async with sessions() as db:
+            await begin_write(db)
+            turns.append(position)
+            await db.execute(text("INSERT INTO writes VALUES (:position)"), {"position": position})
+            await anyio.sleep(0.01)
+            if position % 2:
+                await db.rollback()
+            else:
+                await db.commit()
+
+    async with anyio.create_task_group() as group:
+        for position in range(12):
+            group.start_soon(write, position)
+            await anyio.sleep(0.001)
+
+    assert turns == list(range(12))
+    async with sessions() as db:
+        assert (await db.execute(text("SELECT count(*) FROM writes"))).scalar() == 6
+        await begin_write(db)
+        assert WRITE_TURN in db.info
+    assert WRITE_TURN not in db.info
+    await engine.dispose()
@@ -0,0 +1,67 @@
+import pytest
+from fastapi.testclient import TestClient
+from sqlalchemy import text
+
+from database import make_engine
+from main import app
+from metrics import Counter, Histogram, QUERIES, RequestStats, current_request, instrument_engine
+
+client = TestClient(app)
+
+
+def test_histogram_renders_cumulative_buckets():
+    histogram = Histogram("latency_seconds", "Latency", ("route",), buckets=(0.1, 1.0))
+
+    histogram.observe(0.05, "/a")
+    histogram.observe(0.5, "/a")
+    histogram.observe(5, "/a")
+
+    assert list(histogram.render()) == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{route="/a",le="0.1"} 1',
+        'latency_seconds_bucket{route="/a",le="1.0"} 2',
+        'latency_seconds_bucket{route="/a",le="+Inf"} 3',
+        'latency_seconds_sum{route="/a"} 5.55',
+        'latency_seconds_count{route="/a"} 3'
+    ]
+
+
+def test_counter_escapes_label_values():
+    counter = Counter("requests_total", "Requests", ("route",))
+
+    counter.inc('say "hi"')
+
+    assert list(counter.render())[-1] == 'requests_total{route="say \\"hi\\""} 1'
+
+
+@pytest.mark.anyio
+async def test_instrumented_engine_counts_queries_for_the_current_request(tmp_path):
+    engine = make_engine(f"sqlite+aiosqlite:///{tmp_path / 'metrics.db'}")
+    instrument_engine(engine, "metrics_test")
+    stats = RequestStats()
+    token = current_request.set(stats)
+    try:
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+            await conn.execute(text("SELECT 2"))
+    finally:
+        current_request.reset(token)
+        await engine.dispose()
+
+    # The explicit BEGIN emitted for SQLite counts too: BEGIN IMMEDIATE is where a writer waits for the lock.
+    assert stats.queries == 3
+    assert stats.db_seconds > 0
+    assert QUERIES.values[("metrics_test",)] == 3
+
+
+def test_metrics_endpoint_reports_requests_by_route_template():
+    client.get("/api/v1/wallet/transactions", headers={"Authorization": "Token not_a_real_token"})
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    assert 'wallet_http_requests_total{method="GET",route="/api/v1/wallet/transactions",status="404"}' \
+        in response.text
+    assert 'wallet_cache_hit_ratio{cache="wallet_identity"}' in response.text
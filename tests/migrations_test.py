@@ -0,0 +1,158 @@
+from datetime import datetime
+
+import pytest
+from sqlalchemy import func, inspect, select, text, update
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+import archive
+import crud
+import migrations
+import models
+from database import make_engine, schema_engine
+
+# The tables as the first release created them with create_all, before versioned migrations.
+FIRST_RELEASE_SCHEMA = [
+    "CREATE TABLE wallets (id VARCHAR NOT NULL, customer_xid VARCHAR, status VARCHAR, enabled_at DATETIME, "
+    "balance FLOAT, token VARCHAR, disabled_at DATETIME, PRIMARY KEY (id), UNIQUE (token))",
+    "CREATE INDEX ix_wallets_id ON wallets (id)",
+    "CREATE INDEX ix_wallets_customer_xid ON wallets (customer_xid)",
+    "CREATE TABLE transactions (id VARCHAR NOT NULL, status VARCHAR, transacted_at DATETIME, type VARCHAR, "
+    "amount FLOAT, reference_id VARCHAR, wallet_id VARCHAR, PRIMARY KEY (id), "
+    "FOREIGN KEY(wallet_id) REFERENCES wallets (id))",
+    "CREATE INDEX ix_transactions_id ON transactions (id)",
+    "CREATE INDEX ix_transactions_reference_id ON transactions (reference_id)",
+]
+
+TRIGGERS = text("SELECT name FROM sqlite_master WHERE type = 'trigger'")
+
+
+@pytest.fixture
+def database_url(tmp_path):
+    return f"sqlite+aiosqlite:///{tmp_path / 'migrations_test.db'}"
+
+
+def _query(url, statement):
+    engine = schema_engine(url)
+    try:
+        with engine.connect() as conn:
+            return conn.execute(statement).all()
+    finally:
+        engine.dispose()
+
+
+def test_empty_database_is_created_at_the_latest_version(database_url):
+    assert migrations.migrate(database_url) == (0, migrations.LATEST_VERSION)
+    assert migrations.migrate(database_url) == (migrations.LATEST_VERSION, migrations.LATEST_VERSION)
+
+    versions = _query(database_url, select(migrations.schema_version.c.version))
+    assert [version for version, in versions] == [migration.version for migration in migrations.MIGRATIONS]
+    assert _query(database_url, TRIGGERS) == [("transactions_daily_rollup",)]
+
+
+def test_first_release_database_is_upgraded_and_backfilled(database_url, monkeypatch):
+    monkeypatch.setattr(crud, "CHECKPOINT_INTERVAL", 2)
+    engine = schema_engine(database_url)
+    with engine.begin() as conn:
+        for statement in FIRST_RELEASE_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO wallets VALUES ('w1', 'customer', 'enabled', NULL, 12, 'token', NULL)"))
+        for index, (kind, amount) in enumerate([("deposit", 10), ("withdrawal", 3), ("deposit", 5)]):
+            conn.execute(text("INSERT INTO transactions VALUES (:id, 'success', :at, :kind, :amount, :id, 'w1')"),
+                         {"id": f"t{index}", "at": datetime(2024, 1, 1 + index), "kind": kind, "amount": amount})
+    engine.dispose()
+
+    assert migrations.migrate(database_url) == (0, migrations.LATEST_VERSION)
+
+    transactions = models.Transaction
+    assert _query(database_url, select(transactions.id, transactions.balance_after).order_by(transactions.id)) == [
+        ("t0", 10), ("t1", 7), ("t2", 12)]
+    assert _query(database_url, select(models.Wallet.transaction_count, models.Wallet.version)) == [(3, 0)]
+    assert _query(database_url, select(models.BalanceCheckpoint.transaction_id, models.BalanceCheckpoint.balance)) \
+        == [("t1", 7)]
+    assert len(_query(database_url, select(models.DailyRollup.day))) == 3
+    assert _query(database_url, TRIGGERS) == [("transactions_daily_rollup",)]
+
+    engine = schema_engine(database_url)
+    with engine.connect() as conn:
+        indexes = {index["name"]: index for index in inspect(conn).get_indexes("transactions")}
+        assert "ix_wallets_id" not in {index["name"] for index in inspect(conn).get_indexes("wallets")}
+        assert inspect(conn).has_table("wallet_directory")
+        assert inspect(conn).has_table("reconciliation_runs")
+    engine.dispose()
+    assert indexes["ix_transactions_wallet_id_reference_id"]["unique"]
+    assert "ix_transactions_reference_id" not in indexes
+    assert "ix_transactions_wallet_id_transacted_at_id" in indexes
+
+
+def _first_release_database(url, transactions):
+    engine = schema_engine(url)
+    with engine.begin() as conn:
+        for statement in FIRST_RELEASE_SCHEMA:
+            conn.execute(text(statement))
+        conn.execute(text("INSERT INTO wallets VALUES ('w1', 'customer', 'enabled', NULL, 20, 'token', NULL)"))
+        for index, reference_id in enumerate(transactions):
+            conn.execute(text("INSERT INTO transactions VALUES (:id, 'success', :at, 'deposit', 10, :reference, 'w1')"),
+                         {"id": f"t{index}", "at": datetime(2024, 1, 1 + index), "reference": reference_id})
+    engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_upgraded_database_replays_retried_deposits(database_url):
+    # The first release indexed reference_id without making it unique; idempotent writes need it unique per wallet.
+    _first_release_database(database_url, ["r0", "r1"])
+    migrations.migrate(database_url)
+
+    engine = make_engine(database_url)
+    sessions = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    try:
+        async with sessions() as db:
+            original = await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 5, "retried")
+        async with sessions() as db:
+            assert (await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 5, "retried")).id == original.id
+        async with sessions() as db:
+            assert (await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 10, "r0")).id == "t0"
+            assert (await crud.get_wallet(db, "w1")).balance == 25
+    finally:
+        await engine.dispose()
+
+
+def test_upgrade_stops_on_duplicate_reference_ids(database_url):
+    _first_release_database(database_url, ["r0", "r0"])
+
+    with pytest.raises(RuntimeError, match="ix_transactions_wallet_id_reference_id"):
+        migrations.migrate(database_url)
+    assert _query(database_url, select(func.max(migrations.schema_version.c.version))) == [(1,)]
+
+
+@pytest.mark.anyio
+async def test_references_are_backfilled_from_both_tiers(database_url, tmp_path, monkeypatch):
+    monkeypatch.setenv("WALLET_ARCHIVE_DIR", str(tmp_path / "archive"))
+    migrations.migrate(database_url)
+    engine = make_engine(database_url)
+    sessions = async_sessionmaker(bind=engine, autoflush=False, expire_on_commit=False)
+    try:
+        async with sessions() as db:
+            db.add(models.Wallet(id="w1", customer_xid="customer", token="token", status="enabled", balance=0))
+            await db.commit()
+            old = await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 10, "old")
+            await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 20, "new")
+            await db.execute(update(models.Transaction).where(models.Transaction.id == old.id)
+                             .values(transacted_at=datetime(2020, 1, 1)))
+            await db.commit()
+        assert await archive.archive_transactions(sessions, datetime(2021, 1, 1)) == 1
+
+        # A database from before migration 10.
+        async with engine.begin() as conn:
+            await conn.execute(text("DROP TABLE transaction_references"))
+            await conn.execute(text("DELETE FROM schema_version WHERE version >= 10"))
+        await engine.dispose()
+        assert migrations.migrate(database_url) == (9, migrations.LATEST_VERSION)
+
+        async with sessions() as db:
+            references = (await db.execute(select(models.TransactionReference.reference_id))).scalars().all()
+            assert sorted(references) == ["new", "old"]
+            assert (await crud.add_deposit(db, await crud.get_wallet(db, "w1"), 10, "old")).id == old.id
+            assert (await crud.get_wallet(db, "w1")).balance == 30
+    finally:
+        await engine.dispose()
+        await archive.dispose_engines()
@@ -0,0 +1,62 @@
+import csv
+import uuid
+
+import pytest
+from sqlalchemy import select
+
+import manage
+import models
+import provisioning
+from database import shards
+
+
+def _customers(count):
+    prefix = uuid.uuid4().hex[:8]
+    return [f"{prefix}-{index}" for index in range(count)]
+
+
+async def _wallets(customer_xids):
+    async with shards[0].sessions() as db:
+        rows = await db.execute(select(models.Wallet.customer_xid, models.Wallet.token, models.Wallet.status)
+                                .where(models.Wallet.customer_xid.in_(customer_xids)))
+        return rows.all()
+
+
+@pytest.mark.anyio
+async def test_provisioning_creates_each_customer_one_wallet(monkeypatch):
+    monkeypatch.setattr(provisioning, "STATEMENT_CHUNK_SIZE", 3)
+    customers = _customers(7)
+    mappings = []
+
+    result = await provisioning.provision_wallets(customers[:5] + [customers[0]], mappings.extend, chunk_size=4)
+    assert result == (5, 1)
+    assert [customer_xid for customer_xid, _ in mappings] == customers[:5] + [customers[0]]
+    assert mappings[0][1] == mappings[-1][1]
+
+    again = []
+    assert await provisioning.provision_wallets(customers, again.extend, chunk_size=4) == (2, 5)
+    assert again[:5] == mappings[:5]
+
+    wallets = await _wallets(customers)
+    assert sorted((customer_xid, token) for customer_xid, token, _ in wallets) == sorted(again)
+    assert {status for _, _, status in wallets} == {"disabled"}
+
+
+def test_interrupted_provisioning_resumes_from_the_mapping_file(tmp_path):
+    customers = _customers(10)
+    source = tmp_path / "customers.txt"
+    source.write_text("\n".join(customers[:6]) + "\n\n" + "\n".join(customers[6:]) + "\n")
+    output = tmp_path / "mapping.csv"
+
+    manage.main(["provision", str(source), "--output", str(output), "--chunk-size", "4"])
+    written = output.read_text()
+    # Stop as if interrupted in the middle of the fifth row, after every wallet had been committed.
+    output.write_text(written[:written.index(customers[4]) + 3])
+
+    with pytest.raises(SystemExit):
+        manage.main(["provision", str(source), "--output", str(output)])
+    manage.main(["provision", str(source), "--output", str(output), "--resume", "--chunk-size", "4"])
+
+    assert output.read_text() == written
+    with open(output, newline="") as mapping:
+        assert [row[0] for row in csv.reader(mapping)] == ["customer_xid"] + customers
@@ -0,0 +1,167 @@
+import uuid
+
+import httpx
+import pytest
+
+import crud
+import models
+from cache import WalletIdentity, wallet_cache
+from database import shards
+from main import app
+from metrics import QueryCounter
+
+
+def _amount():
+    return {"data": {"amount": 5, "reference_id": str(uuid.uuid4())}}
+
+
+def _batch():
+    items = [("deposit", 5), ("withdrawal", 1), ("deposit", 2)]
+    return {"json": {"items": [
+        {"type": kind, "amount": amount, "reference_id": str(uuid.uuid4())} for kind, amount in items]}}
+
+
+# method, path, request arguments, max statements (BEGIN and COMMIT included), max rows fetched.
+# Every request runs with a cold auth cache, so the token lookup is part of each budget. History pages and exports
+# read the wallet's version and whether it has archived months in the same query as the token.
+# Writes commit the read transaction of the token lookup before they begin their own with BEGIN IMMEDIATE; on
+# SQLite a trigger keeps the daily rollups, so they cost no statement of their own. Every write also records its
+# reference ids in transaction_references, which outlives archival.
+BUDGETS = [
+    ("GET", "/api/v1/wallet", dict, 3, 2),
+    ("GET", "/api/v1/wallet/balance", lambda: {"params": {"at": "2100-01-01T00:00:00"}}, 3, 2),
+    ("GET", "/api/v1/wallet/summary", dict, 3, 2),
+    ("GET", "/api/v1/wallet/transactions", lambda: {"params": {"limit": 10}}, 3, 13),
+    # Streamed rows are not counted, see QueryCounter.
+    ("GET", "/api/v1/wallet/transactions/export", dict, 3, 1),
+    ("POST", "/api/v1/wallet/deposits", _amount, 8, 4),
+    ("POST", "/api/v1/wallet/withdrawals", _amount, 8, 4),
+    ("POST", "/api/v1/wallet/batch", _batch, 10, 3),
+    ("PATCH", "/api/v1/wallet", lambda: {"data": {"is_disabled": "true"}}, 6, 1),
+]
+
+
+@pytest.fixture
+async def api():
+    """
+    HTTP client for the app as deployed: its own session dependencies over the file-backed test database
+    """
+    async with httpx.AsyncClient(app=app, base_url="http://test") as client:
+        yield client
+
+
+@pytest.fixture
+def query_counter():
+    """
+    QueryCounter on both engines of the app's shard, the primary and the read-only pool
+    """
+    return QueryCounter(shards[0].engine, shards[0].read_engine)
+
+
+@pytest.fixture
+def session_factory():
+    return shards[0].sessions
+
+
+@pytest.fixture
+async def enabled_wallet(session_factory):
+    """
+    An enabled wallet of its own for every test, as the app database is shared by the whole run
+    """
+    async with session_factory() as db:
+        wallet = models.Wallet(customer_xid="budget_customer", token=uuid.uuid4().hex, status="enabled", balance=0)
+        db.add(wallet)
+        await db.commit()
+        return wallet
+
+
+@pytest.fixture
+def auth(enabled_wallet):
+    return {"Authorization": f"Token {enabled_wallet.token}"}
+
+
+async def _add_deposits(session_factory, wallet, count):
+    async with session_factory() as db:
+        for _ in range(count):
+            await crud.add_deposit(db, wallet, 10, str(uuid.uuid4()))
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("method, path, arguments, max_statements, max_rows", BUDGETS,
+                         ids=[f"{method} {path}" for method, path, *_ in BUDGETS])
+async def test_endpoint_stays_within_query_budget(method, path, arguments, max_statements, max_rows, api,
+                                                  session_factory, enabled_wallet, auth, query_counter):
+    await _add_deposits(session_factory, enabled_wallet, 3)
+
+    with query_counter:
+        response = await api.request(method, path, headers=auth, **arguments())
+
+    assert response.status_code < 300, response.text
+    statements = "\n".join(statement for statement, _ in query_counter.statements)
+    assert query_counter.count <= max_statements, f"{query_counter.count} statements:\n{statements}"
+    assert query_counter.rows <= max_rows, f"{query_counter.rows} rows:\n{statements}"
+    assert not query_counter.repeated(), statements
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path, arguments", [(path, arguments) for method, path, arguments, *_ in BUDGETS
+                                              if method == "GET"])
+async def test_read_endpoint_statements_do_not_grow_with_history(path, arguments, api, session_factory,
+                                                                  enabled_wallet, auth, query_counter):
+    counts = []
+    for deposits in (1, 25):
+        await _add_deposits(session_factory, enabled_wallet, deposits)
+        wallet_cache.clear()
+        with query_counter:
+            response = await api.get(path, headers=auth, **arguments())
+        assert response.status_code == 200
+        counts.append(query_counter.count)
+
+    assert counts[1] <= counts[0]
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/api/v1/wallet", "/api/v1/wallet/transactions"])
+async def test_conditional_get_of_an_unchanged_wallet_runs_no_queries(path, api, session_factory, enabled_wallet,
+                                                                      auth, query_counter):
+    await _add_deposits(session_factory, enabled_wallet, 3)
+    etag = (await api.get(path, headers=auth)).headers["ETag"]
+
+    with query_counter:
+        response = await api.get(path, headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 304 and response.headers["ETag"] == etag
+    assert query_counter.count == 0, query_counter.statements
+
+    await _add_deposits(session_factory, enabled_wallet, 1)
+    response = await api.get(path, headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 200 and response.headers["ETag"] != etag
+
+
+@pytest.mark.anyio
+@pytest.mark.parametrize("path", ["/api/v1/wallet", "/api/v1/wallet/transactions"])
+async def test_conditional_get_of_a_disabled_wallet_is_refused(path, api, enabled_wallet, auth):
+    etag = (await api.get(path, headers=auth)).headers["ETag"]
+    assert (await api.patch("/api/v1/wallet", headers=auth, data={"is_disabled": "true"})).status_code == 200
+
+    response = await api.get(path, headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 400
+
+    # Another worker's auth cache still holds the wallet as enabled.
+    wallet_cache.set(enabled_wallet.token, WalletIdentity(enabled_wallet.id, "enabled", enabled_wallet.customer_xid))
+    assert (await api.get(path, headers=auth)).status_code == 400
+    response = await api.get(path, headers={**auth, "If-None-Match": etag})
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_init_and_enable_stay_within_query_budget(api, query_counter):
+    with query_counter:
+        response = await api.post("/api/v1/init", data={"customer_xid": "budget_customer"})
+    assert response.status_code == 201
+    assert query_counter.count <= 3 and query_counter.rows == 0, query_counter.statements
+
+    token = response.json()["data"]["token"]
+    with query_counter:
+        response = await api.post("/api/v1/wallet", headers={"Authorization": f"Token {token}"})
+    assert response.status_code == 201
+    assert query_counter.count <= 6 and query_counter.rows <= 1, query_counter.statements
@@ -0,0 +1,143 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import delete, insert, select, update
+
+import manage
+import migrations
+import models
+import reconcile
+from database import schema_engine
+
+
+def _execute(url, *statements):
+    engine = schema_engine(url)
+    with engine.begin() as conn:
+        for statement in statements:
+            conn.execute(statement)
+    engine.dispose()
+
+
+def _ledger(url, wallet_ids, start=datetime(2024, 1, 1)):
+    """
+    Wallets, each with a deposit of 10 and a withdrawal of 4.25, balances that agree with them
+    """
+    wallets = [{"id": wallet_id, "customer_xid": wallet_id, "status": "enabled", "balance": 5.75,
+                "token": wallet_id, "transaction_count": 2, "version": 2} for wallet_id in wallet_ids]
+    transactions = [
+        {"id": f"{wallet_id}-{kind}", "status": "success", "transacted_at": start + timedelta(minutes=index),
+         "type": kind, "amount": amount, "reference_id": f"{wallet_id}-{kind}", "wallet_id": wallet_id}
+        for wallet_id in wallet_ids
+        for index, (kind, amount) in enumerate((("deposit", 10.0), ("withdrawal", 4.25)))
+    ]
+    _execute(url, insert(models.Wallet).values(wallets), insert(models.Transaction).values(transactions),
+             insert(models.TransactionReference).values([_reference(transaction) for transaction in transactions]))
+
+
+def _reference(transaction):
+    return {"wallet_id": transaction["wallet_id"], "reference_id": transaction["reference_id"],
+            "transaction_id": transaction["id"], "type": transaction["type"], "amount": transaction["amount"],
+            "transacted_at": transaction["transacted_at"]}
+
+
+def _deposit(url, wallet_id, reference_id, amount, balance_change=None):
+    transaction = {"id": reference_id, "status": "success", "transacted_at": datetime(2024, 2, 1), "type": "deposit",
+                   "amount": amount, "reference_id": reference_id, "wallet_id": wallet_id}
+    statements = [insert(models.Transaction).values(transaction),
+                  insert(models.TransactionReference).values(_reference(transaction))]
+    statements.append(update(models.Wallet).where(models.Wallet.id == wallet_id).values(
+        balance=models.Wallet.balance + (amount if balance_change is None else balance_change),
+        transaction_count=models.Wallet.transaction_count + 1))
+    _execute(url, *statements)
+
+
+def test_full_pass_counts_archived_transactions_in(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'ledger.db'}"
+    migrations.migrate(url)
+    wallet_ids = ["0a-archived", "3f-drifted", "c4-fine", "zz-no-transactions"]
+    _ledger(url, wallet_ids[:3])
+    _execute(
+        url,
+        insert(models.Wallet).values(id=wallet_ids[3], customer_xid="x", status="disabled", balance=0,
+                                     token=wallet_ids[3], transaction_count=0, version=0),
+        # Two archived transactions with a running balance of 30 after them.
+        insert(models.ArchivedMonth).values(
+            wallet_id=wallet_ids[0], month="2023-12", transaction_count=2, first_transacted_at=datetime(2023, 12, 1),
+            last_transacted_at=datetime(2023, 12, 2), last_transaction_id="archived-2"),
+        insert(models.BalanceCheckpoint).values(
+            id="checkpoint", wallet_id=wallet_ids[0], transaction_id="archived-2",
+            transacted_at=datetime(2023, 12, 2), transaction_count=2, balance=30.0),
+        update(models.Wallet).where(models.Wallet.id == wallet_ids[0]).values(balance=35.75, transaction_count=4),
+        update(models.Wallet).where(models.Wallet.id == wallet_ids[1]).values(balance=5.5)
+    )
+
+    with ThreadPoolExecutor(2) as executor:
+        summary, mismatches = reconcile.reconcile_shard(3, url, executor, workers=2)
+
+    assert summary == {"shard": 3, "mode": "full", "since": None, "high_water_mark": 6, "wallets_checked": 4,
+                       "transactions_checked": 6, "mismatches": 1}
+    assert mismatches == [{
+        "shard": 3, "wallet_id": "3f-drifted", "balance": 5.5, "expected_balance": 5.75, "difference": -0.25,
+        "transaction_count": 2, "expected_transaction_count": 2, "opening_balance": 0.0, "archived_transactions": 0
+    }]
+
+
+def test_later_passes_only_check_wallets_touched_since(tmp_path, monkeypatch, capsys):
+    database_url = f"sqlite+aiosqlite:///{tmp_path / 'ledger.db'}"
+    monkeypatch.setattr(manage, "SHARD_URLS", [database_url])
+    migrations.migrate(database_url)
+    wallet_ids = [f"{index:x}0-wallet" for index in range(16)]
+    _ledger(database_url, wallet_ids)
+    report_path = tmp_path / "report.json"
+
+    manage.main(["reconcile", "--workers", "2", "--report", str(report_path)])
+    assert json.loads(report_path.read_text())["shards"][0]["wallets_checked"] == 16
+
+    _deposit(database_url, wallet_ids[1], "fine", 1.0)
+    _deposit(database_url, wallet_ids[2], "lost-update", 2.0, balance_change=0.0)
+    # Drift without a transaction row is left to full passes.
+    _execute(database_url, update(models.Wallet).where(models.Wallet.id == wallet_ids[3]).values(balance=1.0))
+
+    with pytest.raises(SystemExit) as exit:
+        manage.main(["reconcile", "--workers", "2"])
+    assert exit.value.code == 1
+    report = json.loads(capsys.readouterr().out)
+    assert report["shards"][0]["mode"] == "incremental"
+    assert report["shards"][0]["wallets_checked"] == 2
+    assert [(mismatch["wallet_id"], mismatch["difference"]) for mismatch in report["mismatches"]] == [
+        (wallet_ids[2], -2.0)]
+
+    with pytest.raises(SystemExit):
+        manage.main(["reconcile", "--workers", "2", "--full", "--report", str(report_path)])
+    assert sorted(mismatch["wallet_id"] for mismatch in json.loads(report_path.read_text())["mismatches"]) == [
+        wallet_ids[2], wallet_ids[3]]
+
+    engine = schema_engine(database_url)
+    with engine.connect() as conn:
+        runs = conn.execute(select(models.ReconciliationRun.mode, models.ReconciliationRun.high_water_mark,
+                                   models.ReconciliationRun.mismatches)
+                            .order_by(models.ReconciliationRun.id)).all()
+    engine.dispose()
+    assert runs == [("full", 32, 0), ("incremental", 34, 1), ("full", 34, 2)]
+
+
+def test_incremental_pass_sees_transactions_after_the_newest_ones_moved_away(tmp_path):
+    url = f"sqlite+aiosqlite:///{tmp_path / 'ledger.db'}"
+    migrations.migrate(url)
+    wallet_ids = ["0a-stays", "f0-moved"]
+    _ledger(url, wallet_ids)
+    with ThreadPoolExecutor(2) as executor:
+        assert reconcile.reconcile_shard(0, url, executor, workers=2)[0]["high_water_mark"] == 4
+
+        # Moving a wallet off the shard deletes the newest rows, after which SQLite would hand their rowids out again.
+        _execute(url, delete(models.TransactionReference).where(models.TransactionReference.wallet_id == wallet_ids[1]),
+                 delete(models.Transaction).where(models.Transaction.wallet_id == wallet_ids[1]),
+                 delete(models.Wallet).where(models.Wallet.id == wallet_ids[1]))
+        _deposit(url, wallet_ids[0], "lost-update", 2.0, balance_change=0.0)
+        summary, mismatches = reconcile.reconcile_shard(0, url, executor, workers=2)
+
+    assert summary["mode"] == "incremental"
+    assert (summary["since"], summary["high_water_mark"], summary["wallets_checked"]) == (4, 5, 1)
+    assert [(mismatch["wallet_id"], mismatch["difference"]) for mismatch in mismatches] == [(wallet_ids[0], -2.0)]
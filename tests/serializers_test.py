@@ -0,0 +1,41 @@
+import json
+from datetime import datetime
+from types import SimpleNamespace
+
+import orjson
+
+from commons import datetime_conversion, format_balance
+from serializers import ORJSONResponse, ndjson_rows, transaction_list, wallet_body
+
+
+def make_row(transacted_at):
+    return SimpleNamespace(id="t1", status="success", transacted_at=transacted_at, type="deposit", amount=10.75,
+                           reference_id="ref-1", balance_after=110.75)
+
+
+def test_transaction_list_matches_the_previous_json_encoding():
+    rows = [make_row(datetime(2024, 1, 2, 3, 4, 5, 678901)), make_row(datetime(2024, 1, 2, 3, 4, 5))]
+    previous = [
+        {"id": row.id, "status": row.status, "transacted_at": datetime_conversion(row.transacted_at),
+         "type": row.type, "amount": format_balance(row.amount), "reference_id": row.reference_id}
+        for row in rows
+    ]
+
+    assert orjson.loads(ORJSONResponse(transaction_list(rows)).body) == previous
+
+
+def test_wallet_body_keeps_missing_timestamps_as_null():
+    wallet = SimpleNamespace(id="w1", customer_xid="c1", status="disabled", disabled_at=None, balance=99.9)
+
+    assert orjson.loads(orjson.dumps(wallet_body(wallet, "disabled_at"))) == {
+        "id": "w1", "owned_by": "c1", "status": "disabled", "disabled_at": None, "balance": 99
+    }
+
+
+def test_ndjson_rows_writes_one_unrounded_line_per_row():
+    lines = ndjson_rows([make_row(datetime(2024, 1, 2)), make_row(datetime(2024, 1, 3))]).decode().splitlines()
+
+    assert len(lines) == 2
+    assert json.loads(lines[1]) == {"id": "t1", "status": "success", "transacted_at": "2024-01-03T00:00:00",
+                                    "type": "deposit", "amount": 10.75, "reference_id": "ref-1",
+                                    "balance_after": 110.75}
@@ -0,0 +1,27 @@
+from server import default_workers, parse_args, server_options
+
+
+def test_production_options_force_uvloop_httptools_and_size_workers_from_cores():
+    options = server_options(parse_args([]))
+
+    assert options["workers"] == default_workers() >= 1
+    assert options["loop"] == "uvloop" and options["http"] == "httptools"
+    assert "reload" not in options
+
+
+def test_limits_come_from_environment_and_flags(monkeypatch):
+    monkeypatch.setenv("WALLET_WORKERS", "3")
+    monkeypatch.setenv("WALLET_LIMIT_CONCURRENCY", "500")
+
+    options = server_options(parse_args(["--keep-alive", "15", "--backlog", "4096"]))
+
+    assert options["workers"] == 3
+    assert options["limit_concurrency"] == 500
+    assert options["timeout_keep_alive"] == 15 and options["backlog"] == 4096
+
+
+def test_dev_mode_runs_one_reloading_process():
+    options = server_options(parse_args(["--dev"]))
+
+    assert options["reload"] is True
+    assert "workers" not in options and "loop" not in options
@@ -0,0 +1,165 @@
+import httpx
+import pytest
+from sqlalchemy import delete, func, select
+
+import crud
+import main
+import models
+import sharding
+from cache import wallet_cache
+from database import Base, _open_shard
+
+
+@pytest.fixture
+async def two_shards(tmp_path, monkeypatch):
+    shards = [_open_shard(index, f"sqlite+aiosqlite:///{tmp_path / f'shard{index}.db'}") for index in range(2)]
+    for shard in shards:
+        async with shard.engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+    monkeypatch.setattr(sharding, "shards", shards)
+    sharding.shard_routes.clear()
+    yield shards
+    sharding.shard_routes.clear()
+    for shard in shards:
+        await shard.engine.dispose()
+        await shard.read_engine.dispose()
+
+
+async def create_funded_wallet(shard, token, deposits=3):
+    async with shard.sessions() as db:
+        wallet = models.Wallet(customer_xid="customer", token=token, status="enabled", balance=0)
+        db.add(wallet)
+        await db.commit()
+        for index in range(deposits):
+            await crud.add_deposit(db, wallet, 10, f"{token}-{index}")
+        return wallet.id
+
+
+async def count(shard, model, wallet_id):
+    async with shard.sessions() as db:
+        return (await db.execute(select(func.count()).select_from(model).filter(
+            model.wallet_id == wallet_id))).scalar()
+
+
+def test_tokens_carry_their_home_shard(monkeypatch):
+    monkeypatch.setattr(sharding, "shards", [None] * 4)
+
+    token = sharding.mint_token(3)
+
+    assert token.startswith("3.")
+    assert sharding.home_shard(token) == 3
+    assert sharding.home_shard("9f86d081884c7d659a2feaa0c55ad015a3bf4f1b") == 0
+    assert sharding.shard_for_wallet("a-wallet-id") == sharding.shard_for_wallet("a-wallet-id") < 4
+
+
+@pytest.mark.anyio
+async def test_move_wallet_copies_the_ledger_and_redirects_the_token(two_shards):
+    wallet_id = await create_funded_wallet(two_shards[0], "0.token")
+
+    assert await sharding.move_wallet(wallet_id, 0, 1)
+
+    assert await count(two_shards[0], models.Transaction, wallet_id) == 0
+    assert await count(two_shards[1], models.Transaction, wallet_id) == 3
+    assert await count(two_shards[1], models.DailyRollup, wallet_id) == 1
+    assert await sharding.resolve_shard("0.token") == 1
+    async with two_shards[1].sessions() as db:
+        assert (await crud.get_wallet(db, wallet_id)).balance == 30
+
+    assert await sharding.move_wallet(wallet_id, 1, 0)
+    assert await sharding.resolve_shard("0.token") == 0
+    async with two_shards[0].sessions() as db:
+        assert (await db.execute(select(func.count()).select_from(models.WalletDirectory))).scalar() == 0
+
+
+@pytest.mark.anyio
+async def test_rerunning_an_interrupted_move_keeps_the_newer_copy(two_shards):
+    wallet_id = await create_funded_wallet(two_shards[0], "0.token")
+    assert await sharding.move_wallet(wallet_id, 0, 1)
+    async with two_shards[1].sessions() as db:
+        await crud.add_deposit(db, await crud.get_wallet(db, wallet_id), 5, "after-move")
+    # A stale copy left on the source, as if the move had stopped before deleting it.
+    await create_funded_wallet(two_shards[0], "0.token", deposits=0)
+    async with two_shards[0].sessions() as db:
+        stale_id = (await crud.get_wallet_by_token(db, "0.token")).id
+
+    assert await sharding.move_wallet(stale_id, 0, 1)
+
+    assert await count(two_shards[1], models.Transaction, wallet_id) == 4
+    async with two_shards[0].sessions() as db:
+        assert await crud.get_wallet_by_token(db, "0.token") is None
+
+
+@pytest.mark.anyio
+async def test_move_wallet_keeps_reference_ids_other_wallets_use_on_the_target(two_shards):
+    wallet_id = await create_funded_wallet(two_shards[0], "0.token")
+    # Reference ids are unique per wallet: another wallet on shard 1 has used one of them.
+    await create_funded_wallet(two_shards[1], "1.other", deposits=0)
+    async with two_shards[1].sessions() as db:
+        await crud.add_deposit(db, await crud.get_wallet_by_token(db, "1.other"), 10, "0.token-1")
+
+    assert await sharding.move_wallet(wallet_id, 0, 1)
+
+    assert await count(two_shards[1], models.Transaction, wallet_id) == 3
+    async with two_shards[1].sessions() as db:
+        wallet = await crud.get_wallet_by_token(db, "0.token")
+        assert (await crud.add_deposit(db, wallet, 10, "0.token-1")).wallet_id == wallet_id
+        assert (await crud.get_wallet(db, wallet_id)).balance == 30
+
+
+@pytest.fixture
+async def two_shard_api(two_shards, monkeypatch):
+    monkeypatch.setattr(main, "shards", two_shards)
+    monkeypatch.setattr(main, "write_coalescers", [None, None])
+    async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+        yield client
+
+
+def _route_to_old_shard(token, identity):
+    # What a process that did not run the move still holds for the token.
+    sharding.shard_routes.set(token, 0)
+    wallet_cache.set(token, identity)
+
+
+@pytest.mark.anyio
+async def test_requests_on_a_stale_route_follow_the_moved_wallet(two_shards, two_shard_api):
+    wallet_id = await create_funded_wallet(two_shards[0], "0.token")
+    auth = {"Authorization": "Token 0.token"}
+    assert (await two_shard_api.get("/api/v1/wallet", headers=auth)).status_code == 200
+    identity = wallet_cache.get("0.token")
+
+    assert await sharding.move_wallet(wallet_id, 0, 1)
+
+    _route_to_old_shard("0.token", identity)
+    response = await two_shard_api.post("/api/v1/wallet/deposits", headers=auth,
+                                        data={"amount": 5, "reference_id": "after-move"})
+    assert response.status_code == 201, response.text
+    assert await sharding.resolve_shard("0.token") == 1
+
+    for path in ("/api/v1/wallet", "/api/v1/wallet/transactions", "/api/v1/wallet/summary"):
+        _route_to_old_shard("0.token", identity)
+        response = await two_shard_api.get(path, headers=auth)
+        assert response.status_code == 200, (path, response.text)
+    _route_to_old_shard("0.token", identity)
+    response = await two_shard_api.post("/api/v1/wallet/batch", headers=auth, json={"items": [
+        {"type": "withdrawal", "amount": 15, "reference_id": "batch-after-move"}]})
+    assert response.json()["data"]["results"][0]["status"] == "success", response.text
+
+    async with two_shards[1].sessions() as db:
+        assert (await crud.get_wallet(db, wallet_id)).balance == 20
+
+
+@pytest.mark.anyio
+async def test_a_missing_wallet_is_not_found_rather_than_disabled(two_shards, two_shard_api):
+    wallet_id = await create_funded_wallet(two_shards[0], "0.token")
+    async with two_shards[0].sessions() as db:
+        identity = await crud.get_wallet_identity(db, "0.token")
+        await db.execute(delete(models.Wallet).where(models.Wallet.id == wallet_id))
+        await db.commit()
+
+    auth = {"Authorization": "Token 0.token"}
+    for method, path, arguments in [("POST", "/api/v1/wallet/deposits", {"data": {"amount": 5, "reference_id": "r"}}),
+                                    ("GET", "/api/v1/wallet/balance", {"params": {"at": "2100-01-01T00:00:00"}}),
+                                    ("GET", "/api/v1/wallet/transactions", {})]:
+        wallet_cache.set("0.token", identity)
+        response = await two_shard_api.request(method, path, headers=auth, **arguments)
+        assert (response.status_code, response.json()) == (404, {"detail": "Wallet not found"}), path
@@ -0,0 +1,24 @@
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import ROOT, cold_start, migrated_environment
+
+# Seconds from importing main to the first response in a fresh process, see benchmarks/startup.py. Most of it
+# is importing FastAPI and SQLAlchemy; raise WALLET_STARTUP_BUDGET on machines slower than the CI runners.
+STARTUP_BUDGET_SECONDS = float(os.getenv("WALLET_STARTUP_BUDGET", "3"))
+
+
+def test_cold_start_stays_within_budget(tmp_path):
+    result = cold_start(migrated_environment(str(tmp_path)))
+
+    assert result["first_response_seconds"] <= STARTUP_BUDGET_SECONDS, result
+
+
+def test_importing_the_app_does_not_touch_the_database(tmp_path):
+    database = tmp_path / "untouched.db"
+    env = {**os.environ, "WALLET_DATABASE_URL": f"sqlite+aiosqlite:///{database}"}
+
+    subprocess.run([sys.executable, "-c", "import main"], cwd=ROOT, env=env, check=True)
+
+    assert not database.exists()
@@ -0,0 +1,149 @@
+import asyncio
+import uuid
+
+import httpx
+import pytest
+
+import crud
+from cache import wallet_cache
+from writer import WriteCoalescer
+
+
+@pytest.fixture
+async def coalescer(session_factory):
+    writer = WriteCoalescer(session_factory, max_batch=16, max_delay=0.05)
+    await writer.start()
+    yield writer
+    await writer.stop()
+
+
+@pytest.mark.anyio
+async def test_concurrent_writes_share_one_commit(coalescer, session_factory, enabled_wallet):
+    results = await asyncio.gather(*[
+        coalescer.submit(crud.add_deposit, wallet=enabled_wallet, amount=10, reference_id=f"ref_{index}")
+        for index in range(5)
+    ])
+
+    assert [transaction.reference_id for transaction in results] == [f"ref_{index}" for index in range(5)]
+    assert coalescer.commits == 1
+    assert coalescer.writes == 5
+    async with session_factory() as db:
+        assert (await crud.get_wallet(db, enabled_wallet.id)).balance == 50
+
+
+@pytest.mark.anyio
+async def test_failed_operation_does_not_fail_the_others(coalescer, session_factory, enabled_wallet):
+    results = await asyncio.gather(
+        coalescer.submit(crud.add_deposit, wallet=enabled_wallet, amount=100, reference_id="ref_deposit"),
+        coalescer.submit(crud.make_withdrawal, wallet=enabled_wallet, amount=500, reference_id="ref_overdraw"),
+        coalescer.submit(crud.make_withdrawal, wallet=enabled_wallet, amount=40, reference_id="ref_withdrawal"),
+        return_exceptions=True
+    )
+
+    assert results[0].reference_id == "ref_deposit"
+    assert isinstance(results[1], ValueError)
+    assert str(results[1]) == "Insufficient balance"
+    assert results[2].reference_id == "ref_withdrawal"
+    assert coalescer.commits == 1
+    async with session_factory() as db:
+        assert (await crud.get_wallet(db, enabled_wallet.id)).balance == 60
+        page = await crud.get_transactions_page(db, enabled_wallet, limit=10)
+        assert {transaction.reference_id for transaction in page} == {"ref_deposit", "ref_withdrawal"}
+
+
+@pytest.mark.anyio
+async def test_retried_write_is_discarded_and_replays_the_original(coalescer, session_factory, enabled_wallet):
+    original = await coalescer.submit(crud.add_deposit, wallet=enabled_wallet, amount=100, reference_id="ref_retry")
+    async with session_factory() as db:
+        version = await crud.get_wallet_version(db, enabled_wallet.id)
+
+    results = await asyncio.gather(*[
+        coalescer.submit(crud.add_deposit, wallet=enabled_wallet, amount=100, reference_id="ref_retry")
+        for _ in range(2)
+    ])
+
+    assert [transaction.id for transaction in results] == [original.id] * 2
+    assert results[0].balance_after == 100
+    async with session_factory() as db:
+        wallet = await crud.get_wallet(db, enabled_wallet.id)
+        assert (wallet.balance, wallet.transaction_count, wallet.version) == (100, 1, version)
+
+
+@pytest.mark.anyio
+async def test_status_changes_go_through_the_writer(coalescer, session_factory, enabled_wallet):
+    async with session_factory() as db:
+        wallet = await crud.get_wallet(db, enabled_wallet.id)
+
+    disabled = await coalescer.submit(crud.disable_wallet, wallet=wallet)
+
+    assert disabled.status == "disabled"
+    async with session_factory() as db:
+        assert (await crud.get_wallet(db, enabled_wallet.id)).status == "disabled"
+
+
+@pytest.fixture
+async def app_writer(monkeypatch):
+    """
+    The app with group commit on, as with WALLET_GROUP_COMMIT=1, over its own file-backed WAL database
+    """
+    import main
+    from database import shards
+
+    writer = WriteCoalescer(lambda: shards[0].sessions(), max_batch=16, max_delay=0.01)
+    monkeypatch.setattr(main, "write_coalescers", [writer])
+    await writer.start()
+    async with httpx.AsyncClient(app=main.app, base_url="http://test") as client:
+        yield client, writer
+    await writer.stop()
+
+
+async def _new_wallet(client):
+    response = await client.post("/api/v1/init", data={"customer_xid": "group_commit_customer"})
+    assert response.status_code == 201
+    return {"Authorization": f"Token {response.json()['data']['token']}"}
+
+
+@pytest.mark.anyio
+async def test_wallet_lifecycle_through_the_app_writer(app_writer):
+    client, writer = app_writer
+    auth = await _new_wallet(client)
+
+    # Every step starts with a cold auth cache, so the request session has read before it hands the write over.
+    steps = [
+        ("post", "/api/v1/wallet", {}, 201),
+        ("post", "/api/v1/wallet/deposits", {"data": {"amount": 100, "reference_id": "lifecycle_deposit"}}, 201),
+        ("post", "/api/v1/wallet/withdrawals", {"data": {"amount": 30, "reference_id": "lifecycle_withdrawal"}}, 201),
+        ("patch", "/api/v1/wallet", {"data": {"is_disabled": "true"}}, 200),
+    ]
+    for method, path, arguments, status_code in steps:
+        wallet_cache.clear()
+        response = await asyncio.wait_for(client.request(method.upper(), path, headers=auth, **arguments), 2)
+        assert response.status_code == status_code, response.text
+
+    assert writer.writes == 4
+    assert response.json()["data"]["wallet"]["status"] == "disabled"
+    wallet_cache.clear()
+    response = await client.post("/api/v1/wallet/deposits", headers=auth,
+                                 data={"amount": 1, "reference_id": "after_disable"})
+    assert response.status_code == 400
+
+
+@pytest.mark.anyio
+async def test_concurrent_app_writes_share_commits(app_writer):
+    client, writer = app_writer
+    wallets = [await _new_wallet(client) for _ in range(4)]
+    for auth in wallets:
+        assert (await client.post("/api/v1/wallet", headers=auth)).status_code == 201
+    wallet_cache.clear()
+    commits = writer.commits
+
+    responses = await asyncio.wait_for(asyncio.gather(*[
+        client.post("/api/v1/wallet/deposits", headers=auth, data={"amount": 10, "reference_id": str(uuid.uuid4())})
+        for auth in wallets for _ in range(3)
+    ]), 5)
+
+    assert [response.status_code for response in responses] == [201] * 12
+    assert writer.commits - commits < 12
+    balances = [(await client.get("/api/v1/wallet", headers=auth)).json()["data"]["wallet"]["balance"]
+                for auth in wallets]
+    assert balances == [30] * 4
@@ -0,0 +1,131 @@
+import asyncio
+import os
+from typing import Optional
+
+from database import begin_write
+
+
+class Discard(Exception):
+    """
+    Raised by an operation that has nothing to write after all, e.g. a retried request, to roll its savepoint
+    back and still return `result` to its caller
+    """
+
+    def __init__(self, result):
+        super().__init__(result)
+        self.result = result
+
+
+class WriteCoalescer:
+    """
+    Group-commit pipeline for the single-writer SQLite backend. One task drains a queue of write operations,
+    gathering whatever arrives within `max_delay` seconds (up to `max_batch` operations), applies each one in
+    its own SAVEPOINT of a shared transaction and commits once, so the batch pays for one fsync. Every caller
+    gets back its own result or error: a failing operation only rolls back its savepoint.
+
+    Operations are crud write functions that accept `commit=False`; they are called as operation(db, **kwargs).
+    An operation raises Discard to undo its writes and still return a result.
+    """
+
+    def __init__(self, session_factory, max_batch: int = 64, max_delay: float = 0.002):
+        self.session_factory = session_factory
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.writes = 0
+        self.commits = 0
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def start(self):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is None:
+            return
+        await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def submit(self, operation, **kwargs):
+        if self._task is None:
+            raise RuntimeError("Write coalescer is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((operation, kwargs, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    batch.append(self._queue.get_nowait())
+                    continue
+                except asyncio.QueueEmpty:
+                    pass
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            try:
+                await self._apply(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _apply(self, batch):
+        outcomes = []
+        try:
+            async with self.session_factory() as db:
+                await begin_write(db)
+                for operation, kwargs, future in batch:
+                    try:
+                        async with db.begin_nested():
+                            result = await operation(db, commit=False, **kwargs)
+                        outcomes.append((future, result, None))
+                    except Discard as discard:
+                        outcomes.append((future, discard.result, None))
+                    except Exception as e:
+                        outcomes.append((future, None, e))
+                await db.commit()
+        except Exception as e:
+            outcomes = [(future, None, error or e) for future, _, error in outcomes]
+            outcomes += [(future, None, e) for _, _, future in batch[len(outcomes):]]
+        else:
+            self.commits += 1
+            self.writes += len(batch)
+
+        for future, result, error in outcomes:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+
+def coalescer_from_env(session_factory) -> Optional[WriteCoalescer]:
+    """
+    The coalescer is opt-in: WALLET_GROUP_COMMIT=1 enables it, WALLET_GROUP_COMMIT_MAX_BATCH and
+    WALLET_GROUP_COMMIT_MAX_DELAY_MS tune the batch size and gathering window
+    """
+    if os.getenv("WALLET_GROUP_COMMIT", "0") != "1":
+        return None
+    return WriteCoalescer(
+        session_factory,
+        max_batch=int(os.getenv("WALLET_GROUP_COMMIT_MAX_BATCH", "64")),
+        max_delay=float(os.getenv("WALLET_GROUP_COMMIT_MAX_DELAY_MS", "2")) / 1000
+    )